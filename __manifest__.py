@@ -1,6 +1,6 @@
 {
     'name': 'Spanish VeriFactu',
-    'version': '1.0',
+    'version': '1.1',
     'summary': 'Integración con VeriFactu para facturación electrónica en España',
     'category': 'Localization/Spain',
     'description': """
@@ -20,6 +20,12 @@
         'views/res_config_settings_menu.xml',
         'views/res_company_views.xml',
         'views/verifactu_status_wizard.xml',
+        'views/verifactu_submission_views.xml',
+        'views/verifactu_chain_views.xml',
+        'views/verifactu_export_wizard.xml',
+        'views/verifactu_response_line_views.xml',
+        'views/verifactu_circuit_views.xml',
+        'data/verifactu_cron.xml',
     ],
     'images': ['static/description/icon.png'],
     'installable': True,
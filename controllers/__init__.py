@@ -1,4 +1,6 @@
 from . import qr_scanner
 from . import invoice_pdf
 from . import auth_handler
-from . import verifactu_downloader
\ No newline at end of file
+from . import verifactu_downloader
+from . import verifactu_export
+from . import verifactu_metrics
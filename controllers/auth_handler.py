@@ -23,11 +23,11 @@ class AuthHandler:
 
             if uid:
                 try:
-                    # Ejecutamos la acción de envío con privilegios del usuario autenticado
+                    # Encolamos el envío con privilegios del usuario autenticado
                     invoice.with_user(uid).action_send_verifactu()
 
                     # Registramos un mensaje interno en el chatter de la factura
-                    invoice.message_post(body="Factura enviada a la AEAT desde QR escaneado.")
+                    invoice.message_post(body="Factura añadida a la cola de envío a la AEAT desde QR escaneado.")
 
                     # Mostramos el PDF generado tras el envío
                     return self.render_invoice_pdf(invoice)
@@ -1,6 +1,10 @@
 from odoo import http
 from odoo.http import request
+from collections import OrderedDict
 import logging
+import re
+import threading
+import time
 
 # Importamos las clases auxiliares para manejar PDF e inicio de sesión
 from .invoice_pdf import InvoicePDFHandler
@@ -8,6 +12,40 @@ from .auth_handler import AuthHandler
 
 _logger = logging.getLogger(__name__)
 
+# Caché por worker de las huellas que no corresponden a ninguna factura,
+# durante SCAN_NEGATIVE_TTL segundos, para que los QR inválidos o repetidos
+# no lleguen a la base de datos en cada escaneo. Las huellas encontradas no se
+# guardan: la búsqueda por el índice único de verifactu_hash es una sola consulta.
+SCAN_CACHE_SIZE = 4096
+SCAN_NEGATIVE_TTL = 60
+_SCAN_MISSES = OrderedDict()
+_SCAN_MISSES_LOCK = threading.Lock()
+# Las huellas son SHA-256 en hexadecimal
+HASH_PATTERN = re.compile(r'[0-9A-Fa-f]{64}')
+
+
+def _find_invoice_by_hash(Move, hash_value):
+    if not HASH_PATTERN.fullmatch(hash_value):
+        return Move.browse()
+    key = (Move.env.cr.dbname, hash_value)
+    now = time.monotonic()
+    with _SCAN_MISSES_LOCK:
+        expires = _SCAN_MISSES.get(key)
+        if expires is not None:
+            if expires > now:
+                return Move.browse()
+            del _SCAN_MISSES[key]
+
+    invoice = Move.search([('verifactu_hash', '=', hash_value)], limit=1)
+    if not invoice:
+        with _SCAN_MISSES_LOCK:
+            _SCAN_MISSES[key] = now + SCAN_NEGATIVE_TTL
+            _SCAN_MISSES.move_to_end(key)
+            while len(_SCAN_MISSES) > SCAN_CACHE_SIZE:
+                _SCAN_MISSES.popitem(last=False)
+    return invoice
+
+
 class QRScannerController(http.Controller):
     @http.route('/verifactu/scan/<string:hash_value>', auth='user', website=True, csrf=False)
     def verifactu_scan(self, hash_value, **kwargs):
@@ -19,10 +57,7 @@ class QRScannerController(http.Controller):
         """
         try:
             # Buscamos la factura asociada al hash recibido
-            invoice = request.env['account.move'].sudo().search(
-                [('verifactu_hash', '=', hash_value)], 
-                limit=1
-            )
+            invoice = _find_invoice_by_hash(request.env['account.move'].sudo(), hash_value)
 
             # Si no se encuentra ninguna factura, devolvemos un 404
             if not invoice:
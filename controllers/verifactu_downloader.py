@@ -11,10 +11,12 @@ class VeriFactuDownloadController(http.Controller):
             return request.not_found()
 
         try:
-            xml_data = invoice._generate_verifactu_xml()
+            # XML firmado guardado; solo se genera y firma si la factura ha cambiado
+            xml_data = invoice._get_verifactu_signed_xml().encode('utf-8')
             filename = f"factura_{invoice.name.replace('/', '_')}.xml"
             headers = [
-                ('Content-Type', 'application/xml'),
+                ('Content-Type', 'application/xml; charset=utf-8'),
+                ('Content-Length', len(xml_data)),
                 ('Content-Disposition', content_disposition(filename)),
             ]
             return request.make_response(xml_data, headers)
@@ -0,0 +1,153 @@
+from odoo import http, api
+from odoo.http import request, content_disposition
+import io
+import json
+import logging
+import time
+import zipfile
+
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+# Facturas leídas por lote: la memoria usada depende de este valor, no del total
+EXPORT_BATCH_SIZE = 500
+
+# Estados en los que el XML que cuenta es el enviado a la AEAT
+SENT_STATES = ('sent', 'accepted', 'partially_accepted', 'rejected')
+
+
+class _ZipStream(io.RawIOBase):
+    """Destino de zipfile que acumula lo escrito hasta que se recoge."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _iter_invoices(env, domain, batch_size):
+    """Recorre las facturas del dominio por lotes de id, vaciando la caché entre lotes."""
+    Move = env['account.move']
+    last_id = 0
+    while True:
+        invoices = Move.search(domain + [('id', '>', last_id)], order='id', limit=batch_size)
+        if not invoices:
+            break
+        yield invoices
+        last_id = invoices[-1].id
+        env.invalidate_all()
+
+
+def _stored_signed_xml(env, invoices):
+    """
+    XML firmado guardado de cada factura del lote: si ya se envió a la AEAT
+    (enviada, aceptada o rechazada), el XML enviado; si nunca se envió, el
+    último firmado para la factura (``verifactu.signature``). No se genera
+    ni se firma nada. Devuelve {id de factura: verifactu.payload}.
+    """
+    payloads = {}
+    unsent = env['account.move']
+    for invoice in invoices:
+        if invoice.verifactu_state in SENT_STATES:
+            if invoice.verifactu_xml_payload_id:
+                payloads[invoice.id] = invoice.verifactu_xml_payload_id.sudo()
+        else:
+            unsent |= invoice
+    if unsent:
+        signatures = env['verifactu.signature'].search_read(
+            [('move_id', 'in', unsent.ids), ('verifactu_artifact_payload_id', '!=', False)],
+            ['move_id', 'verifactu_artifact_payload_id'], order='create_date')
+        Payload = env['verifactu.payload'].sudo()
+        payloads.update({
+            row['move_id'][0]: Payload.browse(row['verifactu_artifact_payload_id'][0])
+            for row in signatures
+        })
+    return payloads
+
+
+def _iter_export(registry, uid, context, domain, export_format):
+    """
+    Genera el contenido de la exportación por partes. Usa su propio cursor:
+    el de la petición ya está cerrado cuando el servidor recorre la respuesta.
+    """
+    start = time.monotonic()
+    count = 0
+    with registry.cursor() as cr:
+        env = api.Environment(cr, uid, context)
+        if export_format == 'zip':
+            stream = _ZipStream()
+            # Un XML enviado en lote es común a varias facturas: se incluye una vez
+            written = set()
+            with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for invoices in _iter_invoices(env, domain, EXPORT_BATCH_SIZE):
+                    payloads = _stored_signed_xml(env, invoices)
+                    for invoice in invoices:
+                        payload = payloads.get(invoice.id)
+                        if not payload:
+                            _logger.warning("Factura %s no exportada: no tiene XML firmado guardado", invoice.name)
+                            continue
+                        if payload.id in written:
+                            continue
+                        written.add(payload.id)
+                        archive.writestr(f"{invoice.name.replace('/', '_')}.xml", payload._load())
+                        count += 1
+                    yield stream.pop()
+            yield stream.pop()
+        else:
+            for invoices in _iter_invoices(env, domain, EXPORT_BATCH_SIZE):
+                lines = []
+                for invoice in invoices:
+                    try:
+                        registro = invoice._generate_verifactu_json(create_head=False)
+                    except UserError as e:
+                        _logger.warning("Factura %s no exportada: %s", invoice.name, e)
+                        continue
+                    lines.append(json.dumps(registro, ensure_ascii=False, separators=(',', ':')))
+                count += len(lines)
+                if lines:
+                    yield ('\n'.join(lines) + '\n').encode('utf-8')
+        # Exportación de solo lectura: nada que guardar
+        cr.rollback()
+
+    elapsed = time.monotonic() - start
+    _logger.info("Exportación VeriFactu (%s): %s facturas en %.2fs (%.0f/s)",
+                 export_format, count, elapsed, count / elapsed if elapsed else 0)
+
+
+class VeriFactuExportController(http.Controller):
+
+    # Descarga por partes (chunked) de las facturas seleccionadas en el asistente de exportación
+    @http.route('/verifactu/export/<int:wizard_id>', type='http', auth='user')
+    def export(self, wizard_id, **kwargs):
+        wizard = request.env['verifactu.export.wizard'].browse(wizard_id).exists()
+        if not wizard:
+            return request.not_found()
+
+        domain = wizard._get_export_domain()
+        if wizard.export_format == 'zip':
+            filename = f"verifactu_{wizard.company_id.id}.zip"
+            content_type = 'application/zip'
+        else:
+            filename = f"verifactu_{wizard.company_id.id}.jsonl"
+            content_type = 'application/x-ndjson; charset=utf-8'
+
+        body = _iter_export(request.env.registry, request.env.uid, dict(request.env.context),
+                            domain, wizard.export_format)
+        headers = [
+            ('Content-Type', content_type),
+            ('Content-Disposition', content_disposition(filename)),
+            ('X-Content-Type-Options', 'nosniff'),
+        ]
+        return request.make_response(body, headers=headers)
@@ -0,0 +1,28 @@
+from odoo import http
+from odoo.http import request
+from odoo.tools import config
+import hmac
+
+from ..models import verifactu_metrics
+
+
+class VeriFactuMetricsController(http.Controller):
+
+    # Métricas en formato Prometheus. Se protege con el token ``verifactu_metrics_token``
+    # del fichero de configuración de Odoo (cabecera Authorization: Bearer o parámetro token).
+    @http.route('/verifactu/metrics', type='http', auth='none', methods=['GET'], csrf=False, save_session=False)
+    def metrics(self, token=None, **kwargs):
+        expected = config.get('verifactu_metrics_token')
+        if not expected:
+            return request.not_found()
+
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        if not token or not hmac.compare_digest(token, expected):
+            return request.make_response('Forbidden', headers=[('Content-Type', 'text/plain')], status=403)
+
+        return request.make_response(verifactu_metrics.render_prometheus(), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Cache-Control', 'no-store'),
+        ])
@@ -0,0 +1,46 @@
+"""
+Firma de documentos VeriFactu en los procesos del pool de firma.
+
+Los procesos del pool no arrancan con los addons de Odoo en su ruta de
+importación, así que este módulo no depende de Odoo: lo importan por su
+nombre desde este directorio (ver ``verifactu_signature_model._get_sign_pool``).
+"""
+from cryptography import x509
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from lxml import etree
+from signxml import XMLSigner, methods
+
+# Firmadores ya cargados en el proceso, por huella de credenciales
+_SIGNERS = {}
+
+
+def build_signer():
+    """XMLSigner con los algoritmos de firma que exige la AEAT."""
+    return XMLSigner(
+        method=methods.enveloped,
+        signature_algorithm="rsa-sha256",
+        digest_algorithm="sha256",
+        c14n_algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"
+    )
+
+
+def sign_chunk(credentials, chunk):
+    """
+    Firma los documentos de ``chunk`` (XML en bytes). ``credentials`` es la
+    tupla (huella, certificado PEM, clave PEM, contraseña o None), con el
+    certificado, la clave y la contraseña en bytes. Devuelve los documentos
+    firmados, también en bytes.
+    """
+    fingerprint, cert_pem, key_pem, key_pass = credentials
+    loaded = _SIGNERS.get(fingerprint)
+    if loaded is None:
+        loaded = _SIGNERS[fingerprint] = (
+            load_pem_private_key(key_pem, password=key_pass),
+            x509.load_pem_x509_certificates(cert_pem),
+            build_signer(),
+        )
+    private_key, cert_chain, signer = loaded
+    return [
+        etree.tostring(signer.sign(etree.fromstring(data), key=private_key, cert=cert_chain))
+        for data in chunk
+    ]
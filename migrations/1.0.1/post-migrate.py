@@ -0,0 +1,18 @@
+from odoo import api, SUPERUSER_ID
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """
+    El QR VeriFactu ya no se guarda: se eliminan los PNG que quedaron en el
+    filestore. unlink() los marca para el recolector de ficheros de Odoo.
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    attachments = env['ir.attachment'].search([
+        ('res_model', '=', 'account.move'),
+        ('res_field', '=', 'verifactu_qr'),
+    ])
+    _logger.info("Eliminando %s QR VeriFactu guardados", len(attachments))
+    attachments.unlink()
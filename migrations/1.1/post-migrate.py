@@ -0,0 +1,76 @@
+from odoo import api, SUPERUSER_ID
+from psycopg2.extras import execute_values
+import logging
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def _column_exists(cr, column):
+    cr.execute("""
+        SELECT 1
+          FROM information_schema.columns
+         WHERE table_name = 'account_move' AND column_name = %s
+    """, (column,))
+    return bool(cr.fetchone())
+
+
+def migrate(cr, version):
+    """
+    Mueve el XML enviado y la respuesta de la AEAT de las columnas de
+    account_move al almacén comprimido ``verifactu.payload`` y elimina las
+    columnas antiguas. Se procesa por lotes de id para no cargar toda la
+    tabla en memoria; los contenidos repetidos (facturas de un mismo envío)
+    se guardan una sola vez.
+    """
+    columns = [c for c in ('verifactu_xml', 'verifactu_response') if _column_exists(cr, c)]
+    if not columns:
+        return
+
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    Payload = env['verifactu.payload']
+    xml_select = 'verifactu_xml' if 'verifactu_xml' in columns else 'NULL'
+    response_select = 'verifactu_response' if 'verifactu_response' in columns else 'NULL'
+    where = ' OR '.join('%s IS NOT NULL' % c for c in columns)
+
+    payload_ids = {}
+    last_id = 0
+    migrated = 0
+    while True:
+        cr.execute("""
+            SELECT id, {xml}, {response}
+              FROM account_move
+             WHERE id > %s AND ({where})
+          ORDER BY id
+             LIMIT %s
+        """.format(xml=xml_select, response=response_select, where=where), (last_id, BATCH_SIZE))
+        rows = cr.fetchall()
+        if not rows:
+            break
+
+        values = []
+        for move_id, xml, response in rows:
+            refs = []
+            for text in (xml, response):
+                if text and text not in payload_ids:
+                    payload_ids[text] = Payload._store(text).id
+                refs.append(payload_ids.get(text) if text else None)
+            values.append((move_id, refs[0], refs[1]))
+        execute_values(cr._obj, """
+            UPDATE account_move AS m
+               SET verifactu_xml_payload_id = v.xml_id,
+                   verifactu_response_payload_id = v.response_id
+              FROM (VALUES %s) AS v(id, xml_id, response_id)
+             WHERE m.id = v.id
+        """, values, template='(%s, %s::integer, %s::integer)')
+
+        migrated += len(rows)
+        last_id = rows[-1][0]
+        # Memoria acotada: si se repite un contenido ya olvidado, _store lo encuentra por su huella
+        if len(payload_ids) > BATCH_SIZE:
+            payload_ids.clear()
+
+    for column in columns:
+        cr.execute('ALTER TABLE account_move DROP COLUMN %s' % column)
+    _logger.info("Contenidos VeriFactu de %s facturas movidos a verifactu.payload", migrated)
@@ -1,6 +1,8 @@
 from . import account_move_extension
+from . import verifactu_payload
 from . import verifactu_hash
 from . import verifactu_qr
+from . import verifactu_tax_breakdown
 from . import verifactu_xml_generation
 from . import verifactu_aeat_integration
 from . import verifactu_status_views
@@ -9,4 +11,13 @@ from . import verifactu_signature_model
 from . import res_config_settings
 from . import verifactu_json
 from . import res_company_extension
-from . import verifactu_status_wizard
\ No newline at end of file
+from . import verifactu_status_wizard
+from . import verifactu_submission
+from . import verifactu_chain
+from . import verifactu_chain_verifier
+from . import verifactu_pdf_cache
+from . import ir_actions_report
+from . import verifactu_artifact
+from . import verifactu_export_wizard
+from . import verifactu_response_line
+from . import verifactu_circuit
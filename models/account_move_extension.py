@@ -6,11 +6,16 @@ class AccountMoveExtension(models.Model):
 
     # Campos específicos para la integración con VeriFactu
     verifactu_hash = fields.Char("Hash VeriFactu", readonly=True, copy=False)
-    verifactu_qr = fields.Binary("QR VeriFactu", readonly=True)
+    verifactu_prev_hash = fields.Char("Huella del registro anterior", readonly=True, copy=False)
+    verifactu_gen_datetime = fields.Char("Fecha de generación del registro", readonly=True, copy=False,
+                                         help="FechaHoraHusoGenRegistro usada en la huella y en el XML")
+    verifactu_qr = fields.Binary("QR VeriFactu", compute='_compute_verifactu_qr', attachment=False,
+                                 help="QR en SVG, calculado al imprimir o mostrar la factura")
     verifactu_sent = fields.Boolean("Enviado a AEAT", default=False, readonly=True)
     verifactu_sent_date = fields.Datetime("Fecha envío AEAT", readonly=True)
     verifactu_csv = fields.Char("CSV (Código Seguro de Verificación)", readonly=True)
-    verifactu_response = fields.Text("Respuesta AEAT", readonly=True)
+    verifactu_response = fields.Text("Respuesta AEAT", readonly=True, compute='_compute_verifactu_response',
+                                     inverse='_inverse_verifactu_response')
     verifactu_state = fields.Selection([
         ('draft', 'Borrador'),
         ('sent', 'Enviado'),
@@ -21,7 +26,12 @@ class AccountMoveExtension(models.Model):
     ], string="Estado VeriFactu", default='draft', readonly=True)
     verifactu_subsanacion = fields.Boolean("Es subsanación", default=False)
     verifactu_rechazo_previo = fields.Boolean("Rechazo previo", default=False)
-    verifactu_xml = fields.Text("XML enviado", readonly=True)
+    verifactu_xml = fields.Text("XML enviado", readonly=True, compute='_compute_verifactu_xml',
+                                inverse='_inverse_verifactu_xml')
+    verifactu_chain_seq = fields.Integer("Posición en la cadena VeriFactu", readonly=True, copy=False)
+    verifactu_chain_prev_id = fields.Many2one('account.move', string="Registro anterior VeriFactu", readonly=True, copy=False)
+    verifactu_send_uncertain = fields.Boolean("Envío sin respuesta de la AEAT", readonly=True, copy=False,
+                                              help="El último envío agotó el tiempo de lectura: la AEAT pudo registrarlo")
     verifactu_signature_ids = fields.One2many('verifactu.signature', 'move_id', string="Firmas Electrónicas")
     verifactu_signature_id = fields.One2many(
         'verifactu.signature',
@@ -29,4 +39,9 @@ class AccountMoveExtension(models.Model):
         string='Firma VeriFactu',
         readonly=True
     )
+
+    # Índice único: /verifactu/scan busca la factura por su hash
+    _sql_constraints = [
+        ('verifactu_hash_uniq', 'unique(verifactu_hash)', 'Ya existe una factura con este hash VeriFactu.'),
+    ]
     
@@ -20,8 +20,9 @@ class AccountMove(models.Model):
             if self.move_type not in ('out_invoice', 'out_refund'):
                 raise UserError("Solo se pueden generar XML para facturas de cliente y notas de crédito.")
             
-            # Genera el xml y si no puede generarlo lanza una excepción
-            xml_content = self._generate_verifactu_xml()
+            # Genera el xml (o reutiliza el ya firmado) y si no puede generarlo lanza una excepción.
+            # La ruta de descarga sirve después el mismo documento guardado sin volver a firmarlo.
+            xml_content = self._get_verifactu_signed_xml()
             if not xml_content:
                 raise UserError("No se pudo generar el contenido XML. Verifique los datos del documento.")
                 
@@ -0,0 +1,21 @@
+from odoo import models, api, tools
+
+
+class IrActionsReport(models.Model):
+    _inherit = 'ir.actions.report'
+
+    @api.model
+    @tools.ormcache('report_names')
+    def _get_verifactu_invoice_report_id(self, report_names):
+        """
+        Devuelve el id del primer reporte de ``report_names`` que existe en la
+        base de datos, o False. El resultado se guarda en la caché del registro
+        (por base de datos), que Odoo vacía al crear, modificar o borrar
+        acciones; se guarda el id y no el recordset para no retener un
+        entorno ni un cursor de otra petición.
+        """
+        for report_name in report_names:
+            report = self.sudo().search([('report_name', '=', report_name)], limit=1)
+            if report:
+                return report.id
+        return False
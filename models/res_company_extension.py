@@ -1,8 +1,37 @@
 from odoo import models, fields
 
+from .verifactu_aeat_integration import drop_aeat_sessions
+from .verifactu_signature_model import credentials_fingerprint, drop_cached_signers
+from .verifactu_xml_generation import drop_verifactu_skeletons
+
+# Campos de credenciales: al modificarlos se invalidan las cachés por empresa
+VERIFACTU_CREDENTIAL_FIELDS = ('verifactu_cert_pem', 'verifactu_key_pem', 'verifactu_key_password')
+
 class ResCompany(models.Model):
     _inherit = 'res.company'
 
     verifactu_cert_pem = fields.Text("Certificado X.509 (PEM)", help="Certificado público en formato PEM para firmar XML")
     verifactu_key_pem = fields.Text("Clave Privada (PEM)", help="Clave privada en formato PEM para firmar XML")
     verifactu_key_password = fields.Char("Contraseña de Clave", help="Contraseña de la clave privada, si la tiene")
+    verifactu_next_send_at = fields.Datetime("Próximo envío AEAT permitido", compute='_compute_verifactu_next_send_at',
+                                             help="Hasta esta hora la cola acumula registros salvo que se complete un lote")
+
+    # Se guarda en la cabeza de la cadena para no modificar la empresa en cada envío
+    def _compute_verifactu_next_send_at(self):
+        heads = self.env['verifactu.chain'].sudo().search([('company_id', 'in', self.ids)])
+        for company in self:
+            dates = [d for d in heads.filtered(lambda h: h.company_id == company).mapped('next_send_at') if d]
+            company.verifactu_next_send_at = max(dates) if dates else False
+
+    # Huella de las credenciales; permite detectar en cualquier worker que han cambiado
+    def _verifactu_credentials_fingerprint(self):
+        self.ensure_one()
+        return credentials_fingerprint(self.verifactu_cert_pem, self.verifactu_key_pem, self.verifactu_key_password)
+
+    def write(self, vals):
+        res = super().write(vals)
+        drop_verifactu_skeletons(self.env.cr.dbname, self.ids)
+        if any(field in vals for field in VERIFACTU_CREDENTIAL_FIELDS):
+            drop_aeat_sessions(self.env.cr.dbname, self.ids)
+            drop_cached_signers(self.env.cr.dbname, self.ids)
+        return res
@@ -12,6 +12,17 @@ class ResConfigSettings(models.TransientModel):
         string="Archivo XSD VeriFactu",
         help="Sube aquí el archivo XSD que se usará para validar los XML antes de enviarlos a la AEAT."
     )
+    verifactu_endpoint_url = fields.Char(
+        string="URL del servicio VeriFactu",
+        config_parameter='verifactu.endpoint_url',
+        help="Sustituye el endpoint de la AEAT (p. ej. por el simulador local scripts/aeat_stub_server.py). "
+             "Vacío: se usa el entorno de pruebas o el de producción de la AEAT."
+    )
+    verifactu_endpoint_ca_file = fields.Char(
+        string="CA del servicio VeriFactu",
+        config_parameter='verifactu.endpoint_ca_file',
+        help="Ruta del certificado de la CA con la que se verifica el servidor de la URL anterior."
+    )
 
     @api.model
     def get_values(self):
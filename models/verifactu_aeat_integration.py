@@ -2,18 +2,162 @@ import requests
 import xml.etree.ElementTree as ET
 import tempfile
 import os
+import ssl
+import threading
+from requests.adapters import HTTPAdapter
 from odoo import models, fields, _
 from odoo.exceptions import UserError
 
+from .verifactu_metrics import timed_stage
+
+# Sesiones HTTPS con mTLS reutilizables por (base de datos, empresa) dentro del
+# proceso. Cada entrada guarda la huella de las credenciales con las que se
+# construyó: si otro worker cambia el certificado, la huella deja de coincidir
+# y la sesión se reconstruye.
+_AEAT_SESSIONS = {}
+_AEAT_SESSIONS_LOCK = threading.Lock()
+
+# Timeouts (segundos) de conexión y de lectura de las peticiones a la AEAT
+AEAT_CONNECT_TIMEOUT = 5
+AEAT_READ_TIMEOUT = 30
+
+# Endpoints oficiales; ``verifactu.endpoint_url`` permite apuntar a otro servidor
+# (p. ej. el simulador scripts/aeat_stub_server.py para pruebas sin red)
+AEAT_TEST_URL = 'https://prewww1.aeat.es/wbWTINE-CONT/swi/SistemaFacturacion/VerifactuSOAP'
+AEAT_PROD_URL = 'https://www1.agenciatributaria.gob.es/wbWTINE-CONT/swi/SistemaFacturacion/VerifactuSOAP'
+
+# Espacio de nombres de la RespuestaSuministro, en notación {uri} de ElementTree
+RESP_NS = '{https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/RespuestaSuministro.xsd}'
+
+
+class _SSLContextAdapter(HTTPAdapter):
+    """Adaptador de requests que usa un ``ssl.SSLContext`` ya cargado."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self._ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self._ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _load_cert_chain_in_memory(context, cert_pem, key_pem, key_password=None):
+    """
+    Carga certificado y clave en el contexto SSL sin dejarlos en disco.
+    ``ssl`` solo acepta rutas, así que en Linux se usan ficheros anónimos en
+    memoria (memfd); en otros sistemas se recurre a un temporal que se borra
+    siempre, incluso si la carga falla.
+    """
+    if hasattr(os, 'memfd_create'):
+        cert_fd = os.memfd_create('verifactu_cert')
+        key_fd = os.memfd_create('verifactu_key')
+        try:
+            _write_all(cert_fd, cert_pem.encode())
+            _write_all(key_fd, key_pem.encode())
+            context.load_cert_chain(
+                '/proc/self/fd/%d' % cert_fd,
+                '/proc/self/fd/%d' % key_fd,
+                password=key_password or None,
+            )
+        finally:
+            os.close(cert_fd)
+            os.close(key_fd)
+        return
+
+    with tempfile.NamedTemporaryFile(mode='w+', suffix='.pem', delete=False) as pem_file:
+        pem_path = pem_file.name
+    try:
+        os.chmod(pem_path, 0o600)
+        with open(pem_path, 'w') as pem_file:
+            pem_file.write(cert_pem)
+            pem_file.write('\n')
+            pem_file.write(key_pem)
+        context.load_cert_chain(pem_path, password=key_password or None)
+    finally:
+        os.unlink(pem_path)
+
+
+def _build_aeat_session(cert_pem, key_pem, key_password=None, ca_file=None):
+    # Con ``ca_file`` solo se confía en esa CA (certificado de servidor propio del simulador)
+    context = ssl.create_default_context(cafile=ca_file or None)
+    _load_cert_chain_in_memory(context, cert_pem, key_pem, key_password)
+    session = requests.Session()
+    session.mount('https://', _SSLContextAdapter(context, pool_connections=1, pool_maxsize=4))
+    return session
+
+
+def get_aeat_session(company, ca_file=None):
+    """Devuelve la sesión HTTPS con keep-alive de la empresa para este worker."""
+    key = (company.env.cr.dbname, company.id)
+    fingerprint = (company._verifactu_credentials_fingerprint(), ca_file or '')
+    with _AEAT_SESSIONS_LOCK:
+        entry = _AEAT_SESSIONS.get(key)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+    session = _build_aeat_session(
+        company.verifactu_cert_pem,
+        company.verifactu_key_pem,
+        company.verifactu_key_password,
+        ca_file,
+    )
+    with _AEAT_SESSIONS_LOCK:
+        old = _AEAT_SESSIONS.get(key)
+        _AEAT_SESSIONS[key] = (fingerprint, session)
+    if old:
+        old[1].close()
+    return session
+
+
+def drop_aeat_sessions(dbname, company_ids):
+    """Cierra las sesiones de las empresas indicadas (p. ej. al cambiar el certificado)."""
+    with _AEAT_SESSIONS_LOCK:
+        dropped = [_AEAT_SESSIONS.pop((dbname, company_id), None) for company_id in company_ids]
+    for entry in dropped:
+        if entry:
+            entry[1].close()
+
+
+def _parse_soap_fault(body):
+    """Texto del faultstring si ``body`` es un SOAP Fault; None en otro caso."""
+    try:
+        root = ET.fromstring(body.encode('utf-8') if isinstance(body, str) else body)
+    except ET.ParseError:
+        return None
+    fault = root.find('.//{*}Fault')
+    if fault is None:
+        return None
+    faultstring = fault.find('faultstring')
+    return (faultstring.text if faultstring is not None else None) or 'SOAP Fault'
+
 
 class VeriFactuAEATIntegration(models.Model):
     _inherit = 'account.move'
 
+    # URL del servicio y CA con la que se verifica el servidor (None: CAs del sistema)
+    def _get_aeat_endpoint(self):
+        config = self.env['ir.config_parameter'].sudo()
+        url = config.get_param('verifactu.endpoint_url')
+        if url:
+            return url, config.get_param('verifactu.endpoint_ca_file') or None
+        test_mode = config.get_param('verifactu.test_mode', default=True)
+        return (AEAT_TEST_URL if test_mode else AEAT_PROD_URL), None
+
     def _send_to_aeat(self, xml_data):
         company = self.env.company
         cert_pem = company.verifactu_cert_pem
         key_pem = company.verifactu_key_pem
-        key_password = company.verifactu_key_password
 
         # Validación para el certificado y la clave
         if not cert_pem or not key_pem:
@@ -23,65 +167,96 @@ class VeriFactuAEATIntegration(models.Model):
                 'status_code': 400
             }
 
-        # Crear archivos temporales para certificado y clave
-        try:
-            with tempfile.NamedTemporaryFile(mode='w+', suffix='.pem', delete=False) as cert_file:
-                cert_file.write(cert_pem)
-                cert_file.flush()
-                cert_path = cert_file.name
-
-            with tempfile.NamedTemporaryFile(mode='w+', suffix='.pem', delete=False) as key_file:
-                key_file.write(key_pem)
-                key_file.flush()
-                key_path = key_file.name
+        wsdl_url, ca_file = self._get_aeat_endpoint()
 
-            config = self.env['ir.config_parameter'].sudo()
-            test_mode = config.get_param('verifactu.test_mode', default=True)
+        # Con el endpoint caído no se espera al timeout: se falla de inmediato y se reintenta más tarde
+        circuit = self.env['verifactu.circuit'].sudo()
+        if not circuit._allow_request(wsdl_url):
+            return {
+                'success': False,
+                'error': _('La AEAT no está disponible en este momento. El envío se reintentará automáticamente.'),
+                'status_code': 503,
+                'retry': True,
+                'circuit_open': True,
+            }
 
-            wsdl_url = 'https://prewww1.aeat.es/wbWTINE-CONT/swi/SistemaFacturacion/VerifactuSOAP'  if test_mode else 'https://www1.agenciatributaria.gob.es/wbWTINE-CONT/swi/SistemaFacturacion/VerifactuSOAP' 
+        try:
+            session = get_aeat_session(company, ca_file)
 
             headers = {
                 'Content-Type': 'text/xml; charset=utf-8',
                 'SOAPAction': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/RegFactuSistemaFacturacion' 
             }
 
-            # Enviar solicitud con certificado y clave temporales
-            response = requests.post(
+            # Enviar solicitud por la sesión mTLS reutilizada (sin nuevo handshake)
+            response = session.post(
                 wsdl_url,
-                data=xml_data,
+                data=xml_data.encode('utf-8') if isinstance(xml_data, str) else xml_data,
                 headers=headers,
-                cert=(cert_path, key_path),
-                timeout=30
+                timeout=(AEAT_CONNECT_TIMEOUT, AEAT_READ_TIMEOUT)
             )
 
-            # Limpiar archivos temporales
-            os.unlink(cert_path)
-            os.unlink(key_path)
-
             if response.status_code == 403:
+                circuit._record_success(wsdl_url)
                 return {
                     'success': False,
                     'error': _('Error 403: No se detecta certificado válido o no se seleccionó correctamente.'),
                     'status_code': 403
                 }
 
+            # La AEAT devuelve los rechazos del mensaje (p. ej. de esquema) como
+            # SOAP Fault con HTTP 500: el endpoint funciona y reenviar no sirve
+            fault = _parse_soap_fault(response.content) if response.status_code >= 500 else None
+            if fault:
+                circuit._record_success(wsdl_url)
+                return {
+                    'success': False,
+                    'error': _('La AEAT rechazó el envío: %s') % fault,
+                    'status_code': response.status_code,
+                }
+
+            # Errores del servidor: cuentan como fallo del endpoint y se reintentan
+            if response.status_code >= 500:
+                error = _('La AEAT respondió con un error %s.') % response.status_code
+                circuit._record_failure(wsdl_url, error)
+                return {
+                    'success': False,
+                    'error': error,
+                    'status_code': response.status_code,
+                    'retry': True,
+                }
+
+            circuit._record_success(wsdl_url)
             return {
                 'success': True,
                 'response': response.text,
                 'status_code': response.status_code
             }
 
-        except requests.exceptions.SSLError as e:
+        except (requests.exceptions.SSLError, ssl.SSLError) as e:
             return {
                 'success': False,
                 'error': _('Error SSL: Certificado inválido o no reconocido.'),
                 'status_code': 403
             }
-        except requests.exceptions.ConnectionError:
+        except requests.exceptions.ReadTimeout as e:
+            # La petición llegó: la AEAT pudo registrar el lote. Se reintenta y la
+            # respuesta del reenvío se concilia (ver ``_apply_verifactu_result``)
+            circuit._record_failure(wsdl_url, str(e))
+            return {
+                'success': False,
+                'error': _('La AEAT no respondió a tiempo. El envío se reintentará y se conciliará con la respuesta.'),
+                'status_code': 504,
+                'retry': True,
+                'uncertain': True,
+            }
+        except requests.exceptions.ConnectionError as e:
+            circuit._record_failure(wsdl_url, str(e))
             return {
                 'success': False,
                 'error': _('No se pudo conectar con el servidor de la AEAT. Verifique su conexión a internet.'),
-                'status_code': 503
+                'status_code': 503,
+                'retry': True,
             }
         except Exception as e:
             return {
@@ -137,53 +312,76 @@ class VeriFactuAEATIntegration(models.Model):
     #             'status_code': 500
     #         }
 
+    @timed_stage('parse')
     def _parse_aeat_response(self, xml_response):
-            try:
-                root = ET.fromstring(xml_response)
-                namespaces = {
-                    'resp': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/RespuestaSuministro.xsd' 
-                }
-                
-                # Extraer información básica de la respuesta
-                estado_envio = root.find('.//resp:EstadoEnvio', namespaces)
-                csv = root.find('.//resp:CSV', namespaces)
-                errores = root.findall('.//resp:Error', namespaces)
-                
-                estado = estado_envio.text if estado_envio is not None else 'Error'
-                csv_text = csv.text if csv is not None else ''
-                
-                # Procesar errores si existen
-                error_messages = []
-                if errores:
-                    for error in errores:
-                        codigo = error.find('resp:Codigo', namespaces)
-                        descripcion = error.find('resp:Descripcion', namespaces)
-                        if codigo is not None and descripcion is not None:
-                            error_messages.append(
-                                f"Código de error: {codigo.text}. Descripción: {descripcion.text}"
-                            )
-                
-                result = {
-                    'estado': estado,
-                    'csv': csv_text,
-                    'errores': error_messages if error_messages else None
-                }
-                
-                # Si hay errores pero el estado no es Error, actualizamos el estado
-                if error_messages and estado != 'Error':
-                    result['estado'] = 'Error'
-                
-                return result
-                
-            except ET.ParseError as e:
-                return {
-                    'estado': 'Error',
-                    'csv': '',
-                    'errores': ['La respuesta recibida no es un XML válido. Por favor, contacte con soporte técnico.']
-                }
-            except Exception as e:
-                return {
-                    'estado': 'Error',
-                    'csv': '',
-                    'errores': [f'Ocurrió un error inesperado al procesar la respuesta: {str(e)}. Por favor, inténtelo de nuevo más tarde.']
-                }
\ No newline at end of file
+        """
+        Interpreta la RespuestaSuministro: estado del envío, CSV, tiempo de
+        espera, errores generales y el resultado de cada RespuestaLinea.
+        """
+        try:
+            if isinstance(xml_response, str):
+                xml_response = xml_response.encode('utf-8')
+            root = ET.fromstring(xml_response or b'')
+
+            estado_envio = root.find('.//%sEstadoEnvio' % RESP_NS)
+            csv = root.find('.//%sCSV' % RESP_NS)
+            # Segundos que hay que esperar antes del siguiente envío
+            tiempo_espera = root.find('.//%sTiempoEsperaEnvio' % RESP_NS)
+
+            estado = (estado_envio.text if estado_envio is not None else None) or 'Error'
+            csv_text = (csv.text if csv is not None else None) or ''
+
+            # Procesar errores si existen
+            error_messages = []
+            for error in root.iterfind('.//%sError' % RESP_NS):
+                codigo = error.find(RESP_NS + 'Codigo')
+                descripcion = error.find(RESP_NS + 'Descripcion')
+                if codigo is not None and descripcion is not None:
+                    error_messages.append(
+                        f"Código de error: {codigo.text}. Descripción: {descripcion.text}"
+                    )
+
+            # Resultado de cada registro (un envío por lotes devuelve varios)
+            lineas = []
+            for linea in root.iterfind('.//%sRespuestaLinea' % RESP_NS):
+                num_serie = linea.find('.//{*}NumSerieFactura')
+                estado_registro = linea.find(RESP_NS + 'EstadoRegistro')
+                codigo = linea.find(RESP_NS + 'CodigoErrorRegistro')
+                descripcion = linea.find(RESP_NS + 'DescripcionErrorRegistro')
+                lineas.append({
+                    'num_serie': num_serie.text if num_serie is not None else '',
+                    'estado': estado_registro.text if estado_registro is not None else 'Error',
+                    'codigo': codigo.text if codigo is not None else '',
+                    'descripcion': descripcion.text if descripcion is not None else '',
+                })
+
+            result = {
+                'estado': estado,
+                'csv': csv_text,
+                'tiempo_espera': int(tiempo_espera.text or 0) if tiempo_espera is not None else 0,
+                'errores': error_messages if error_messages else None,
+                'lineas': lineas,
+            }
+
+            # Si hay errores pero el estado no es Error, actualizamos el estado
+            if error_messages and estado != 'Error':
+                result['estado'] = 'Error'
+
+            return result
+
+        except ET.ParseError as e:
+            return {
+                'estado': 'Error',
+                'csv': '',
+                'errores': ['La respuesta recibida no es un XML válido. Por favor, contacte con soporte técnico.'],
+                'lineas': [],
+                'tiempo_espera': 0,
+            }
+        except Exception as e:
+            return {
+                'estado': 'Error',
+                'csv': '',
+                'errores': [f'Ocurrió un error inesperado al procesar la respuesta: {str(e)}. Por favor, inténtelo de nuevo más tarde.'],
+                'lineas': [],
+                'tiempo_espera': 0,
+            }
\ No newline at end of file
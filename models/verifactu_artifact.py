@@ -0,0 +1,65 @@
+from odoo import models
+import hashlib
+import json
+import logging
+
+from .verifactu_xml_generation import serialize_verifactu_xml
+
+_logger = logging.getLogger(__name__)
+
+
+class VeriFactuArtifact(models.Model):
+    _inherit = 'account.move'
+
+    # Huella de todo lo que interviene en el XML firmado de la factura
+    def _get_verifactu_artifact_fingerprint(self):
+        """
+        SHA-256 de los datos de la factura que aparecen en el RegistroAlta,
+        de la empresa (datos del skeleton y certificado) y del registro
+        anterior de la cadena. Si no cambia, el XML firmado tampoco.
+        Es una lectura: no crea la cabeza de la cadena.
+        """
+        self.ensure_one()
+        company = self.company_id
+        breakdown = self._get_verifactu_tax_breakdown()
+        data = [
+            self._get_verifactu_skeleton(company).version,
+            company._verifactu_credentials_fingerprint(),
+            self.name,
+            str(self.invoice_date),
+            [line.name or '' for line in self.invoice_line_ids][:3],
+            self.partner_id.name or '',
+            self.partner_id.vat or '',
+            breakdown['rows'],
+            breakdown['base'],
+            self._get_verifactu_registro_anterior(create_head=False),
+            self.verifactu_gen_datetime or '',
+            self.verifactu_hash or '',
+            self.verifactu_subsanacion,
+        ]
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _get_verifactu_signed_xml(self):
+        """
+        XML firmado de la factura. Se reutiliza el último documento firmado
+        si la huella de sus datos no ha cambiado; si no, se genera, se firma
+        y se guarda en ``verifactu.payload`` junto a la firma de la factura.
+        Se usa también desde las descargas: nunca crea la cabeza de la cadena.
+        """
+        self.ensure_one()
+        fingerprint = self._get_verifactu_artifact_fingerprint()
+        Signature = self.env['verifactu.signature']
+
+        signature = Signature.search([('move_id', '=', self.id)], limit=1)
+        if signature.verifactu_artifact_fingerprint == fingerprint and signature.verifactu_artifact_payload_id:
+            _logger.debug("XML firmado de la factura %s reutilizado", self.name)
+            return signature.verifactu_artifact_payload_id._load()
+
+        xml_data = serialize_verifactu_xml(self._generate_verifactu_tree(create_head=False))
+        # La firma acaba de crear o actualizar la fila verifactu.signature de la factura
+        signature = Signature.search([('move_id', '=', self.id)], limit=1)
+        signature.write({
+            'verifactu_artifact_fingerprint': fingerprint,
+            'verifactu_artifact_payload_id': self.env['verifactu.payload'].sudo()._store(xml_data).id,
+        })
+        return xml_data
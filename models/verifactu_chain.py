@@ -0,0 +1,127 @@
+from odoo import models, fields, api
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class VeriFactuChain(models.Model):
+    _name = 'verifactu.chain'
+    _description = 'Cabeza de la cadena de registros VeriFactu'
+    _rec_name = 'company_id'
+
+    company_id = fields.Many2one('res.company', string='Empresa', required=True, ondelete='cascade', index=True)
+    installation = fields.Char("Número de instalación", required=True)
+    sequence = fields.Integer("Registros encadenados", default=0, readonly=True)
+    last_move_id = fields.Many2one('account.move', string='Último registro', readonly=True, ondelete='set null')
+    last_nif = fields.Char("NIF emisor", readonly=True)
+    last_number = fields.Char("Número de serie", readonly=True)
+    last_date = fields.Date("Fecha de expedición", readonly=True)
+    last_hash = fields.Char("Huella", readonly=True)
+    next_send_at = fields.Datetime("Próximo envío permitido", readonly=True,
+                                   help="Fin del TiempoEsperaEnvio indicado por la AEAT en el último envío. "
+                                        "Antes de esa hora solo se envían lotes completos.")
+
+    _sql_constraints = [
+        ('company_installation_uniq', 'unique(company_id, installation)',
+         'Solo puede haber una cadena VeriFactu por empresa e instalación.'),
+    ]
+
+    @api.model
+    def _get_head(self, company, installation=None, lock=False, create=True):
+        """
+        Devuelve la cabeza de la cadena de la empresa, creándola si no existe.
+        Con ``lock=True`` la fila queda bloqueada (FOR UPDATE) hasta el final
+        de la transacción, de modo que dos workers no pueden encadenar al
+        mismo registro anterior. Con ``create=False`` (lecturas como la
+        exportación) devuelve un recordset vacío si la cabeza no existe.
+        """
+        installation = installation or str(company.id)
+        query = """
+            SELECT id
+              FROM verifactu_chain
+             WHERE company_id = %s AND installation = %s
+        """ + (" FOR UPDATE" if lock else "")
+        self.env.cr.execute(query, (company.id, installation))
+        row = self.env.cr.fetchone()
+
+        if not row and not create:
+            return self.browse()
+
+        created = False
+        if not row:
+            # ON CONFLICT: otro worker puede estar creando la misma cabeza a la vez
+            self.env.cr.execute("""
+                INSERT INTO verifactu_chain (company_id, installation, sequence,
+                                             create_uid, create_date, write_uid, write_date)
+                     VALUES (%s, %s, 0, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (company_id, installation) DO NOTHING
+                  RETURNING id
+            """, (company.id, installation, self.env.uid, self.env.uid))
+            created = bool(self.env.cr.fetchone())
+            self.env.cr.execute(query, (company.id, installation))
+            row = self.env.cr.fetchone()
+
+        head = self.browse(row[0])
+        # La fila puede haber cambiado en otra transacción mientras esperábamos el bloqueo
+        head.invalidate_recordset()
+
+        if created:
+            head._seed_from_history()
+        return head
+
+    @api.model
+    def _find_last_registered(self, company):
+        """Último envío de la empresa registrado por la AEAT, según el historial de facturas."""
+        return self.env['account.move'].search([
+            ('company_id', '=', company.id),
+            ('verifactu_sent', '=', True),
+            ('verifactu_state', 'in', ('accepted', 'partially_accepted')),
+        ], order='verifactu_sent_date desc, id desc', limit=1)
+
+    def _seed_from_history(self):
+        """
+        Inicializa una cabeza nueva con el último envío registrado antes de
+        existir este modelo, para no romper la cadena en instalaciones previas.
+        """
+        self.ensure_one()
+        last_invoice = self._find_last_registered(self.company_id)
+        if last_invoice:
+            self.write({
+                'last_move_id': last_invoice.id,
+                'last_nif': last_invoice._clean_vat(self.company_id.vat),
+                'last_number': last_invoice.name,
+                'last_date': last_invoice.invoice_date,
+                'last_hash': last_invoice.verifactu_hash,
+            })
+            _logger.info("Cadena VeriFactu de %s inicializada con la factura %s", self.company_id.name, last_invoice.name)
+
+    def _advance(self, moves):
+        """
+        Avanza la cabeza de la cadena con las facturas indicadas, en orden.
+        Cada factura guarda su posición y su registro anterior.
+        """
+        self.ensure_one()
+        if not moves:
+            return
+        sequence = self.sequence
+        previous = self.last_move_id
+        for move in moves:
+            sequence += 1
+            move.write({
+                'verifactu_chain_seq': sequence,
+                'verifactu_chain_prev_id': previous.id,
+            })
+            previous = move
+        self.write({
+            'sequence': sequence,
+            'last_move_id': previous.id,
+            'last_nif': previous._clean_vat(self.company_id.vat),
+            'last_number': previous.name,
+            'last_date': previous.invoice_date,
+            'last_hash': previous.verifactu_hash,
+        })
+
+    # Recalcula las huellas registradas de cada empresa (ver ``_verifactu_backfill_hashes``)
+    def action_backfill_hashes(self):
+        for company in self.company_id:
+            self.env['account.move']._verifactu_backfill_hashes(company)
@@ -0,0 +1,201 @@
+from odoo import models, fields
+import logging
+import time
+
+from .verifactu_hash import verifactu_huella
+from .verifactu_tax_breakdown import format_cents, read_verifactu_amounts
+
+_logger = logging.getLogger(__name__)
+
+# Máximo de incidencias de cada tipo que se guardan en el informe
+VERIFACTU_VERIFY_MAX_ISSUES = 100
+
+
+def _verify_row(report, divergence, nif, amounts, previous, row):
+    """Comprueba un registro contra el anterior y recalcula su huella. Devuelve ``row``."""
+    (move_id, sequence, prev_id, number, invoice_date, stored_hash, prev_hash, gen_datetime) = row
+    report['checked'] += 1
+
+    if previous:
+        if sequence != previous[1] + 1 and len(report['gaps']) < VERIFACTU_VERIFY_MAX_ISSUES:
+            report['gaps'].append((previous[1], sequence))
+        if prev_id != previous[0]:
+            divergence(row, "El registro anterior no es la factura %s" % previous[3])
+        elif (prev_hash or '') != (previous[5] or ''):
+            divergence(row, "La huella anterior no coincide con la de %s" % previous[3])
+
+    if not gen_datetime or not invoice_date:
+        divergence(row, "Faltan datos para recalcular la huella")
+    else:
+        cuota, importe_total = amounts[move_id]
+        huella = verifactu_huella(
+            nif,
+            number,
+            invoice_date.strftime('%d-%m-%Y'),
+            'F1',
+            format_cents(cuota),
+            format_cents(importe_total),
+            prev_hash,
+            gen_datetime,
+        )
+        if huella != stored_hash:
+            divergence(row, "La huella guardada no coincide con la recalculada")
+    return row
+
+
+def verify_verifactu_chain(env, company, batch_size=5000, echo=False):
+    """
+    Recorre la cadena de registros de una empresa y comprueba su integridad:
+    recalcula cada huella (con los mismos importes que la huella en vivo,
+    ver ``read_verifactu_amounts``), comprueba que enlaza con la del
+    registro anterior y detecta saltos de secuencia y predecesores duplicados.
+
+    Las facturas se leen con un cursor de servidor (con nombre) en lotes de
+    ``batch_size``, así que la memoria usada no depende del tamaño de la
+    cadena. Pensada también para ``odoo-bin shell``::
+
+        >>> from odoo.addons.l10n_es_verifactu.models.verifactu_chain_verifier import verify_verifactu_chain
+        >>> verify_verifactu_chain(env, env.company, echo=True)
+
+    Devuelve un diccionario con el resultado.
+    """
+    start = time.monotonic()
+    env.flush_all()
+    nif = env['account.move']._get_verifactu_skeleton(company).nif
+
+    report = {
+        'company': company.name,
+        'checked': 0,
+        'ok': True,
+        'first_divergence': None,
+        'divergences': 0,
+        'gaps': [],
+        'duplicate_predecessors': [],
+        'unchained': 0,
+        'elapsed': 0.0,
+        'rate': 0.0,
+    }
+
+    def divergence(row, reason):
+        report['divergences'] += 1
+        if not report['first_divergence']:
+            report['first_divergence'] = {
+                'move_id': row[0],
+                'sequence': row[1],
+                'number': row[3],
+                'reason': reason,
+            }
+
+    # Cursor de servidor sobre la misma conexión para ver los datos de la transacción
+    cursor = env.cr._cnx.cursor(name='verifactu_chain_verify')
+    cursor.itersize = batch_size
+    try:
+        cursor.execute("""
+            SELECT id, verifactu_chain_seq, verifactu_chain_prev_id, name, invoice_date,
+                   verifactu_hash, verifactu_prev_hash, verifactu_gen_datetime
+              FROM account_move
+             WHERE company_id = %s AND verifactu_chain_seq IS NOT NULL
+          ORDER BY verifactu_chain_seq, id
+        """, (company.id,))
+
+        previous = None
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            amounts = read_verifactu_amounts(env.cr, [row[0] for row in rows])
+            for row in rows:
+                previous = _verify_row(report, divergence, nif, amounts, previous, row)
+            _logger.info("Verificación cadena VeriFactu %s: %s registros", company.name, report['checked'])
+    finally:
+        cursor.close()
+
+    env.cr.execute("""
+        SELECT verifactu_chain_prev_id, count(*)
+          FROM account_move
+         WHERE company_id = %s AND verifactu_chain_prev_id IS NOT NULL
+      GROUP BY verifactu_chain_prev_id
+        HAVING count(*) > 1
+         LIMIT %s
+    """, (company.id, VERIFACTU_VERIFY_MAX_ISSUES))
+    report['duplicate_predecessors'] = env.cr.fetchall()
+
+    # Facturas registradas en la AEAT que no ocupan ninguna posición en la cadena
+    env.cr.execute("""
+        SELECT count(*)
+          FROM account_move
+         WHERE company_id = %s AND verifactu_sent
+           AND verifactu_state IN ('accepted', 'partially_accepted')
+           AND verifactu_chain_seq IS NULL
+    """, (company.id,))
+    report['unchained'] = env.cr.fetchone()[0]
+
+    elapsed = time.monotonic() - start
+    report['elapsed'] = elapsed
+    report['rate'] = report['checked'] / elapsed if elapsed else 0.0
+    report['ok'] = not (report['divergences'] or report['gaps']
+                        or report['duplicate_predecessors'] or report['unchained'])
+
+    _logger.info(
+        "Cadena VeriFactu de %s verificada: %s registros en %.2fs (%.0f/s), %s",
+        company.name, report['checked'], elapsed, report['rate'],
+        "correcta" if report['ok'] else "con incidencias",
+    )
+    if echo:
+        print(format_chain_report(report))
+    return report
+
+
+def format_chain_report(report):
+    """Texto legible del resultado de ``verify_verifactu_chain``."""
+    lines = [
+        "Empresa: %s" % report['company'],
+        "Registros comprobados: %s" % report['checked'],
+        "Tiempo: %.2fs (%.0f registros/s)" % (report['elapsed'], report['rate']),
+        "Resultado: %s" % ("cadena correcta" if report['ok'] else "cadena con incidencias"),
+    ]
+    first = report['first_divergence']
+    if first:
+        lines.append("Primera divergencia: %s (posición %s, id %s): %s" % (
+            first['number'], first['sequence'], first['move_id'], first['reason']))
+        lines.append("Registros con divergencias: %s" % report['divergences'])
+    for before, after in report['gaps']:
+        lines.append("Salto de secuencia: de %s a %s" % (before, after))
+    for prev_id, count in report['duplicate_predecessors']:
+        lines.append("Predecesor duplicado: la factura id %s es el registro anterior de %s registros" % (prev_id, count))
+    if report['unchained']:
+        lines.append("Facturas registradas fuera de la cadena: %s" % report['unchained'])
+    return "\n".join(lines)
+
+
+class VerifactuChainVerifyWizard(models.TransientModel):
+    _name = 'verifactu.chain.verify.wizard'
+    _description = 'Verificación de la cadena VeriFactu'
+
+    company_id = fields.Many2one('res.company', string='Empresa', required=True,
+                                 default=lambda self: self.env.company)
+    state = fields.Selection([
+        ('draft', 'Pendiente'),
+        ('ok', 'Correcta'),
+        ('error', 'Con incidencias')
+    ], string="Resultado", default='draft', readonly=True)
+    checked = fields.Integer("Registros comprobados", readonly=True)
+    rate = fields.Float("Registros por segundo", readonly=True)
+    result = fields.Text("Informe", readonly=True)
+
+    def action_verify(self):
+        self.ensure_one()
+        report = verify_verifactu_chain(self.env, self.company_id)
+        self.write({
+            'state': 'ok' if report['ok'] else 'error',
+            'checked': report['checked'],
+            'rate': report['rate'],
+            'result': format_chain_report(report),
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
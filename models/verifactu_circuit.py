@@ -0,0 +1,119 @@
+from odoo import models, fields, api
+from datetime import timedelta
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Fallos consecutivos que abren el circuito
+CIRCUIT_FAILURE_THRESHOLD = 5
+# Segundos que el circuito permanece abierto antes de dejar pasar una prueba
+CIRCUIT_OPEN_SECONDS = 60
+# Segundos que se reserva la única petición de prueba (por si su worker muere)
+CIRCUIT_PROBE_SECONDS = 60
+
+
+class VeriFactuCircuit(models.Model):
+    """
+    Circuit breaker compartido por todos los workers para cada endpoint de
+    la AEAT. El estado se lee y se actualiza con un cursor propio que hace
+    commit enseguida, de modo que es visible para el resto de workers
+    aunque la transacción del envío termine en rollback.
+    """
+    _name = 'verifactu.circuit'
+    _description = 'Estado del endpoint AEAT'
+    _rec_name = 'endpoint'
+
+    endpoint = fields.Char("Endpoint", required=True, readonly=True)
+    state = fields.Selection([
+        ('closed', 'Cerrado'),
+        ('open', 'Abierto'),
+        ('half_open', 'Probando')
+    ], string="Estado", default='closed', required=True, readonly=True)
+    failures = fields.Integer("Fallos consecutivos", readonly=True)
+    opened_at = fields.Datetime("Abierto desde", readonly=True)
+    probe_until = fields.Datetime("Prueba en curso hasta", readonly=True)
+    last_error = fields.Char("Último error", readonly=True)
+
+    _sql_constraints = [
+        ('endpoint_uniq', 'unique(endpoint)', 'Solo puede haber un circuito por endpoint.'),
+    ]
+
+    @api.model
+    def _lock_circuit(self, endpoint):
+        """Fila del endpoint bloqueada (FOR UPDATE), creándola si no existe."""
+        self.env.cr.execute("""
+            INSERT INTO verifactu_circuit (endpoint, state, failures,
+                                           create_uid, create_date, write_uid, write_date)
+                 VALUES (%s, 'closed', 0, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (endpoint) DO NOTHING
+        """, (endpoint, self.env.uid, self.env.uid))
+        self.env.cr.execute("SELECT id FROM verifactu_circuit WHERE endpoint = %s FOR UPDATE", (endpoint,))
+        circuit = self.browse(self.env.cr.fetchone()[0])
+        circuit.invalidate_recordset()
+        return circuit
+
+    @api.model
+    def _allow_request(self, endpoint):
+        """
+        Indica si se puede llamar al endpoint. Con el circuito abierto se
+        falla de inmediato; pasado CIRCUIT_OPEN_SECONDS solo un worker obtiene
+        permiso para una petición de prueba.
+        """
+        with self.env.registry.cursor() as cr:
+            circuit = self.with_env(self.env(cr=cr))._lock_circuit(endpoint)
+            now = fields.Datetime.now()
+            if circuit.state == 'closed':
+                return True
+            if circuit.state == 'open' and circuit.opened_at + timedelta(seconds=CIRCUIT_OPEN_SECONDS) > now:
+                return False
+            if circuit.state == 'half_open' and circuit.probe_until and circuit.probe_until > now:
+                return False
+            circuit.write({
+                'state': 'half_open',
+                'probe_until': now + timedelta(seconds=CIRCUIT_PROBE_SECONDS),
+            })
+            _logger.info("Circuito AEAT %s: enviando petición de prueba", endpoint)
+            return True
+
+    @api.model
+    def _record_success(self, endpoint):
+        with self.env.registry.cursor() as cr:
+            circuit = self.with_env(self.env(cr=cr))._lock_circuit(endpoint)
+            if circuit.state == 'closed' and not circuit.failures:
+                return
+            recovered = circuit.state != 'closed'
+            circuit.write({
+                'state': 'closed',
+                'failures': 0,
+                'opened_at': False,
+                'probe_until': False,
+                'last_error': False,
+            })
+            if recovered:
+                _logger.info("Circuito AEAT %s cerrado: el endpoint vuelve a responder", endpoint)
+                circuit.env['verifactu.submission']._replay_backlog()
+
+    @api.model
+    def _record_failure(self, endpoint, error):
+        with self.env.registry.cursor() as cr:
+            circuit = self.with_env(self.env(cr=cr))._lock_circuit(endpoint)
+            failures = circuit.failures + 1
+            vals = {'failures': failures, 'last_error': (error or '')[:250]}
+            if circuit.state == 'half_open' or failures >= CIRCUIT_FAILURE_THRESHOLD:
+                vals.update({
+                    'state': 'open',
+                    'opened_at': fields.Datetime.now(),
+                    'probe_until': False,
+                })
+                if circuit.state != 'open':
+                    _logger.warning("Circuito AEAT %s abierto tras %s fallos: %s", endpoint, failures, error)
+            circuit.write(vals)
+
+    def action_reset(self):
+        self.write({
+            'state': 'closed',
+            'failures': 0,
+            'opened_at': False,
+            'probe_until': False,
+        })
+        self.env['verifactu.submission']._replay_backlog()
@@ -0,0 +1,58 @@
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+from odoo.tools.safe_eval import safe_eval
+
+
+class VerifactuExportWizard(models.TransientModel):
+    _name = 'verifactu.export.wizard'
+    _description = 'Exportación VeriFactu'
+
+    company_id = fields.Many2one('res.company', string='Empresa', required=True,
+                                 default=lambda self: self.env.company)
+    date_from = fields.Date("Desde")
+    date_to = fields.Date("Hasta")
+    export_format = fields.Selection([
+        ('jsonl', 'JSON Lines (RegistroAlta)'),
+        ('zip', 'ZIP con el XML firmado de cada factura')
+    ], string="Formato", default='jsonl', required=True)
+    only_sent = fields.Boolean("Solo facturas enviadas a la AEAT", default=True)
+    domain = fields.Char("Filtro", default=lambda self: self._default_domain(),
+                         help="Filtro adicional de facturas (por ejemplo, la selección de la vista lista)")
+
+    @api.model
+    def _default_domain(self):
+        context = self.env.context
+        if context.get('active_model') != 'account.move':
+            return '[]'
+        if context.get('active_domain'):
+            return str(context['active_domain'])
+        if context.get('active_ids'):
+            return str([('id', 'in', context['active_ids'])])
+        return '[]'
+
+    # Dominio de las facturas a exportar
+    def _get_export_domain(self):
+        self.ensure_one()
+        domain = [
+            ('company_id', '=', self.company_id.id),
+            ('move_type', 'in', ('out_invoice', 'out_refund')),
+            ('state', '=', 'posted'),
+        ]
+        if self.date_from:
+            domain.append(('invoice_date', '>=', self.date_from))
+        if self.date_to:
+            domain.append(('invoice_date', '<=', self.date_to))
+        if self.only_sent:
+            domain.append(('verifactu_sent', '=', True))
+        return domain + safe_eval(self.domain or '[]')
+
+    def action_export(self):
+        self.ensure_one()
+        if self.date_from and self.date_to and self.date_from > self.date_to:
+            raise UserError("La fecha inicial no puede ser posterior a la final.")
+        # La descarga se genera por partes en /verifactu/export, sin crear adjuntos
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/verifactu/export/{self.id}',
+            'target': 'self',
+        }
@@ -1,5 +1,38 @@
 import hashlib
-from odoo import models, fields
+import logging
+import time
+from psycopg2.extras import execute_values
+from odoo import models, fields, api
+
+from .verifactu_tax_breakdown import format_cents, read_verifactu_amounts
+from .verifactu_metrics import timed_stage
+
+_logger = logging.getLogger(__name__)
+
+
+def verifactu_timestamp(dt):
+    """FechaHoraHusoGenRegistro: fecha y hora UTC con huso horario explícito."""
+    return dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def verifactu_huella(nif, number, date, tipo_factura, cuota_total, importe_total, prev_huella, gen_datetime):
+    """
+    Huella de un RegistroAlta según la especificación de la AEAT: SHA-256 en
+    hexadecimal (mayúsculas) de la concatenación campo=valor separada por '&',
+    incluida la huella del registro anterior (vacía en el primer registro).
+    """
+    data = (
+        f"IDEmisorFactura={nif.strip()}"
+        f"&NumSerieFactura={number.strip()}"
+        f"&FechaExpedicionFactura={date}"
+        f"&TipoFactura={tipo_factura}"
+        f"&CuotaTotal={cuota_total}"
+        f"&ImporteTotal={importe_total}"
+        f"&Huella={prev_huella or ''}"
+        f"&FechaHoraHusoGenRegistro={gen_datetime}"
+    )
+    return hashlib.sha256(data.encode('utf-8')).hexdigest().upper()
+
 
 class VeriFactuHash(models.Model):
     _inherit = 'account.move'
@@ -10,22 +43,130 @@ class VeriFactuHash(models.Model):
             return ''
         return ''.join(filter(str.isalnum, vat)).upper().lstrip('ES')
 
-    # Genera un hash único para la factura según especificaciones AEAT
+    # Huella de la factura con la huella anterior y la fecha de generación indicadas
+    def _compute_verifactu_huella(self, prev_huella, gen_datetime):
+        self.ensure_one()
+        breakdown = self._get_verifactu_tax_breakdown()
+        return verifactu_huella(
+            self._get_verifactu_skeleton(self.company_id).nif,
+            self.name,
+            self.invoice_date.strftime('%d-%m-%Y'),
+            'F1',
+            format_cents(breakdown['cuota']),
+            format_cents(breakdown['base'] + breakdown['cuota']),
+            prev_huella,
+            gen_datetime,
+        )
+
+    # Genera la huella encadenada de cada factura según especificaciones AEAT.
+    # Las facturas se encadenan en el orden del recordset: la primera con la
+    # cabeza de la cadena de la empresa y cada una de las siguientes con la anterior.
+    # Si el registro no ha cambiado desde la última vez (mismo anterior y mismos
+    # datos) se conserva su huella y su fecha de generación, de modo que un
+    # reenvío reutiliza el XML firmado guardado.
+    @timed_stage('hash')
     def _generate_verifactu_hash(self):
+        previous = {}
         for invoice in self:
-            name = invoice.name or 'NO-NUMBER'
-            date = invoice.invoice_date.strftime('%d-%m-%Y') if invoice.invoice_date else 'NO-DATE'
-            company_vat = self._clean_vat(invoice.company_id.vat) or 'NO-COMPANY-VAT'
-            partner_vat = self._clean_vat(invoice.partner_id.vat) or 'NO-PARTNER-VAT'
-            timestamp = fields.Datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-
-            data = (
-                f"{name}|"
-                f"{date}|"
-                f"{company_vat}|"
-                f"{partner_vat}|"
-                f"{invoice.amount_total:.2f}|"
-                f"{timestamp}"
-            )
-            hash_object = hashlib.sha256(data.encode("utf-8"))
-            invoice.verifactu_hash = hash_object.hexdigest()
+            anterior = invoice._get_verifactu_registro_anterior(previous=previous.get(invoice.company_id))
+            prev_huella = anterior['Huella'] if anterior else ''
+            previous[invoice.company_id] = invoice
+
+            if (invoice.verifactu_hash and invoice.verifactu_gen_datetime
+                    and (invoice.verifactu_prev_hash or '') == prev_huella
+                    and invoice._compute_verifactu_huella(prev_huella, invoice.verifactu_gen_datetime) == invoice.verifactu_hash):
+                continue
+
+            gen_datetime = verifactu_timestamp(fields.Datetime.now())
+            invoice.write({
+                'verifactu_hash': invoice._compute_verifactu_huella(prev_huella, gen_datetime),
+                'verifactu_prev_hash': prev_huella,
+                'verifactu_gen_datetime': gen_datetime,
+            })
+
+    @api.model
+    def _verifactu_backfill_hashes(self, company, batch_size=2000):
+        """
+        Recalcula y guarda las huellas de las facturas ya registradas de una
+        empresa, en orden de cadena, para migrar datos existentes.
+        Lee las facturas con ``search_read`` por lotes (sin cargar recordsets
+        completos) y escribe cada lote con un único UPDATE. Los importes se
+        calculan como en la huella en vivo (``read_verifactu_amounts``).
+        Devuelve el número de facturas procesadas.
+
+        Se lanza con la acción «Recalcular huellas VeriFactu» de Cadenas de
+        registros o desde ``odoo-bin shell``::
+
+            >>> env['account.move']._verifactu_backfill_hashes(env.company)
+            >>> env.cr.commit()
+        """
+        start = time.monotonic()
+        head = self.env['verifactu.chain'].sudo()._get_head(company, lock=True)
+        self.env.flush_all()
+
+        ids = self.search([
+            ('company_id', '=', company.id),
+            ('verifactu_sent', '=', True),
+            ('verifactu_state', 'in', ('accepted', 'partially_accepted')),
+        ], order='verifactu_sent_date, id').ids
+
+        nif = self._get_verifactu_skeleton(company).nif
+        read_fields = ['name', 'invoice_date', 'verifactu_sent_date', 'verifactu_gen_datetime']
+        prev_huella = ''
+        prev_id = None
+        last = None
+        sequence = 0
+
+        for offset in range(0, len(ids), batch_size):
+            chunk = ids[offset:offset + batch_size]
+            rows = {row['id']: row for row in self.search_read([('id', 'in', chunk)], read_fields)}
+            amounts = read_verifactu_amounts(self.env.cr, chunk)
+            values = []
+            for move_id in chunk:
+                row = rows[move_id]
+                sequence += 1
+                gen_datetime = row['verifactu_gen_datetime'] or verifactu_timestamp(row['verifactu_sent_date'])
+                cuota, importe_total = amounts[move_id]
+                huella = verifactu_huella(
+                    nif,
+                    row['name'],
+                    row['invoice_date'].strftime('%d-%m-%Y'),
+                    'F1',
+                    format_cents(cuota),
+                    format_cents(importe_total),
+                    prev_huella,
+                    gen_datetime,
+                )
+                values.append((move_id, huella, prev_huella, gen_datetime, sequence, prev_id))
+                prev_huella = huella
+                prev_id = move_id
+                last = row
+
+            execute_values(self.env.cr._obj, """
+                UPDATE account_move AS m
+                   SET verifactu_hash = v.hash,
+                       verifactu_prev_hash = v.prev_hash,
+                       verifactu_gen_datetime = v.gen_datetime,
+                       verifactu_chain_seq = v.seq,
+                       verifactu_chain_prev_id = v.prev_id
+                  FROM (VALUES %s) AS v(id, hash, prev_hash, gen_datetime, seq, prev_id)
+                 WHERE m.id = v.id
+            """, values, template='(%s, %s, %s, %s, %s, %s::integer)', page_size=batch_size)
+
+        self.env.invalidate_all()
+        if last:
+            head.write({
+                'sequence': sequence,
+                'last_move_id': last['id'],
+                'last_nif': nif,
+                'last_number': last['name'],
+                'last_date': last['invoice_date'],
+                'last_hash': prev_huella,
+            })
+
+        elapsed = time.monotonic() - start
+        _logger.info(
+            "Huellas VeriFactu recalculadas para %s: %s facturas en %.2fs (%.0f/s)",
+            company.name, len(ids), elapsed, len(ids) / elapsed if elapsed else 0,
+        )
+        return len(ids)
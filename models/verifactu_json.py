@@ -3,13 +3,17 @@ from odoo.exceptions import UserError
 import base64
 import json
 
+from .verifactu_tax_breakdown import format_cents
+from .verifactu_hash import verifactu_timestamp
+
 class AccountMove(models.Model):
     _inherit = 'account.move'
 
-    def _generate_verifactu_json(self):
+    def _generate_verifactu_json(self, create_head=True):
         """
         Genera un diccionario con los datos de la factura en formato compatible
-        con el esquema de VeriFactu de la AEAT.
+        con el esquema de VeriFactu de la AEAT. Con ``create_head=False`` no
+        se crea la cabeza de la cadena (ver ``_get_verifactu_registro_anterior``).
         """
         self.ensure_one()
         invoice = self  
@@ -45,49 +49,25 @@ class AccountMove(models.Model):
             }
         }
 
-        # Desglose de impuestos
-        desglose = []
-        for line in invoice.invoice_line_ids:
-            if not line.tax_ids:
-                continue
-            for tax in line.tax_ids:
-                taxes = tax.compute_all(
-                    line.price_unit, line.currency_id, line.quantity,
-                    product=line.product_id, partner=invoice.partner_id
-                )
-                tax_amount = sum(t['amount'] for t in taxes['taxes'] if abs(t['amount']) > 0)
-
-                detalle = {
-                    "ClaveRegimen": "01",  # Régimen general
-                    "CalificacionOperacion": "S1",  # Sujeto pasivo
-                    "TipoImpositivo": f"{tax.amount:.2f}",
-                    "BaseImponibleOimporteNoSujeto": f"{line.price_subtotal:.2f}",
-                    "CuotaRepercutida": f"{tax_amount:.2f}"
-                }
-                desglose.append(detalle)
-
-        # Encadenamiento
-        last_invoice = self.search([
-            ('company_id', '=', invoice.company_id.id),
-            ('verifactu_sent', '=', True),
-            ('id', '!=', invoice.id)
-        ], order='verifactu_sent_date desc', limit=1)
-
-        registro_anterior = {}
-        if last_invoice:
-            registro_anterior = {
-                "IDEmisorFactura": self._clean_vat(last_invoice.company_id.vat),
-                "NumSerieFactura": last_invoice.name,
-                "FechaExpedicionFactura": last_invoice.invoice_date.strftime('%d-%m-%Y'),
-                "Huella": last_invoice.verifactu_hash or ""
+        # Desglose de impuestos (mismo cálculo agregado que el XML)
+        breakdown = invoice._get_verifactu_tax_breakdown()
+        desglose = [
+            {
+                "ClaveRegimen": row['clave_regimen'],
+                "CalificacionOperacion": row['calificacion'],
+                "TipoImpositivo": row['tipo_impositivo'],
+                "BaseImponibleOimporteNoSujeto": format_cents(row['base']),
+                "CuotaRepercutida": format_cents(row['cuota'])
             }
+            for row in breakdown['rows']
+        ]
+
+        # Encadenamiento: el primer registro de la cadena no tiene registro anterior
+        registro_anterior = invoice._get_verifactu_registro_anterior(create_head=create_head)
+        if registro_anterior:
+            encadenamiento = {"RegistroAnterior": registro_anterior}
         else:
-            registro_anterior = {
-                "IDEmisorFactura": self._clean_vat(invoice.company_id.vat),
-                "NumSerieFactura": "INITIAL",
-                "FechaExpedicionFactura": invoice.invoice_date.strftime('%d-%m-%Y'),
-                "Huella": "INITIAL"
-            }
+            encadenamiento = {"PrimerRegistro": "S"}
 
         # Sistema informático
         sistema_informatico = {
@@ -111,15 +91,13 @@ class AccountMove(models.Model):
             "DescripcionOperacion": description,
             "Destinatarios": destinatarios,
             "Desglose": desglose,
-            "CuotaTotal": f"{invoice.amount_tax:.2f}",
-            "ImporteTotal": f"{invoice.amount_total:.2f}",
+            "CuotaTotal": format_cents(breakdown['cuota']),
+            "ImporteTotal": format_cents(breakdown['base'] + breakdown['cuota']),
             "Subsanacion": "S" if invoice.verifactu_subsanacion else None,
             "RechazoPrevio": "X" if invoice.verifactu_rechazo_previo else None,
-            "Encadenamiento": {
-                "RegistroAnterior": registro_anterior
-            },
+            "Encadenamiento": encadenamiento,
             "SistemaInformatico": sistema_informatico,
-            "FechaHoraHusoGenRegistro": fields.Datetime.now().strftime('%Y-%m-%dT%H:%M:%S+01:00'),
+            "FechaHoraHusoGenRegistro": invoice.verifactu_gen_datetime or verifactu_timestamp(fields.Datetime.now()),
             "TipoHuella": "01",
             "Huella": invoice.verifactu_hash or ""
         }
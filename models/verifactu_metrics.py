@@ -0,0 +1,272 @@
+"""
+Métricas del proceso de envío VeriFactu (duración de cada etapa, tamaños,
+códigos HTTP y códigos de error de la AEAT) en formato Prometheus.
+
+Cada proceso de Odoo acumula sus métricas en memoria y las vuelca a
+``<data_dir>/verifactu_metrics/<pid>-<inicio>.json``: el instante de inicio
+del proceso distingue a un worker nuevo que reutiliza el PID de otro. Al
+leerlas, la ruta ``/verifactu/metrics`` incorpora los ficheros de procesos
+ya terminados a ``_aggregate.json`` y los borra, y suma el agregado con los
+ficheros de los procesos vivos. Así el directorio no crece con el reciclado
+de workers y los totales nunca disminuyen.
+"""
+import functools
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+from odoo.tools import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 5242880, 10485760)
+
+# Descripción y límites de cada métrica
+HISTOGRAMS = {
+    'verifactu_stage_seconds': ("Duración de cada etapa del envío VeriFactu", STAGE_BUCKETS),
+    'verifactu_payload_bytes': ("Tamaño de los XML enviados y las respuestas de la AEAT", BYTES_BUCKETS),
+}
+COUNTERS = {
+    'verifactu_aeat_requests_total': "Peticiones a la AEAT por código HTTP",
+    'verifactu_aeat_record_errors_total': "Registros rechazados por la AEAT por código de error",
+}
+
+# Segundos mínimos entre volcados a disco de un mismo proceso
+FLUSH_INTERVAL = 5
+
+AGGREGATE_FILE = '_aggregate.json'
+
+_LOCK = threading.Lock()
+_DATA = {'histograms': {}, 'counters': {}}
+_STATE = {'last_flush': 0.0, 'dirty': False, 'pid': None, 'worker': None}
+
+
+def _process_key(pid):
+    """Identificador único del proceso: PID e instante de inicio (ms)."""
+    return '%s-%d' % (pid, psutil.Process(pid).create_time() * 1000)
+
+
+def _check_fork():
+    """
+    Llamar con _LOCK tomado. Un worker creado con fork hereda las métricas
+    del proceso padre: se descartan para no contarlas dos veces.
+    """
+    pid = os.getpid()
+    if _STATE['pid'] != pid:
+        _DATA['histograms'].clear()
+        _DATA['counters'].clear()
+        _STATE.update(pid=pid, worker=_process_key(pid), dirty=False, last_flush=0.0)
+
+
+def _labels_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Añade ``value`` al histograma ``name``."""
+    buckets = HISTOGRAMS[name][1]
+    with _LOCK:
+        _check_fork()
+        series = _DATA['histograms'].setdefault(name, {}).setdefault(
+            _labels_key(labels), {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+        _STATE['dirty'] = True
+    flush()
+
+
+def increment(name, amount=1, **labels):
+    """Suma ``amount`` al contador ``name``."""
+    with _LOCK:
+        _check_fork()
+        series = _DATA['counters'].setdefault(name, {})
+        key = _labels_key(labels)
+        series[key] = series.get(key, 0) + amount
+        _STATE['dirty'] = True
+    flush()
+
+
+@contextmanager
+def stage(name):
+    """Mide la duración de un bloque como etapa ``name``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('verifactu_stage_seconds', time.perf_counter() - start, stage=name)
+
+
+def timed_stage(name):
+    """Decorador de métodos: mide cada llamada como etapa ``name``."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _metrics_dir():
+    return os.path.join(config['data_dir'], 'verifactu_metrics')
+
+
+def flush(force=False):
+    """Vuelca las métricas del proceso a su fichero (como mucho cada FLUSH_INTERVAL segundos)."""
+    now = time.monotonic()
+    with _LOCK:
+        _check_fork()
+        if not _STATE['dirty'] or (not force and now - _STATE['last_flush'] < FLUSH_INTERVAL):
+            return
+        data = json.dumps(_DATA)
+        _STATE['dirty'] = False
+        _STATE['last_flush'] = now
+        worker = _STATE['worker']
+
+    directory = _metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    _write_atomic(os.path.join(directory, '%s.json' % worker), data)
+
+
+def _write_atomic(path, data):
+    # Escritura atómica: quien lee nunca ve un fichero a medias
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as tmp:
+        tmp.write(data)
+    os.replace(tmp_path, path)
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_alive(worker):
+    """Indica si el proceso que escribió el fichero ``worker`` sigue en marcha."""
+    try:
+        return _process_key(int(worker.split('-')[0])) == worker
+    except (psutil.Error, ValueError):
+        return False
+
+
+@contextmanager
+def _directory_lock(directory):
+    """Bloqueo entre procesos para que dos lecturas no agreguen el mismo fichero."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _merge_into(merged, snapshot):
+    for name, series in snapshot.get('histograms', {}).items():
+        for key, values in series.items():
+            target = merged['histograms'].setdefault(name, {}).setdefault(
+                key, {'buckets': [0] * len(values['buckets']), 'sum': 0.0, 'count': 0})
+            target['buckets'] = [a + b for a, b in zip(target['buckets'], values['buckets'])]
+            target['sum'] += values['sum']
+            target['count'] += values['count']
+    for name, series in snapshot.get('counters', {}).items():
+        for key, value in series.items():
+            target = merged['counters'].setdefault(name, {})
+            target[key] = target.get(key, 0) + value
+
+
+def _merge_snapshots():
+    """
+    Suma las métricas de todos los procesos. Los ficheros de procesos
+    terminados se incorporan antes a ``AGGREGATE_FILE`` y se borran; el
+    agregado recuerda los ficheros incorporados por si el borrado no llega
+    a hacerse.
+    """
+    directory = _metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    aggregate_path = os.path.join(directory, AGGREGATE_FILE)
+    with _directory_lock(directory):
+        aggregate = _load_snapshot(aggregate_path) or {}
+        merged = {'histograms': {}, 'counters': {}}
+        _merge_into(merged, aggregate)
+        folded = set(aggregate.get('folded', []))
+
+        live, dead = [], []
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            filename = os.path.basename(path)
+            if filename == AGGREGATE_FILE:
+                continue
+            if filename in folded:
+                dead.append(path)
+            elif _is_alive(filename[:-len('.json')]):
+                live.append(path)
+            else:
+                snapshot = _load_snapshot(path)
+                if snapshot:
+                    _merge_into(merged, snapshot)
+                folded.add(filename)
+                dead.append(path)
+
+        if dead:
+            existing = {os.path.basename(path) for path in dead}
+            _write_atomic(aggregate_path, json.dumps(dict(merged, folded=sorted(existing & folded))))
+            for path in dead:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    for path in live:
+        snapshot = _load_snapshot(path)
+        if snapshot:
+            _merge_into(merged, snapshot)
+    return merged
+
+
+def _format_labels(key, extra=None):
+    labels = [(k, v) for k, v in json.loads(key)] + (extra or [])
+    if not labels:
+        return ''
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in labels]
+    return '{%s}' % ','.join(escaped)
+
+
+def render_prometheus():
+    """Métricas de todos los procesos en formato de texto de Prometheus."""
+    flush(force=True)
+    merged = _merge_snapshots()
+    lines = []
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s histogram' % name)
+        for key, values in sorted(merged['histograms'].get(name, {}).items()):
+            for bound, count in zip(buckets, values['buckets']):
+                lines.append('%s_bucket%s %d' % (name, _format_labels(key, [('le', repr(float(bound)))]), count))
+            lines.append('%s_bucket%s %d' % (name, _format_labels(key, [('le', '+Inf')]), values['count']))
+            lines.append('%s_sum%s %r' % (name, _format_labels(key), values['sum']))
+            lines.append('%s_count%s %d' % (name, _format_labels(key), values['count']))
+    for name, description in COUNTERS.items():
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s counter' % name)
+        for key, value in sorted(merged['counters'].get(name, {}).items()):
+            lines.append('%s%s %d' % (name, _format_labels(key), value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,178 @@
+from odoo import models, fields, api
+import base64
+import hashlib
+import logging
+import zlib
+
+import psycopg2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_logger = logging.getLogger(__name__)
+
+# Los contenidos creados hace menos de este tiempo no se eliminan aunque aún
+# no los use ninguna factura
+PAYLOAD_GC_GRACE_HOURS = 24
+
+
+def compress_payload(data):
+    """Comprime ``data`` (bytes) con zstd si está disponible y si no con zlib."""
+    if zstandard:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+
+def decompress_payload(codec, blob):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+
+class VeriFactuPayload(models.Model):
+    """
+    Almacén de los XML enviados, los XML firmados reutilizables y las
+    respuestas de la AEAT, fuera de la tabla account_move. El contenido se guarda comprimido en el filestore y
+    se identifica por su SHA-256: todas las facturas de un mismo envío
+    comparten el mismo XML y la misma respuesta, que se guardan una sola vez.
+    """
+    _name = 'verifactu.payload'
+    _description = 'Contenido VeriFactu comprimido'
+    _rec_name = 'digest'
+
+    digest = fields.Char("SHA-256", required=True, readonly=True, index=True)
+    codec = fields.Selection([
+        ('zlib', 'zlib'),
+        ('zstd', 'zstd')
+    ], string="Compresión", required=True, readonly=True)
+    size = fields.Integer("Tamaño", readonly=True)
+    compressed_size = fields.Integer("Tamaño comprimido", readonly=True)
+    content = fields.Binary("Contenido comprimido", attachment=True, readonly=True)
+
+    _sql_constraints = [
+        ('digest_uniq', 'unique(digest)', 'Ya existe un contenido VeriFactu con esta huella.'),
+    ]
+
+    @api.model
+    def _store(self, text):
+        """Guarda ``text`` (si no existe ya) y devuelve su registro."""
+        if not text:
+            return self.browse()
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        payload = self._find_by_digest(digest)
+        if payload:
+            return payload
+
+        codec, blob = compress_payload(data)
+        try:
+            with self.env.cr.savepoint():
+                return self.create({
+                    'digest': digest,
+                    'codec': codec,
+                    'size': len(data),
+                    'compressed_size': len(blob),
+                    'content': base64.b64encode(blob),
+                })
+        except psycopg2.IntegrityError:
+            # Otro worker ha guardado el mismo contenido a la vez
+            return self._find_by_digest(digest)
+
+    @api.model
+    def _find_by_digest(self, digest):
+        """
+        Contenido existente con esa huella. La fila queda bloqueada (FOR SHARE)
+        hasta el final de la transacción: la limpieza la salta mientras quien
+        la reutiliza no haya guardado su referencia, y si la limpieza la está
+        borrando se espera y no se devuelve.
+        """
+        self.env.cr.execute("SELECT id FROM verifactu_payload WHERE digest = %s FOR SHARE", (digest,))
+        row = self.env.cr.fetchone()
+        return self.browse(row[0]) if row else self.browse()
+
+    def _load(self):
+        """Devuelve el contenido descomprimido como texto."""
+        self.ensure_one()
+        content = self.with_context(bin_size=False).content
+        if not content:
+            return False
+        return decompress_payload(self.codec, base64.b64decode(content)).decode('utf-8')
+
+    @api.autovacuum
+    def _gc_unreferenced_payloads(self):
+        """
+        Elimina los contenidos que ya no usa ninguna factura. Se respetan los
+        creados en las últimas PAYLOAD_GC_GRACE_HOURS horas y los que otra
+        transacción está reutilizando (bloqueados, ver ``_find_by_digest``);
+        los candidatos se bloquean y, ya bloqueados, se vuelven a comprobar
+        sus referencias: una reutilización confirmada entre la instantánea de
+        la primera consulta y el bloqueo no se ve en la primera.
+        """
+        self.flush_model()
+        self.env['account.move'].flush_model(['verifactu_xml_payload_id', 'verifactu_response_payload_id'])
+        self.env['verifactu.signature'].flush_model(['verifactu_artifact_payload_id'])
+        self.env.cr.execute("""
+            SELECT p.id
+              FROM verifactu_payload p
+             WHERE p.create_date < (now() at time zone 'UTC') - make_interval(hours => %s)
+               AND NOT EXISTS (SELECT 1 FROM account_move m WHERE m.verifactu_xml_payload_id = p.id)
+               AND NOT EXISTS (SELECT 1 FROM account_move m WHERE m.verifactu_response_payload_id = p.id)
+               AND NOT EXISTS (SELECT 1 FROM verifactu_signature s WHERE s.verifactu_artifact_payload_id = p.id)
+               FOR UPDATE OF p SKIP LOCKED
+        """, (PAYLOAD_GC_GRACE_HOURS,))
+        candidates = [row[0] for row in self.env.cr.fetchall()]
+        if not candidates:
+            return
+        self.env.cr.execute("""
+            SELECT p.id
+              FROM verifactu_payload p
+             WHERE p.id IN %s
+               AND NOT EXISTS (SELECT 1 FROM account_move m WHERE m.verifactu_xml_payload_id = p.id)
+               AND NOT EXISTS (SELECT 1 FROM account_move m WHERE m.verifactu_response_payload_id = p.id)
+               AND NOT EXISTS (SELECT 1 FROM verifactu_signature s WHERE s.verifactu_artifact_payload_id = p.id)
+        """, (tuple(candidates),))
+        payloads = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if payloads:
+            _logger.info("Eliminando %s contenidos VeriFactu sin uso", len(payloads))
+            payloads.unlink()
+
+
+class AccountMovePayload(models.Model):
+    _inherit = 'account.move'
+
+    verifactu_xml_payload_id = fields.Many2one('verifactu.payload', string="Contenido XML enviado",
+                                               readonly=True, copy=False, index=True, ondelete='set null')
+    verifactu_response_payload_id = fields.Many2one('verifactu.payload', string="Contenido respuesta AEAT",
+                                                    readonly=True, copy=False, index=True, ondelete='set null')
+    verifactu_xml_digest = fields.Char(related='verifactu_xml_payload_id.digest', string="SHA-256 XML enviado")
+
+    # El XML y la respuesta solo se descomprimen cuando se leen
+    @api.depends('verifactu_xml_payload_id')
+    def _compute_verifactu_xml(self):
+        for invoice in self:
+            payload = invoice.verifactu_xml_payload_id
+            invoice.verifactu_xml = payload._load() if payload else False
+
+    def _inverse_verifactu_xml(self):
+        self._store_verifactu_payload('verifactu_xml', 'verifactu_xml_payload_id')
+
+    @api.depends('verifactu_response_payload_id')
+    def _compute_verifactu_response(self):
+        for invoice in self:
+            payload = invoice.verifactu_response_payload_id
+            invoice.verifactu_response = payload._load() if payload else False
+
+    def _inverse_verifactu_response(self):
+        self._store_verifactu_payload('verifactu_response', 'verifactu_response_payload_id')
+
+    # Guarda una sola vez cada contenido distinto y enlaza las facturas
+    def _store_verifactu_payload(self, field_name, payload_field):
+        Payload = self.env['verifactu.payload'].sudo()
+        by_value = {}
+        for invoice in self:
+            value = invoice[field_name] or ''
+            by_value[value] = by_value.get(value, self.browse()) | invoice
+        for value, invoices in by_value.items():
+            invoices.write({payload_field: Payload._store(value).id})
@@ -0,0 +1,78 @@
+from odoo import models
+import hashlib
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Campo ficticio de los adjuntos de caché: los oculta del chatter y de las búsquedas normales
+PDF_CACHE_FIELD = 'verifactu_pdf_cache'
+
+
+class VeriFactuPDFCache(models.Model):
+    _inherit = 'account.move'
+
+    def _get_verifactu_pdf_cache_key(self, report):
+        """
+        Clave de caché del PDF: ``<id del reporte>:<SHA-1>`` de todo lo que
+        cambia su contenido sin pasar por la factura (versión del reporte y de
+        las plantillas QWeb, pagos conciliados, idioma y datos de la empresa)
+        además de la última modificación de la factura. Se calcula sin leer ni
+        renderizar el PDF, así que sirve también de ETag.
+        """
+        self.ensure_one()
+        self.env['account.partial.reconcile'].flush_model()
+        self.env.cr.execute("""
+            SELECT (SELECT max(write_date) FROM ir_ui_view WHERE type = 'qweb'),
+                   (SELECT max(p.write_date)
+                      FROM account_partial_reconcile p
+                      JOIN account_move_line l ON l.id IN (p.debit_move_id, p.credit_move_id)
+                     WHERE l.move_id = %s)
+        """, (self.id,))
+        templates_date, payments_date = self.env.cr.fetchone()
+        parts = [
+            report.report_name,
+            report.write_date,
+            templates_date,
+            self.write_date,
+            self.payment_state,
+            self.amount_residual,
+            payments_date,
+            self.partner_id.lang,
+            self.company_id.write_date,
+        ]
+        digest = hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+        return f"{report.id}:{digest}"
+
+    def _get_verifactu_pdf_attachment(self, report, key=None):
+        """
+        Devuelve el PDF de la factura guardado como adjunto, renderizándolo
+        solo si su clave de caché ha cambiado (ver ``_get_verifactu_pdf_cache_key``)
+        o no existía. Al renderizar de nuevo se eliminan las versiones anteriores.
+        """
+        self.ensure_one()
+        Attachment = self.env['ir.attachment'].sudo()
+        domain = [
+            ('res_model', '=', self._name),
+            ('res_id', '=', self.id),
+            ('res_field', '=', PDF_CACHE_FIELD),
+        ]
+        key = key or self._get_verifactu_pdf_cache_key(report)
+        cached = Attachment.search(domain + [('description', '=', key)], limit=1)
+        if cached:
+            return cached
+
+        pdf_content, report_type = self.env['ir.actions.report']._render_qweb_pdf(report.report_name, [self.id])
+        if not pdf_content or report_type != 'pdf':
+            raise ValueError("El reporte generado no es un PDF válido")
+
+        Attachment.search(domain + [('description', '=like', f"{report.id}:%")]).unlink()
+        _logger.info("PDF de la factura %s renderizado y guardado en caché", self.name)
+        return Attachment.create({
+            'name': f"factura_{self.name or self.id}.pdf".replace('/', '_'),
+            'description': key,
+            'res_model': self._name,
+            'res_id': self.id,
+            'res_field': PDF_CACHE_FIELD,
+            'mimetype': 'application/pdf',
+            'raw': pdf_content,
+        })
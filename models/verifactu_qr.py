@@ -1,19 +1,70 @@
 import qrcode
-from io import BytesIO
 import base64
-from odoo import models
+from functools import lru_cache
+from odoo import models, fields, api
+
+from .verifactu_metrics import timed_stage
+
+# Número de QRs distintos que se mantienen en memoria por worker
+QR_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def verifactu_qr_svg(url):
+    """
+    Devuelve el QR de la URL como SVG. Cada tramo horizontal de módulos
+    negros se dibuja como un único rectángulo del path, lo que deja un SVG de
+    pocos KB sin pasar por PIL.
+    """
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=2)
+    qr.add_data(url)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                path.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
+            else:
+                x += 1
+
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+        f'shape-rendering="crispEdges"><rect width="{size}" height="{size}" fill="#fff"/>'
+        f'<path d="{"".join(path)}" fill="#000"/></svg>'
+    ).encode('utf-8')
+
 
 class VeriFactuQR(models.Model):
     _inherit = 'account.move'
 
-    # Genera un código QR con los datos de la factura
+    # URL codificada en el QR de la factura
+    def _get_verifactu_qr_url(self):
+        self.ensure_one()
+        if not self.verifactu_hash:
+            return False
+        return f"{self.get_base_url()}/verifactu/scan/{self.verifactu_hash}"
+
+    # Genera los QR de varias facturas a la vez (impresión masiva). Devuelve {id: svg}.
+    # La URL base es la de cada factura (get_base_url), igual que en _get_verifactu_qr_url
+    @timed_stage('qr')
     def _generate_verifactu_qr(self):
-        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        return {
+            invoice.id: verifactu_qr_svg(invoice._get_verifactu_qr_url())
+            for invoice in self
+            if invoice.verifactu_hash
+        }
+
+    # El QR no se guarda: se calcula al imprimir o mostrar la factura
+    @api.depends('verifactu_hash')
+    def _compute_verifactu_qr(self):
+        svgs = self._generate_verifactu_qr()
         for invoice in self:
-            if not invoice.verifactu_hash:
-                continue
-            qr_url = f"{base_url}/verifactu/scan/{invoice.verifactu_hash}"
-            qr = qrcode.make(qr_url)
-            buffer = BytesIO()
-            qr.save(buffer, format="PNG")
-            invoice.verifactu_qr = base64.b64encode(buffer.getvalue())
\ No newline at end of file
+            svg = svgs.get(invoice.id)
+            invoice.verifactu_qr = base64.b64encode(svg) if svg else False
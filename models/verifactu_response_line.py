@@ -0,0 +1,47 @@
+from odoo import models, fields, api
+
+
+class VeriFactuResponseLine(models.Model):
+    _name = 'verifactu.response.line'
+    _description = 'Resultado AEAT por registro VeriFactu'
+    _order = 'date desc, id desc'
+    _rec_name = 'num_serie'
+
+    move_id = fields.Many2one('account.move', string='Factura', required=True, ondelete='cascade', index=True)
+    company_id = fields.Many2one('res.company', string='Empresa', related='move_id.company_id', store=True, index=True)
+    date = fields.Datetime("Fecha de respuesta", required=True, readonly=True)
+    num_serie = fields.Char("Número de serie", readonly=True)
+    estado = fields.Char("Estado del registro", readonly=True, index=True)
+    codigo = fields.Char("Código de error", readonly=True, index=True)
+    descripcion = fields.Text("Descripción del error", readonly=True)
+    csv = fields.Char("CSV", readonly=True)
+
+    @api.model
+    def _create_from_response(self, invoices, parsed, date):
+        """
+        Guarda el resultado de cada RespuestaLinea en su factura (por número
+        de serie) con un único create para todo el envío.
+        """
+        by_name = {invoice.name: invoice for invoice in invoices}
+        vals_list = []
+        for linea in parsed.get('lineas') or []:
+            invoice = by_name.get(linea['num_serie'])
+            if not invoice:
+                continue
+            vals_list.append({
+                'move_id': invoice.id,
+                'date': date,
+                'num_serie': linea['num_serie'],
+                'estado': linea['estado'],
+                'codigo': linea['codigo'] or False,
+                'descripcion': linea['descripcion'] or False,
+                'csv': parsed.get('csv') or False,
+            })
+        return self.create(vals_list)
+
+
+class AccountMoveResponseLine(models.Model):
+    _inherit = 'account.move'
+
+    verifactu_response_line_ids = fields.One2many('verifactu.response.line', 'move_id',
+                                                  string="Resultados AEAT", readonly=True)
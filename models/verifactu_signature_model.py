@@ -1,14 +1,235 @@
-from odoo import models, fields
+from odoo import models, fields, api
 from odoo.exceptions import UserError
 from lxml import etree as ET
-from signxml import XMLSigner, methods
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from cryptography.hazmat.backends import default_backend
+from cryptography import x509
+from collections import OrderedDict
 import base64
+import hashlib
+import importlib.util
 import logging
+import multiprocessing
+import os
+import site
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+from psycopg2.extras import execute_values
+
+from .verifactu_metrics import timed_stage
+from .verifactu_xml_generation import serialize_verifactu_xml
 
 _logger = logging.getLogger(__name__)
 
+# Código que ejecutan los procesos del pool de firma. Se carga como módulo de
+# primer nivel porque esos procesos no tienen los addons de Odoo en su ruta
+# y lo importan por su nombre desde SIGN_WORKER_DIR
+SIGN_WORKER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+SIGN_WORKER_MODULE = 'verifactu_sign_worker'
+
+
+def _import_sign_worker():
+    module = sys.modules.get(SIGN_WORKER_MODULE)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(
+            SIGN_WORKER_MODULE, os.path.join(SIGN_WORKER_DIR, SIGN_WORKER_MODULE + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[SIGN_WORKER_MODULE] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+sign_worker = _import_sign_worker()
+
+# Caché por proceso de clave privada, certificado y firmador ya configurados.
+# Clave: (base de datos, empresa). Cada entrada guarda la huella de las
+# credenciales: si otro worker las modifica la huella cambia y se reconstruye.
+SIGNER_CACHE_SIZE = 32
+_SIGNER_CACHE = OrderedDict()
+_SIGNER_CACHE_LOCK = threading.Lock()
+
+
+def credentials_fingerprint(cert_pem, key_pem, key_pass=None):
+    data = '\0'.join([cert_pem or '', key_pem or '', key_pass or ''])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class _CachedSigner:
+    """Clave deserializada, cadena X.509 y XMLSigner listos para firmar."""
+
+    __slots__ = ('fingerprint', 'private_key', 'cert_chain', 'signer', 'lock')
+
+    def __init__(self, fingerprint, private_key, cert_chain, signer):
+        self.fingerprint = fingerprint
+        self.private_key = private_key
+        self.cert_chain = cert_chain
+        self.signer = signer
+        # XMLSigner guarda estado durante sign(): un hilo a la vez por entrada
+        self.lock = threading.Lock()
+
+
+def _load_signer(fingerprint, cert_pem, key_pem, key_pass=None):
+    # Cargar clave privada con manejo de errores detallado
+    try:
+        private_key = load_pem_private_key(
+            key_pem.encode(),
+            password=key_pass.encode() if key_pass else None,
+            backend=default_backend()
+        )
+        _logger.info("Clave privada cargada correctamente.")
+    except ValueError as e:
+        if "Could not deserialize key data" in str(e):
+            raise UserError("🔑 Error en la clave privada: El formato no es válido o la contraseña es incorrecta.")
+        raise UserError(f"🔑 Error al procesar la clave privada: {str(e)}")
+    except Exception as e:
+        _logger.exception("Error técnico al cargar la clave privada")
+        raise UserError("🔑 Ocurrió un problema técnico al procesar la clave privada. Contacte al administrador.")
+
+    try:
+        cert_chain = x509.load_pem_x509_certificates(cert_pem.encode())
+    except ValueError as e:
+        raise UserError(f"📄 Error al procesar el certificado digital: {str(e)}")
+
+    # Configurar firmador (el mismo que usan los procesos del pool)
+    try:
+        signer = sign_worker.build_signer()
+        _logger.info("Firmador XMLSigner configurado.")
+    except Exception as e:
+        raise UserError(f"⚙️ Error al configurar el sistema de firma: {str(e)}")
+
+    return _CachedSigner(fingerprint, private_key, cert_chain, signer)
+
+
+def get_cached_signer(dbname, company_id, cert_pem, key_pem, key_pass=None):
+    """Devuelve el firmador de la empresa, cargándolo solo si no está en caché."""
+    key = (dbname, company_id)
+    fingerprint = credentials_fingerprint(cert_pem, key_pem, key_pass)
+    with _SIGNER_CACHE_LOCK:
+        entry = _SIGNER_CACHE.get(key)
+        if entry and entry.fingerprint == fingerprint:
+            _SIGNER_CACHE.move_to_end(key)
+            return entry
+
+    entry = _load_signer(fingerprint, cert_pem, key_pem, key_pass)
+    with _SIGNER_CACHE_LOCK:
+        _SIGNER_CACHE[key] = entry
+        _SIGNER_CACHE.move_to_end(key)
+        while len(_SIGNER_CACHE) > SIGNER_CACHE_SIZE:
+            _SIGNER_CACHE.popitem(last=False)
+    return entry
+
+
+def drop_cached_signers(dbname, company_ids):
+    with _SIGNER_CACHE_LOCK:
+        for company_id in company_ids:
+            _SIGNER_CACHE.pop((dbname, company_id), None)
+
+
+def _signature_values(signed_doc):
+    """Extrae del documento firmado los valores que se guardan en ``verifactu.signature``."""
+    try:
+        signature_elem = signed_doc.xpath('//*[local-name()="Signature"]')
+        if not signature_elem:
+            raise UserError("""
+            ❌ No se encontró la firma en el documento generado.
+            
+            El proceso de firma se completó pero no se pudo localizar la firma en el XML resultante.
+            Esto podría indicar un problema con la estructura del XML.
+            """)
+            
+        signature_elem = signature_elem[0]
+        
+        # Extraer componentes de la firma
+        signed_info_elem = signature_elem.xpath('./*[local-name()="SignedInfo"]')[0]
+        signature_value_elem = signature_elem.xpath('./*[local-name()="SignatureValue"]')[0]
+        x509_elem = signature_elem.xpath('.//*[local-name()="X509Certificate"]')[0]
+        reference_elem = signature_elem.xpath('.//*[local-name()="Reference"]')[0]
+        digest_elem = signature_elem.xpath('.//*[local-name()="DigestValue"]')[0]
+
+        # Extraer valores
+        signature_value = signature_value_elem.text.strip()
+        x509_text = x509_elem.text.strip()
+        x509_clean = "".join(x509_text.splitlines())
+        digest_value = digest_elem.text.strip()
+        signed_info_xml = ET.tostring(signed_info_elem, encoding='unicode')
+        reference_uri_value = reference_elem.attrib.get('URI', '')
+
+    except (IndexError, AttributeError) as e:
+        error_msg = f"""
+        ❌ Estructura de firma incompleta:
+        
+        No se pudo encontrar un componente esencial de la firma digital.
+        
+        Componente faltante: {str(e)}
+        
+        Por favor:
+        1. Verifique que el certificado sea válido
+        2. Revise la configuración de firma electrónica
+        3. Contacte al soporte técnico
+        """
+        raise UserError(error_msg)
+    except Exception as e:
+        _logger.exception("Error técnico al procesar firma")
+        raise UserError("""
+        ❌ Error inesperado al procesar la firma digital.
+        
+        Ocurrió un problema técnico al intentar leer los componentes de la firma.
+        Por favor contacte al administrador del sistema.
+        """)
+
+    return {
+        'verifactu_signature_value': signature_value,
+        'verifactu_x509_certificate': x509_clean,
+        'verifactu_digest_value': digest_value,
+        'verifactu_signature_algorithm': "rsa-sha256",
+        'verifactu_signed_info': signed_info_xml,
+        'verifactu_reference_uri': reference_uri_value,
+    }
+
+
+# Por debajo de este número de documentos no compensa arrancar procesos
+BULK_SIGN_MIN_DOCUMENTS = 20
+
+# Firma en paralelo: un pool de procesos por worker de Odoo, creado una sola
+# vez y reutilizado entre llamadas y empresas
+_POOL = {'executor': None, 'pid': None, 'workers': 0}
+_POOL_LOCK = threading.Lock()
+
+
+def _get_sign_pool(workers):
+    """
+    Devuelve el pool de firma del proceso, creándolo la primera vez. Los
+    workers de Odoo tienen varios hilos (prefork y multihilo), así que los
+    procesos del pool no salen de un fork del worker sino de un forkserver
+    (spawn donde no existe) y arrancan importando ``sign_worker``.
+    """
+    with _POOL_LOCK:
+        executor = _POOL['executor']
+        if executor and _POOL['pid'] == os.getpid() and _POOL['workers'] == workers:
+            return executor
+        if executor and _POOL['pid'] == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(method),
+            initializer=site.addsitedir,
+            initargs=(SIGN_WORKER_DIR,),
+        )
+        _POOL.update(executor=executor, pid=os.getpid(), workers=workers)
+        return executor
+
+
+def _drop_sign_pool():
+    with _POOL_LOCK:
+        if _POOL['executor'] and _POOL['pid'] == os.getpid():
+            _POOL['executor'].shutdown(wait=False, cancel_futures=True)
+        _POOL.update(executor=None, pid=None, workers=0)
+
 
 class VeriFactuSignature(models.Model):
     _name = 'verifactu.signature'
@@ -24,12 +245,15 @@ class VeriFactuSignature(models.Model):
     verifactu_signature_algorithm = fields.Char("Algoritmo de Firma", readonly=True)
     verifactu_signed_info = fields.Text("SignedInfo XML", readonly=True)
     verifactu_reference_uri = fields.Char("Referencia URI", readonly=True)
+    verifactu_artifact_fingerprint = fields.Char("Huella de los datos firmados", readonly=True, copy=False)
+    verifactu_artifact_payload_id = fields.Many2one('verifactu.payload', string="XML firmado", readonly=True,
+                                                    copy=False, ondelete='set null')
 
     def _sign_verifactu_xml(self, xml_str, cert_pem, key_pem, key_pass=None, reference_uri=None):
         _logger.info("Iniciando proceso de firma VeriFactu...")
 
         # Validación de datos de entrada con mensajes claros
-        if not xml_str:
+        if xml_str is None or len(xml_str) == 0:
             raise UserError("❌ No se proporcionó el XML para firmar. Por favor, genere primero el XML de la factura.")
         
         if not cert_pem:
@@ -38,25 +262,16 @@ class VeriFactuSignature(models.Model):
         if not key_pem:
             raise UserError("❌ No se encontró la clave privada. Configure la clave privada en los ajustes de la empresa.")
 
-        # Cargar clave privada con manejo de errores detallado
-        try:
-            private_key = load_pem_private_key(
-                key_pem.encode(),
-                password=key_pass.encode() if key_pass else None,
-                backend=default_backend()
-            )
-            _logger.info("Clave privada cargada correctamente.")
-        except ValueError as e:
-            if "Could not deserialize key data" in str(e):
-                raise UserError("🔑 Error en la clave privada: El formato no es válido o la contraseña es incorrecta.")
-            raise UserError(f"🔑 Error al procesar la clave privada: {str(e)}")
-        except Exception as e:
-            _logger.exception("Error técnico al cargar la clave privada")
-            raise UserError("🔑 Ocurrió un problema técnico al procesar la clave privada. Contacte al administrador.")
+        # Clave, certificado y firmador se reutilizan entre facturas de la misma empresa
+        company_id = self.move_id.company_id[:1].id or 0
+        cached = get_cached_signer(self.env.cr.dbname, company_id, cert_pem, key_pem, key_pass)
+
+        # Se firma directamente el árbol lxml si se recibe; el XML en texto se parsea
+        as_tree = isinstance(xml_str, ET._Element)
 
         # Parsear XML con validación clara
         try:
-            doc = ET.fromstring(xml_str.encode('utf-8'))
+            doc = xml_str if as_tree else ET.fromstring(xml_str.encode('utf-8'))
             _logger.info("XML parseado correctamente.")
         except ET.XMLSyntaxError as e:
             error_msg = f"""
@@ -70,27 +285,16 @@ class VeriFactuSignature(models.Model):
             """
             raise UserError(error_msg)
 
-        # Configurar firmador
-        try:
-            signer = XMLSigner(
-                method=methods.enveloped,
-                signature_algorithm="rsa-sha256",
-                digest_algorithm="sha256",
-                c14n_algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"
-            )
-            _logger.info("Firmador XMLSigner configurado.")
-        except Exception as e:
-            raise UserError(f"⚙️ Error al configurar el sistema de firma: {str(e)}")
-
         # Firmar documento con mensajes detallados
         try:
             sign_kwargs = {
-                'key': private_key,
-                'cert': cert_pem.encode(),
+                'key': cached.private_key,
+                'cert': cached.cert_chain,
                 'reference_uri': reference_uri or None
             }
-            
-            signed_doc = signer.sign(doc, **sign_kwargs)
+
+            with cached.lock:
+                signed_doc = cached.signer.sign(doc, **sign_kwargs)
             _logger.info("Documento firmado correctamente.")
         except Exception as e:
             error_msg = f"""
@@ -110,72 +314,16 @@ class VeriFactuSignature(models.Model):
             """
             raise UserError(error_msg)
 
-        # Registrar XML firmado completo en el log
-        signed_xml_str = ET.tostring(signed_doc, encoding='unicode', method='xml')
-        _logger.debug("XML firmado generado:\n%s", signed_xml_str)
+        # Registrar XML firmado completo en el log (solo se serializa si hace falta)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("XML firmado generado:\n%s", ET.tostring(signed_doc, encoding='unicode', method='xml'))
 
         # Buscar elementos de la firma con manejo de errores
-        try:
-            signature_elem = signed_doc.xpath('//*[local-name()="Signature"]')
-            if not signature_elem:
-                raise UserError("""
-                ❌ No se encontró la firma en el documento generado.
-                
-                El proceso de firma se completó pero no se pudo localizar la firma en el XML resultante.
-                Esto podría indicar un problema con la estructura del XML.
-                """)
-                
-            signature_elem = signature_elem[0]
-            
-            # Extraer componentes de la firma
-            signed_info_elem = signature_elem.xpath('./*[local-name()="SignedInfo"]')[0]
-            signature_value_elem = signature_elem.xpath('./*[local-name()="SignatureValue"]')[0]
-            x509_elem = signature_elem.xpath('.//*[local-name()="X509Certificate"]')[0]
-            reference_elem = signature_elem.xpath('.//*[local-name()="Reference"]')[0]
-            digest_elem = signature_elem.xpath('.//*[local-name()="DigestValue"]')[0]
-
-            # Extraer valores
-            signature_value = signature_value_elem.text.strip()
-            x509_text = x509_elem.text.strip()
-            x509_clean = "".join(x509_text.splitlines())
-            digest_value = digest_elem.text.strip()
-            signed_info_xml = ET.tostring(signed_info_elem, encoding='unicode')
-            reference_uri_value = reference_elem.attrib.get('URI', '')
-
-        except (IndexError, AttributeError) as e:
-            error_msg = f"""
-            ❌ Estructura de firma incompleta:
-            
-            No se pudo encontrar un componente esencial de la firma digital.
-            
-            Componente faltante: {str(e)}
-            
-            Por favor:
-            1. Verifique que el certificado sea válido
-            2. Revise la configuración de firma electrónica
-            3. Contacte al soporte técnico
-            """
-            raise UserError(error_msg)
-        except Exception as e:
-            _logger.exception("Error técnico al procesar firma")
-            raise UserError("""
-            ❌ Error inesperado al procesar la firma digital.
-            
-            Ocurrió un problema técnico al intentar leer los componentes de la firma.
-            Por favor contacte al administrador del sistema.
-            """)
+        signature_vals = _signature_values(signed_doc)
 
         # Guardar datos en el modelo
         try:
-            self.write({
-                'verifactu_signature_value': signature_value,
-                'verifactu_signature_date': fields.Datetime.now(),
-                'verifactu_x509_certificate': x509_clean,
-                'verifactu_digest_value': digest_value,
-                'verifactu_signature_algorithm': "rsa-sha256",
-                'verifactu_signed_info': signed_info_xml,
-                'verifactu_reference_uri': reference_uri_value,
-            })
+            self.write(dict(signature_vals, verifactu_signature_date=fields.Datetime.now()))
             _logger.info("Datos de firma guardados correctamente.")
         except Exception as e:
             _logger.error("Error al guardar firma: %s", str(e))
@@ -189,9 +337,134 @@ class VeriFactuSignature(models.Model):
             """)
 
         _logger.info("Proceso de firma VeriFactu completado con éxito.")
-        return signed_xml_str
+        if as_tree:
+            return signed_doc
+        return ET.tostring(signed_doc, encoding='unicode', method='xml')
+
+    @api.model
+    @timed_stage('sign_bulk')
+    def _sign_verifactu_xml_bulk(self, company, trees):
+        """
+        Firma en bloque los documentos de una empresa.
+        ``trees`` es un diccionario {factura: árbol lxml sin firmar}. A partir
+        de BULK_SIGN_MIN_DOCUMENTS documentos se firman en el pool de procesos
+        del worker (RSA-SHA256 y C14N son CPU puro); con menos documentos, un
+        solo proceso configurado o si el pool se rompe, en el propio proceso.
+        Cada XML firmado se guarda como artefacto reutilizable de su factura
+        (ver ``_get_verifactu_signed_xml``) y las filas ``verifactu.signature``
+        se crean o actualizan en bloque.
+        Devuelve {factura: árbol lxml firmado}.
+        """
+        cert_pem = company.verifactu_cert_pem
+        key_pem = company.verifactu_key_pem
+        key_pass = company.verifactu_key_password
+        if not cert_pem or not key_pem:
+            raise UserError("❌ No se encontró el certificado digital o la clave privada. Configure ambos en los ajustes de la empresa.")
+
+        # Las credenciales se cargan aquí: un error sale como UserError claro
+        # y no como un fallo del pool
+        cached = get_cached_signer(self.env.cr.dbname, company.id, cert_pem, key_pem, key_pass)
+
+        moves = list(trees)
+        payloads = [ET.tostring(trees[move]) for move in moves]
+        workers = int(self.env['ir.config_parameter'].sudo().get_param(
+            'verifactu.sign_workers', os.cpu_count() or 1))
+
+        signed = None
+        if workers > 1 and len(payloads) >= BULK_SIGN_MIN_DOCUMENTS:
+            executor = _get_sign_pool(workers)
+            # Solo viajan bytes: cada proceso del pool carga sus propias credenciales una vez
+            credentials = (cached.fingerprint, cert_pem.encode(), key_pem.encode(),
+                           key_pass.encode() if key_pass else None)
+            chunksize = max(1, len(payloads) // (workers * 4))
+            chunks = [payloads[i:i + chunksize] for i in range(0, len(payloads), chunksize)]
+            try:
+                signed = [
+                    ET.fromstring(data)
+                    for chunk in executor.map(sign_worker.sign_chunk, repeat(credentials), chunks)
+                    for data in chunk
+                ]
+            except BrokenProcessPool:
+                _logger.warning("El pool de firma VeriFactu se ha roto; se firma en el propio proceso", exc_info=True)
+                _drop_sign_pool()
+        if signed is None:
+            with cached.lock:
+                signed = [
+                    cached.signer.sign(ET.fromstring(data), key=cached.private_key, cert=cached.cert_chain)
+                    for data in payloads
+                ]
+
+        self._store_verifactu_signatures(dict(zip(moves, signed)))
+        _logger.info("Firmados %s documentos VeriFactu de %s", len(signed), company.name)
+
+        return dict(zip(moves, signed))
+
+    @api.model
+    def _store_verifactu_signatures(self, signed):
+        """
+        Guarda los datos de firma y el XML firmado de cada factura de
+        ``signed`` ({factura: árbol firmado}): una sola UPDATE para las filas
+        existentes y una sola creación para las que faltan.
+        """
+        if not signed:
+            return
+        Payload = self.env['verifactu.payload'].sudo()
+        now = fields.Datetime.now()
+        values = {
+            move.id: dict(
+                _signature_values(signed_doc),
+                verifactu_signature_date=now,
+                verifactu_artifact_fingerprint=move._get_verifactu_artifact_fingerprint(),
+                verifactu_artifact_payload_id=Payload._store(serialize_verifactu_xml(signed_doc)).id,
+            )
+            for move, signed_doc in signed.items()
+        }
+
+        self.flush_model()
+        self.env.cr.execute("SELECT move_id, id FROM verifactu_signature WHERE move_id IN %s", [tuple(values)])
+        existing = dict(self.env.cr.fetchall())
+        if existing:
+            execute_values(self.env.cr._obj, """
+                UPDATE verifactu_signature AS s
+                   SET verifactu_signature_value = v.signature_value,
+                       verifactu_x509_certificate = v.x509_certificate,
+                       verifactu_digest_value = v.digest_value,
+                       verifactu_signature_algorithm = v.signature_algorithm,
+                       verifactu_signed_info = v.signed_info,
+                       verifactu_reference_uri = v.reference_uri,
+                       verifactu_signature_date = v.signature_date,
+                       verifactu_artifact_fingerprint = v.artifact_fingerprint,
+                       verifactu_artifact_payload_id = v.artifact_payload_id,
+                       write_uid = v.write_uid,
+                       write_date = v.signature_date
+                  FROM (VALUES %s) AS v(id, signature_value, x509_certificate, digest_value, signature_algorithm,
+                                        signed_info, reference_uri, signature_date, artifact_fingerprint,
+                                        artifact_payload_id, write_uid)
+                 WHERE s.id = v.id
+            """, [
+                (
+                    signature_id,
+                    values[move_id]['verifactu_signature_value'],
+                    values[move_id]['verifactu_x509_certificate'],
+                    values[move_id]['verifactu_digest_value'],
+                    values[move_id]['verifactu_signature_algorithm'],
+                    values[move_id]['verifactu_signed_info'],
+                    values[move_id]['verifactu_reference_uri'],
+                    now,
+                    values[move_id]['verifactu_artifact_fingerprint'],
+                    values[move_id]['verifactu_artifact_payload_id'],
+                    self.env.uid,
+                )
+                for move_id, signature_id in existing.items()
+            ], template='(%s, %s, %s, %s, %s, %s, %s, %s::timestamp, %s, %s::integer, %s::integer)')
+            self.invalidate_model()
+        self.create([dict(vals, move_id=move_id) for move_id, vals in values.items() if move_id not in existing])
 
     def generate_and_sign(self):
+        # Varias firmas seleccionadas: firma en bloque
+        if len(self) > 1:
+            return self.move_id.action_sign_verifactu_bulk()
+
         for record in self:
             move = record.move_id
             company = move.company_id
@@ -219,12 +492,10 @@ class VeriFactuSignature(models.Model):
 
             # Generar XML con manejo de errores
             try:
-                xml_str = move._generate_verifactu_xml()
-                
-                if hasattr(xml_str, 'tag'):
-                    xml_str = ET.tostring(xml_str, encoding='utf-8', method='xml').decode('utf-8')
-                    
-                if not xml_str or not xml_str.strip():
+                # Árbol sin firmar: la firma se hace una sola vez, más abajo
+                xml_str = move._build_verifactu_unsigned_tree()
+
+                if xml_str is None:
                     raise UserError("""
                     ❌ El XML generado está vacío.
                     
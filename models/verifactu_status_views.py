@@ -3,15 +3,38 @@ from odoo.exceptions import UserError
 import os
 from lxml import etree
 import html
+from datetime import timedelta
 import logging
+
+from .verifactu_xml_generation import serialize_verifactu_xml, VERIFACTU_BATCH_LIMIT
+from . import verifactu_metrics as metrics
+
 _logger = logging.getLogger(__name__)
 
+# Estados devueltos por la AEAT (EstadoEnvio y EstadoRegistro) en minúsculas
+VERIFACTU_STATE_MAPPING = {
+    'aceptado': 'accepted',
+    'aceptado parcialmente': 'partially_accepted',
+    'rechazado': 'rejected',
+    'correcto': 'accepted',
+    'parcialmentecorrecto': 'partially_accepted',
+    'aceptadoconerrores': 'partially_accepted',
+    'incorrecto': 'rejected',
+    'error': 'error'
+}
+
+# CodigoErrorRegistro de la AEAT para un registro duplicado (ya registrado)
+VERIFACTU_DUPLICATE_CODE = '3000'
+
+# Prioridades de la cola: los envíos desde el formulario pasan antes que los masivos
+VERIFACTU_PRIORITY_INTERACTIVE = 20
+VERIFACTU_PRIORITY_BATCH = 10
+
 class VeriFactuStatusViews(models.Model):
     _inherit = 'account.move'
 
-    # Campos para almacenar el estado y respuesta de VeriFactu
-    def action_send_verifactu(self):
-
+    # Comprueba que las facturas se pueden enviar a la AEAT
+    def _check_verifactu_ready(self):
         for invoice in self:
 
             if invoice.state != 'posted':
@@ -24,7 +47,8 @@ class VeriFactuStatusViews(models.Model):
                     "Asegúrate de que la factura esté en estado 'Confirmada' antes de enviarla."
                 ))
 
-            if invoice.verifactu_state in ['accepted', 'partially_accepted']:
+            # Una subsanación pendiente sí se reenvía (ver ``_send_verifactu_batches``)
+            if invoice.verifactu_state in ['accepted', 'partially_accepted'] and not invoice.verifactu_subsanacion:
                 raise UserError(_("Esta factura ya fue enviada a la AEAT y aceptada. No es posible reenviarla."))
 
             missing_fields = []
@@ -35,35 +59,200 @@ class VeriFactuStatusViews(models.Model):
             if missing_fields:
                 raise UserError(_("Faltan campos requeridos:\n") + "\n".join(missing_fields))
 
-            invoice._generate_verifactu_hash()
-            xml_data = invoice._generate_verifactu_xml()
-            invoice.verifactu_xml = xml_data
-            invoice._validate_xml_against_schema(xml_data)
-            invoice._generate_verifactu_qr()
-
-            result = invoice._send_to_aeat(xml_data)
-            if result.get('success'):
-                parsed = invoice._parse_aeat_response(result.get('response', ''))
-                estado = parsed.get('estado', 'error').lower()
-                mapping = {
-                    'aceptado': 'accepted',
-                    'aceptado parcialmente': 'partially_accepted',
-                    'rechazado': 'rejected',
-                    'error': 'error'
-                }
-                invoice.verifactu_state = mapping.get(estado, 'error')
-                invoice.verifactu_sent = True
-                invoice.verifactu_sent_date = fields.Datetime.now()
-                invoice.verifactu_csv = parsed.get('csv', '')
-                invoice.verifactu_response = result.get('response', '')
-            else:
-                error_message = result.get('error', 'Error desconocido.')
-                invoice.verifactu_state = 'error'
-                invoice.verifactu_response = error_message
+            invoice._check_verifactu_registro_alta()
+
+    # Aplica el resultado de un envío a las facturas incluidas en él
+    def _apply_verifactu_result(self, result):
+        """
+        Actualiza el estado VeriFactu de las facturas enviadas en un mismo
+        RegFactuSistemaFacturacion. Cada RespuestaLinea se asigna a su factura
+        por el número de serie; si la respuesta no trae líneas se usa el
+        estado global del envío. Devuelve la respuesta parseada o None si el
+        envío falló.
+        """
+        if not result.get('success'):
+            error_message = result.get('error', 'Error desconocido.')
+            vals = {
+                'verifactu_state': 'error',
+                'verifactu_response': error_message,
+            }
+            if result.get('uncertain'):
+                vals['verifactu_send_uncertain'] = True
+            self.write(vals)
+            for invoice in self:
                 _logger.error("❌ Error al enviar factura %s a la AEAT: %s", invoice.name, error_message)
+            return None
+
+        parsed = self._parse_aeat_response(result.get('response', ''))
+        lineas = {linea['num_serie']: linea for linea in parsed.get('lineas') or []}
+        now = fields.Datetime.now()
+        for invoice in self:
+            linea = lineas.get(invoice.name)
+            estado = (linea['estado'] if linea else parsed.get('estado', 'error')).lower()
+            # Conciliación: si el envío anterior se quedó sin respuesta, el duplicado
+            # indica que la AEAT ya lo registró (el registro no ha cambiado desde entonces)
+            if linea and invoice.verifactu_send_uncertain and linea['codigo'] == VERIFACTU_DUPLICATE_CODE:
+                _logger.info("Factura %s ya registrada por la AEAT en el envío sin respuesta", invoice.name)
+                estado = 'correcto'
+            invoice.verifactu_send_uncertain = False
+            invoice.verifactu_state = VERIFACTU_STATE_MAPPING.get(estado, 'error')
+            invoice.verifactu_sent = True
+            invoice.verifactu_sent_date = now
+            invoice.verifactu_csv = parsed.get('csv', '')
+        # Resultado estructurado de cada registro, para poder filtrar por código de error
+        self.env['verifactu.response.line'].sudo()._create_from_response(self, parsed, now)
+        # La respuesta es la misma para todo el envío: se guarda una sola vez
+        self.verifactu_response = result.get('response', '')
+        return parsed
+
+    # Valida, guarda y envía un lote ya firmado y aplica la respuesta de la AEAT
+    def _send_verifactu_batch(self, xml_tree):
+        """Devuelve la respuesta parseada (None si el envío falló) y el resultado de ``_send_to_aeat``."""
+        xml_data = serialize_verifactu_xml(xml_tree)
+
+        with metrics.stage('send'):
+            result = self.with_company(self.company_id)._send_to_aeat(xml_data)
+        if result.get('circuit_open'):
+            # No se llegó a enviar: las facturas no cambian de estado
+            return None, result
+        self.verifactu_xml = xml_data
+        metrics.increment('verifactu_aeat_requests_total', status=str(result.get('status_code')))
+        metrics.observe('verifactu_payload_bytes', len(xml_data.encode('utf-8')), kind='request')
+        if result.get('response'):
+            metrics.observe('verifactu_payload_bytes', len(result['response'].encode('utf-8')), kind='response')
+
+        parsed = self._apply_verifactu_result(result)
+        for linea in (parsed or {}).get('lineas') or []:
+            if linea['codigo']:
+                metrics.increment('verifactu_aeat_record_errors_total', code=linea['codigo'])
+        _logger.info("Lote VeriFactu de %s facturas enviado a la AEAT (empresa %s)", len(self), self.company_id.name)
+        return parsed, result
 
-                raise UserError(_("❌ Error al enviar la factura a la AEAT. Por favor, consulta el campo de respuesta para más detalles."))
+    # Envío síncrono por lotes: un RegFactuSistemaFacturacion con hasta 1000 registros.
+    # Lo ejecutan los workers de la cola ``verifactu.submission``.
+    def _send_verifactu_batches(self):
+        """
+        Genera, firma, valida y envía las facturas agrupadas en lotes, empresa
+        por empresa; cada lote se encadena con la cabeza que dejó el anterior.
+        No lanza excepción por errores de envío: los lotes ya aceptados por la
+        AEAT deben quedar registrados.
+
+        Si un lote falla, el resto de facturas de la empresa no se envía: su
+        Encadenamiento apuntaría a registros que la AEAT no tiene. Si la AEAT
+        rechaza un registro de un lote, los aceptados detrás de él quedaron
+        encadenados con el rechazado: se encadenan de nuevo y se reenvían
+        como subsanación.
+
+        Tras cada lote se respeta el TiempoEsperaEnvio indicado por la AEAT:
+        las facturas restantes se quedan en la cola salvo que llenen un lote.
+
+        Devuelve cuatro recordsets: las facturas cuyo envío falló, entre ellas
+        las que se pueden reintentar porque la AEAT no estaba disponible, las
+        que no se han enviado y deben esperar a ese reintento (la AEAT no
+        está disponible) y las que no se han enviado por otros motivos.
+        """
+        failed = retry = held = deferred = self.browse()
+        for company in self.company_id:
+            # Bloqueo de la cabeza de la cadena de la empresa hasta el commit del envío
+            head = self.env['verifactu.chain'].sudo()._get_head(company, lock=True)
+            pending = self.filtered(lambda m: m.company_id == company).sorted('id')
+            # Las huellas de las pendientes se calculan una vez, encadenadas en orden; solo
+            # se recalculan si la cadena prevista cambia (facturas apartadas o rechazadas)
+            rehash = True
+            while pending:
+                # Hasta que pase el TiempoEsperaEnvio del último envío solo se envían lotes completos
+                if (head.next_send_at and head.next_send_at > fields.Datetime.now()
+                        and len(pending) < VERIFACTU_BATCH_LIMIT):
+                    deferred |= pending
+                    break
+
+                batch = self.browse()
+                try:
+                    # Un error al generar o validar el lote solo deshace ese lote
+                    with self.env.cr.savepoint():
+                        if rehash:
+                            pending._generate_verifactu_hash()
+                            rehash = False
+                        batch, xml_tree = pending._generate_verifactu_next_batch()
+                        batch[:1]._validate_xml_against_schema(xml_tree)
+                except Exception as e:
+                    _logger.exception("Error generando un lote VeriFactu de la empresa %s", company.name)
+                    # El savepoint ha deshecho también las huellas calculadas
+                    rehash = True
+                    # Se apartan las facturas que no cumplen el esquema y se sigue con el resto
+                    invalid = (batch or pending)._find_invalid_verifactu_records()
+                    if invalid:
+                        failed |= invalid
+                        pending -= invalid
+                        continue
+                    failing = batch or pending
+                    failing.write({'verifactu_state': 'error', 'verifactu_response': str(e)})
+                    failed |= failing
+                    deferred |= pending - failing
+                    break
+
+                parsed, result = batch._send_verifactu_batch(xml_tree)
+                pending -= batch
+
+                if parsed is None:
+                    if result.get('circuit_open'):
+                        held |= batch | pending
+                        break
+                    failed |= batch
+                    if result.get('retry'):
+                        # El resto espera al reintento para no adelantarse en la cadena
+                        retry |= batch
+                        held |= pending
+                    else:
+                        deferred |= pending
+                    break
+
+                # Solo se encadenan los registros aceptados hasta el primer rechazo
+                registered = batch.filtered(lambda m: m.verifactu_state in ('accepted', 'partially_accepted'))
+                chained = self.browse()
+                for invoice in batch:
+                    if invoice not in registered:
+                        break
+                    chained |= invoice
+                chained.filtered('verifactu_subsanacion').write({'verifactu_subsanacion': False})
+                head._advance(chained)
+                failed |= batch - registered
+                if chained != batch:
+                    # Las pendientes se encadenaron tras un registro que la AEAT no tiene
+                    rehash = True
+
+                resend = registered - chained
+                if resend:
+                    _logger.warning("Reencadenando %s registros VeriFactu aceptados tras un rechazo (empresa %s)",
+                                    len(resend), company.name)
+                    resend.write({'verifactu_subsanacion': True})
+                    pending = (pending | resend).sorted('id')
+
+                # La AEAT indica cuánto esperar antes del siguiente envío (TiempoEsperaEnvio)
+                head.next_send_at = fields.Datetime.now() + timedelta(seconds=parsed.get('tiempo_espera') or 0)
+        metrics.flush(force=True)
+        return failed, retry, held, deferred
+
+    # Encola las facturas para que los workers las envíen en segundo plano
+    def _enqueue_verifactu(self, priority):
+        self._check_verifactu_ready()
+        submissions = self.env['verifactu.submission']._enqueue(self, priority=priority)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Envío a la AEAT en cola'),
+                'message': _("%s facturas añadidas a la cola de envío a la AEAT.") % len(submissions),
+                'type': 'info',
+                'sticky': False,
+            }
+        }
+
+    def action_send_verifactu(self):
+        return self._enqueue_verifactu(priority=VERIFACTU_PRIORITY_INTERACTIVE)
 
+    def action_send_verifactu_batch(self):
+        return self._enqueue_verifactu(priority=VERIFACTU_PRIORITY_BATCH)
 
     # Acción para ver el estado de VeriFactu
     def action_view_verifactu_status(self):
@@ -0,0 +1,224 @@
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from datetime import timedelta
+import logging
+import random
+
+from .verifactu_xml_generation import VERIFACTU_BATCH_LIMIT
+
+_logger = logging.getLogger(__name__)
+
+# Reintentos con espera exponencial (segundos) cuando la AEAT no está disponible
+VERIFACTU_MAX_ATTEMPTS = 10
+VERIFACTU_RETRY_BASE_DELAY = 30
+VERIFACTU_RETRY_MAX_DELAY = 3600
+
+# Crons que vacían la cola (ver data/verifactu_cron.xml)
+VERIFACTU_WORKER_CRONS = (
+    'l10n_es_verifactu.ir_cron_verifactu_submission_worker_1',
+    'l10n_es_verifactu.ir_cron_verifactu_submission_worker_2',
+)
+
+
+class VeriFactuSubmission(models.Model):
+    _name = 'verifactu.submission'
+    _description = 'Cola de envíos VeriFactu'
+    _order = 'priority desc, id'
+
+    move_id = fields.Many2one('account.move', string='Factura', required=True, ondelete='cascade', index=True)
+    company_id = fields.Many2one('res.company', string='Empresa', related='move_id.company_id', store=True, index=True)
+    state = fields.Selection([
+        ('pending', 'Pendiente'),
+        ('done', 'Enviado'),
+        ('error', 'Error'),
+        ('cancel', 'Cancelado')
+    ], string="Estado", default='pending', required=True, index=True, readonly=True)
+    priority = fields.Integer("Prioridad", default=10, help="Las entradas con mayor prioridad se envían antes.")
+    attempts = fields.Integer("Intentos", default=0, readonly=True)
+    next_retry_at = fields.Datetime("Próximo reintento", readonly=True, index=True)
+    error_message = fields.Text("Error", readonly=True)
+    date_done = fields.Datetime("Fecha de envío", readonly=True)
+
+    @api.model
+    def _enqueue(self, moves, priority=10):
+        """
+        Crea una entrada pendiente por factura. Las facturas que ya tienen una
+        entrada pendiente no se duplican; solo se actualiza su prioridad.
+        """
+        pending = self.search([('move_id', 'in', moves.ids), ('state', '=', 'pending')])
+        pending.filtered(lambda s: s.priority < priority).write({'priority': priority})
+        new_moves = moves - pending.move_id
+        submissions = pending | self.create([
+            {'move_id': move.id, 'priority': priority} for move in new_moves
+        ])
+        # Los workers comprueban enseguida si la empresa puede enviar ya
+        self._trigger_workers()
+        return submissions
+
+    @api.model
+    def _trigger_workers(self, at=None):
+        for xmlid in VERIFACTU_WORKER_CRONS:
+            cron = self.env.ref(xmlid, raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger(at=at)
+
+    @api.model
+    def _get_ready_companies(self, batch_size):
+        """
+        Empresas cuya cola se puede enviar ya: ha pasado el TiempoEsperaEnvio
+        del último envío (``verifactu.chain.next_send_at``) o tienen pendientes
+        suficientes para llenar un lote. El resto acumula registros.
+        """
+        now = fields.Datetime.now()
+        self.env.cr.execute("""
+            SELECT s.company_id
+              FROM verifactu_submission s
+         LEFT JOIN verifactu_chain h ON h.company_id = s.company_id
+             WHERE s.state = 'pending'
+               AND (s.next_retry_at IS NULL OR s.next_retry_at <= %s)
+          GROUP BY s.company_id
+            HAVING max(h.next_send_at) IS NULL
+                OR max(h.next_send_at) <= %s
+                OR count(DISTINCT s.id) >= %s
+        """, (now, now, batch_size))
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _claim_pending(self, limit, company_ids):
+        """
+        Bloquea hasta ``limit`` entradas pendientes de las empresas indicadas.
+        SKIP LOCKED permite que varios workers vacíen la cola en paralelo sin
+        pisarse: las filas bloqueadas por otro worker se saltan y el bloqueo
+        dura hasta el commit.
+        """
+        self.env.cr.execute("""
+            SELECT id
+              FROM verifactu_submission
+             WHERE state = 'pending' AND company_id IN %s
+               AND (next_retry_at IS NULL OR next_retry_at <= %s)
+          ORDER BY priority DESC, id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, (tuple(company_ids), fields.Datetime.now(), limit))
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    @api.model
+    def _cron_process_queue(self, batch_size=VERIFACTU_BATCH_LIMIT, max_batches=10):
+        """Punto de entrada de los ``ir.cron`` que vacían la cola."""
+        for _i in range(max_batches):
+            company_ids = self._get_ready_companies(batch_size)
+            if not company_ids:
+                break
+            submissions = self._claim_pending(batch_size, company_ids)
+            if not submissions:
+                break
+            submissions._process()
+            # El commit libera los bloqueos y deja registrado el resultado del lote
+            self.env.cr.commit()
+
+        # Siguiente ejecución al terminar el TiempoEsperaEnvio de la primera empresa
+        # con pendientes o al llegar el primer reintento programado
+        now = fields.Datetime.now()
+        self.env.cr.execute("""
+            SELECT min(t)
+              FROM (SELECT h.next_send_at AS t
+                      FROM verifactu_chain h
+                     WHERE h.next_send_at > %s
+                       AND EXISTS (SELECT 1 FROM verifactu_submission s
+                                    WHERE s.company_id = h.company_id AND s.state = 'pending')
+                 UNION ALL
+                    SELECT next_retry_at
+                      FROM verifactu_submission
+                     WHERE state = 'pending' AND next_retry_at > %s) AS pending_times
+        """, (now, now))
+        next_send_at = self.env.cr.fetchone()[0]
+        if next_send_at:
+            self._trigger_workers(at=next_send_at)
+
+    def _process(self):
+        now = fields.Datetime.now()
+        for company in self.company_id:
+            submissions = self.filtered(lambda s: s.company_id == company)
+
+            # Las facturas que ya no se pueden enviar no bloquean al resto del lote
+            ready = self.browse()
+            for submission in submissions:
+                try:
+                    submission.move_id._check_verifactu_ready()
+                    ready |= submission
+                except UserError as e:
+                    submission.write({
+                        'state': 'error',
+                        'attempts': submission.attempts + 1,
+                        'error_message': str(e),
+                    })
+            if not ready:
+                continue
+
+            # Cada lote usa su propio savepoint: un lote que falla no deshace los ya enviados
+            _failed, retry, held, deferred = ready.move_id.with_company(company)._send_verifactu_batches()
+
+            for submission in ready:
+                move = submission.move_id
+                if move in deferred:
+                    # No se llegó a enviar: sigue pendiente, sin contar como intento
+                    continue
+                if move in held:
+                    # La AEAT no está disponible: espera al reintento sin gastar intentos,
+                    # así una caída larga no agota VERIFACTU_MAX_ATTEMPTS
+                    submission.write({
+                        'next_retry_at': now + timedelta(seconds=submission._get_retry_delay()),
+                        'error_message': _('La AEAT no está disponible. El envío se reintentará automáticamente.'),
+                    })
+                    continue
+                if move in retry and submission.attempts + 1 < VERIFACTU_MAX_ATTEMPTS:
+                    # La AEAT no estaba disponible: sigue pendiente hasta el próximo reintento
+                    submission.write({
+                        'attempts': submission.attempts + 1,
+                        'next_retry_at': now + timedelta(seconds=submission._get_retry_delay()),
+                        'error_message': move.verifactu_response,
+                    })
+                    continue
+                accepted = move.verifactu_state in ('accepted', 'partially_accepted')
+                submission.write({
+                    'state': 'done' if accepted else 'error',
+                    'attempts': submission.attempts + 1,
+                    'error_message': False if accepted else move.verifactu_response,
+                    'date_done': now,
+                })
+
+    # Espera exponencial con jitter: entre la mitad y el total del retardo del intento
+    def _get_retry_delay(self):
+        self.ensure_one()
+        delay = min(VERIFACTU_RETRY_MAX_DELAY, VERIFACTU_RETRY_BASE_DELAY * 2 ** self.attempts)
+        return random.uniform(delay / 2, delay)
+
+    @api.model
+    def _replay_backlog(self):
+        """
+        Cuando la AEAT vuelve a responder, los reintentos programados pasan a
+        estar disponibles a la vez y los workers los envían en el orden
+        original de la cola (prioridad e id), sin esperar a su jitter.
+        """
+        # SKIP LOCKED: las entradas que un worker está enviando ahora mismo no se tocan
+        self.env.cr.execute("""
+            UPDATE verifactu_submission
+               SET next_retry_at = NULL
+             WHERE id IN (SELECT id
+                            FROM verifactu_submission
+                           WHERE state = 'pending' AND next_retry_at IS NOT NULL
+                             FOR UPDATE SKIP LOCKED)
+        """)
+        if self.env.cr.rowcount:
+            _logger.info("Reenviando %s envíos VeriFactu pendientes de reintento", self.env.cr.rowcount)
+            self._trigger_workers()
+
+    def action_retry(self):
+        self.filtered(lambda s: s.state in ('error', 'cancel')).write({
+            'state': 'pending',
+            'next_retry_at': False,
+            'error_message': False,
+        })
+
+    def action_cancel(self):
+        self.filtered(lambda s: s.state == 'pending').write({'state': 'cancel'})
@@ -0,0 +1,108 @@
+from odoo import models
+from collections import defaultdict
+
+
+def to_cents(amount):
+    """Importe ya redondeado a la moneda expresado en céntimos enteros."""
+    return int(round(amount * 100))
+
+
+def format_cents(cents):
+    sign = '-' if cents < 0 else ''
+    cents = abs(cents)
+    return f"{sign}{cents // 100}.{cents % 100:02d}"
+
+
+def verifactu_amounts(lines, sign):
+    """
+    CuotaTotal e ImporteTotal en céntimos a partir de los apuntes de la
+    factura. ``lines`` son tuplas (display_type, es línea de impuesto,
+    amount_currency) y ``sign`` el ``direction_sign`` de la factura: las
+    líneas de producto aportan la base y las de impuesto la cuota, de modo
+    que el redondeo de caja o el descuento por pronto pago no cuentan.
+    Es la única definición de los importes de la huella: la usan el XML, la
+    huella, el recálculo masivo y el verificador de la cadena.
+    """
+    base = cuota = 0
+    for display_type, is_tax, amount in lines:
+        if display_type == 'product':
+            base += to_cents(amount * sign)
+        elif is_tax:
+            cuota += to_cents(amount * sign)
+    return cuota, base + cuota
+
+
+def read_verifactu_amounts(cr, move_ids):
+    """
+    ``verifactu_amounts`` de varias facturas leyendo los apuntes con una sola
+    consulta, sin cargar recordsets. Devuelve {id: (cuota, importe total)}.
+    """
+    if not move_ids:
+        return {}
+    # Mismo criterio que account.move.direction_sign
+    cr.execute("""
+        SELECT l.move_id, l.display_type, l.tax_line_id IS NOT NULL, l.amount_currency,
+               CASE WHEN m.move_type IN ('entry', 'in_invoice', 'out_refund', 'in_receipt') THEN 1 ELSE -1 END
+          FROM account_move_line l
+          JOIN account_move m ON m.id = l.move_id
+         WHERE l.move_id IN %s
+    """, (tuple(move_ids),))
+    lines = defaultdict(list)
+    signs = {}
+    for move_id, display_type, is_tax, amount, sign in cr.fetchall():
+        lines[move_id].append((display_type, is_tax, amount or 0.0))
+        signs[move_id] = sign
+    return {move_id: verifactu_amounts(lines[move_id], signs.get(move_id, -1)) for move_id in move_ids}
+
+
+class VeriFactuTaxBreakdown(models.Model):
+    _inherit = 'account.move'
+
+    # Clave de agrupación del desglose: (ClaveRegimen, CalificacionOperacion, TipoImpositivo)
+    def _verifactu_breakdown_key(self, tax):
+        return ('01', 'S1', f"{tax.amount:.2f}")
+
+    def _get_verifactu_tax_breakdown(self):
+        """
+        Calcula el Desglose de la factura con una fila por grupo (tipo
+        impositivo, régimen y calificación). Se reutilizan los apuntes ya
+        calculados por Odoo: las líneas de producto aportan la base y las
+        líneas de impuesto la cuota, sin volver a llamar a ``compute_all``.
+        Todos los importes se manejan en céntimos enteros.
+
+        Devuelve un diccionario con ``rows`` (lista de filas con
+        clave_regimen, calificacion, tipo_impositivo, base y cuota),
+        ``base`` y ``cuota`` totales.
+        """
+        self.ensure_one()
+        sign = self.direction_sign
+        groups = {}
+
+        for line in self.line_ids:
+            if line.display_type == 'product':
+                base = to_cents(line.amount_currency * sign)
+                for tax in line.tax_ids.flatten_taxes_hierarchy():
+                    group = groups.setdefault(self._verifactu_breakdown_key(tax), [0, 0])
+                    group[0] += base
+            elif line.tax_line_id:
+                group = groups.setdefault(self._verifactu_breakdown_key(line.tax_line_id), [0, 0])
+                group[1] += to_cents(line.amount_currency * sign)
+
+        rows = []
+        for (clave_regimen, calificacion, tipo_impositivo), (base, cuota) in sorted(groups.items()):
+            rows.append({
+                'clave_regimen': clave_regimen,
+                'calificacion': calificacion,
+                'tipo_impositivo': tipo_impositivo,
+                'base': base,
+                'cuota': cuota,
+            })
+
+        # Totales con la misma función que el recálculo masivo y el verificador
+        cuota_total, importe_total = verifactu_amounts(
+            [(line.display_type, bool(line.tax_line_id), line.amount_currency) for line in self.line_ids], sign)
+        return {
+            'rows': rows,
+            'base': importe_total - cuota_total,
+            'cuota': cuota_total,
+        }
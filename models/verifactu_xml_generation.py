@@ -1,15 +1,80 @@
-import xml.etree.ElementTree as ET
-import xml.sax.saxutils as saxutils
 from odoo import models, fields, _
 from odoo.exceptions import UserError
-from xml.dom import minidom
 import logging
 from lxml import etree
 import os
-from decimal import Decimal, ROUND_HALF_UP
+import copy
+import threading
+from collections import OrderedDict
+
+from .verifactu_tax_breakdown import format_cents
+from .verifactu_hash import verifactu_timestamp
+from .verifactu_metrics import timed_stage
 
 _logger = logging.getLogger(__name__)
 
+NAMESPACES = {
+    'soapenv': 'http://schemas.xmlsoap.org/soap/envelope/',
+    'sum': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd',
+    'sum1': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroInformacion.xsd',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance'
+}
+
+
+def _q(prefix, tag):
+    """Nombre cualificado (notación Clark) de ``prefix:tag``."""
+    return '{%s}%s' % (NAMESPACES[prefix], tag)
+
+
+def _sub(parent, prefix, tag, text=None):
+    element = etree.SubElement(parent, _q(prefix, tag))
+    if text is not None:
+        element.text = text
+    return element
+
+
+def serialize_verifactu_xml(root):
+    """Serialización única y compacta del árbol firmado."""
+    return etree.tostring(root, encoding='unicode')
+
+# Límite de RegistroFactura por RegFactuSistemaFacturacion fijado por la AEAT
+VERIFACTU_BATCH_LIMIT = 1000
+# Tamaño máximo por defecto de un envío por lotes (bytes)
+VERIFACTU_BATCH_MAX_BYTES = 5 * 1024 * 1024
+
+# XSD incluido en el módulo; importa SuministroInformacion.xsd y xmldsig-core-schema.xsd
+BUNDLED_XSD_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'xsd', 'SuministroLR.xsd')
+
+# Esqueletos XML por empresa: partes del envelope que no cambian entre facturas.
+# Clave: (base de datos, empresa). La versión incluye el write_date de la empresa,
+# así que un cambio hecho desde otro worker también invalida la entrada.
+SKELETON_CACHE_SIZE = 64
+_SKELETON_CACHE = OrderedDict()
+_SKELETON_CACHE_LOCK = threading.Lock()
+
+
+class _CompanySkeleton:
+    """Fragmentos precompilados de una empresa que se copian en cada factura."""
+
+    __slots__ = ('version', 'nif', 'name', 'envelope', 'sistema')
+
+    def __init__(self, version, nif, name, envelope, sistema):
+        self.version = version
+        self.nif = nif
+        self.name = name
+        self.envelope = envelope
+        self.sistema = sistema
+
+
+def drop_verifactu_skeletons(dbname, company_ids):
+    with _SKELETON_CACHE_LOCK:
+        for company_id in company_ids:
+            _SKELETON_CACHE.pop((dbname, company_id), None)
+
+# Esquemas compilados por proceso: {clave: (XMLSchema, lock)}
+_SCHEMA_CACHE = {}
+_SCHEMA_CACHE_LOCK = threading.Lock()
+
 class VeriFactuXMLGeneration(models.Model):
     _inherit = 'account.move'
 
@@ -24,214 +89,385 @@ class VeriFactuXMLGeneration(models.Model):
             raise UserError(_("El NIF/CIF '%s' debe tener exactamente 9 caracteres después de limpiar.") % cleaned)
         return cleaned
 
-    def _generate_verifactu_xml(self):
-        self.ensure_one()
-        invoice = self
+    def _get_verifactu_skeleton(self, company):
+        """
+        Devuelve los fragmentos constantes de la empresa: envelope con
+        namespaces, schemaLocation y Cabecera/ObligadoEmision, el bloque
+        SistemaInformatico y el NIF ya limpio.
+        """
+        key = (self.env.cr.dbname, company.id)
+        version = (str(company.write_date), company.name or '', company.vat or '')
+        with _SKELETON_CACHE_LOCK:
+            skeleton = _SKELETON_CACHE.get(key)
+            if skeleton and skeleton.version == version:
+                _SKELETON_CACHE.move_to_end(key)
+                return skeleton
+
+        nif = self._clean_vat(company.vat)
+
+        envelope = etree.Element(_q('soapenv', 'Envelope'), nsmap=NAMESPACES)
+        envelope.set(_q('xsi', 'schemaLocation'), ' '.join([
+            NAMESPACES['sum'], '/l10n_es_verifactu/static/xsd/SuministroLR.xsd',
+            NAMESPACES['sum1'], '/l10n_es_verifactu/static/xsd/SuministroInformacion.xsd'
+        ]))
 
-        # Validación de impuestos 
-        if not any(line.tax_ids for line in invoice.invoice_line_ids):
-            raise UserError(_("La factura debe tener al menos un impuesto para poder enviarse a la AEAT (DetalleDesglose obligatorio)."))
-
-        # Configuración de namespaces 
-        namespaces = {
-            'soapenv': 'http://schemas.xmlsoap.org/soap/envelope/',
-            'sum': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd',
-            'sum1': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroInformacion.xsd',
-            'xsi': 'http://www.w3.org/2001/XMLSchema-instance'
+        # Cuerpo del XML 
+        _sub(envelope, 'soapenv', 'Header')
+        body = _sub(envelope, 'soapenv', 'Body')
+        reg_factu = _sub(body, 'sum', 'RegFactuSistemaFacturacion')
+        cabecera = _sub(reg_factu, 'sum', 'Cabecera')
+        obligado_emision = _sub(cabecera, 'sum1', 'ObligadoEmision')
+        _sub(obligado_emision, 'sum1', 'NombreRazon', company.name or '')
+        _sub(obligado_emision, 'sum1', 'NIF', nif)
+
+        sistema = etree.Element(_q('sum1', 'SistemaInformatico'), nsmap=NAMESPACES)
+        _sub(sistema, 'sum1', 'NombreRazon', 'Odoo')
+        _sub(sistema, 'sum1', 'NIF', nif)
+        _sub(sistema, 'sum1', 'NombreSistemaInformatico', 'Odoo VeriFactu')
+        _sub(sistema, 'sum1', 'IdSistemaInformatico', 'OD')
+        _sub(sistema, 'sum1', 'Version', '1.0.03')
+        _sub(sistema, 'sum1', 'NumeroInstalacion', str(company.id))
+        _sub(sistema, 'sum1', 'TipoUsoPosibleSoloVerifactu', 'N')
+        _sub(sistema, 'sum1', 'TipoUsoPosibleMultiOT', 'S')
+        _sub(sistema, 'sum1', 'IndicadorMultiplesOT', 'S')
+
+        skeleton = _CompanySkeleton(version, nif, company.name or '', envelope, sistema)
+        with _SKELETON_CACHE_LOCK:
+            _SKELETON_CACHE[key] = skeleton
+            _SKELETON_CACHE.move_to_end(key)
+            while len(_SKELETON_CACHE) > SKELETON_CACHE_SIZE:
+                _SKELETON_CACHE.popitem(last=False)
+        return skeleton
+
+    def _build_verifactu_envelope(self, company):
+        """
+        Copia el envelope precompilado de la empresa.
+        Devuelve el envelope y el nodo RegFactuSistemaFacturacion donde se
+        añaden los RegistroFactura.
+        """
+        envelope = copy.deepcopy(self._get_verifactu_skeleton(company).envelope)
+        # Envelope > Body > RegFactuSistemaFacturacion
+        reg_factu = envelope[1][0]
+        return envelope, reg_factu
+
+    def _get_verifactu_registro_anterior(self, previous=None, create_head=True):
+        """
+        Datos del registro anterior de la cadena, o None si es el primero.
+        ``previous`` es la factura anterior del mismo lote, aún sin enviar.
+        Una factura ya encadenada conserva su registro anterior; el resto
+        encadena con la cabeza ``verifactu.chain`` de la empresa, que el envío
+        bloquea (FOR UPDATE) en su misma transacción. Con ``create_head=False``
+        no se crea la cabeza si aún no existe: se encadena con el último envío
+        registrado, como haría la cabeza al crearse.
+        """
+        self.ensure_one()
+        if previous:
+            return {
+                'IDEmisorFactura': self._get_verifactu_skeleton(previous.company_id).nif,
+                'NumSerieFactura': previous.name,
+                'FechaExpedicionFactura': previous.invoice_date.strftime('%d-%m-%Y'),
+                'Huella': previous.verifactu_hash or '',
+            }
+        if self.verifactu_chain_seq:
+            prev_move = self.verifactu_chain_prev_id
+            if not prev_move:
+                return None
+            return self._get_verifactu_registro_anterior(previous=prev_move)
+
+        Chain = self.env['verifactu.chain'].sudo()
+        head = Chain._get_head(self.company_id, create=create_head)
+        if not head:
+            last_move = Chain._find_last_registered(self.company_id)
+            return self._get_verifactu_registro_anterior(previous=last_move) if last_move else None
+        if not head.last_number:
+            return None
+        return {
+            'IDEmisorFactura': head.last_nif,
+            'NumSerieFactura': head.last_number,
+            'FechaExpedicionFactura': head.last_date.strftime('%d-%m-%Y'),
+            'Huella': head.last_hash or '',
         }
 
-        # Creación del envelope 
-        envelope = ET.Element(
-            'soapenv:Envelope',
-            attrib={
-                'xmlns:soapenv': namespaces['soapenv'],
-                'xmlns:sum': namespaces['sum'],
-                'xmlns:sum1': namespaces['sum1'],
-                'xmlns:xsi': namespaces['xsi'],
-                'xsi:schemaLocation': ' '.join([
-                    namespaces['sum'], '/l10n_es_verifactu/static/xsd/SuministroLR.xsd',
-                    namespaces['sum1'], '/l10n_es_verifactu/static/xsd/SuministroInformacion.xsd'
-                ])
-            }
-        )
+    # Datos de la factura que el RegistroAlta exige. Se comprueban también al
+    # encolar y antes de cada envío: una factura incorrecta no hace fallar al lote
+    def _check_verifactu_registro_alta(self):
+        for invoice in self:
+            # Validación de impuestos 
+            if not any(line.tax_ids for line in invoice.invoice_line_ids):
+                raise UserError(_("La factura debe tener al menos un impuesto para poder enviarse a la AEAT (DetalleDesglose obligatorio)."))
+            invoice._clean_vat(invoice.company_id.vat)
+            invoice._clean_vat(invoice.partner_id.vat)
+
+    def _append_verifactu_registro_alta(self, reg_factu, previous=None, create_head=True):
+        """
+        Añade el RegistroFactura/RegistroAlta de la factura a ``reg_factu``.
+        ``previous`` permite encadenar con una factura del mismo lote que
+        todavía no se ha enviado y ``create_head`` indica si se puede crear
+        la cabeza de la cadena (ver ``_get_verifactu_registro_anterior``).
+        """
+        self.ensure_one()
+        invoice = self
+        skeleton = self._get_verifactu_skeleton(invoice.company_id)
+        invoice._check_verifactu_registro_alta()
 
-        # Cuerpo del XML 
-        ET.SubElement(envelope, 'soapenv:Header')
-        body = ET.SubElement(envelope, 'soapenv:Body')
-        reg_factu = ET.SubElement(body, 'sum:RegFactuSistemaFacturacion')
-        cabecera = ET.SubElement(reg_factu, 'sum:Cabecera')
-        obligado_emision = ET.SubElement(cabecera, 'sum1:ObligadoEmision')
-        ET.SubElement(obligado_emision, 'sum1:NombreRazon').text = saxutils.escape(invoice.company_id.name or '')
-        ET.SubElement(obligado_emision, 'sum1:NIF').text = self._clean_vat(invoice.company_id.vat)
-
-        registro_factura = ET.SubElement(reg_factu, 'sum:RegistroFactura')
-        registro_alta = ET.SubElement(registro_factura, 'sum1:RegistroAlta')
-        ET.SubElement(registro_alta, 'sum1:IDVersion').text = '1.0'
+        registro_factura = _sub(reg_factu, 'sum', 'RegistroFactura')
+        registro_alta = _sub(registro_factura, 'sum1', 'RegistroAlta')
+        _sub(registro_alta, 'sum1', 'IDVersion', '1.0')
 
         # Sección IDFactura 
-        id_factura = ET.SubElement(registro_alta, 'sum1:IDFactura')
-        ET.SubElement(id_factura, 'sum1:IDEmisorFactura').text = self._clean_vat(invoice.company_id.vat)
-        ET.SubElement(id_factura, 'sum1:NumSerieFactura').text = invoice.name
-        ET.SubElement(id_factura, 'sum1:FechaExpedicionFactura').text = invoice.invoice_date.strftime('%d-%m-%Y')
+        id_factura = _sub(registro_alta, 'sum1', 'IDFactura')
+        _sub(id_factura, 'sum1', 'IDEmisorFactura', skeleton.nif)
+        _sub(id_factura, 'sum1', 'NumSerieFactura', invoice.name)
+        _sub(id_factura, 'sum1', 'FechaExpedicionFactura', invoice.invoice_date.strftime('%d-%m-%Y'))
 
         # Datos básicos 
-        ET.SubElement(registro_alta, 'sum1:NombreRazonEmisor').text = saxutils.escape(invoice.company_id.name or '')
-        ET.SubElement(registro_alta, 'sum1:TipoFactura').text = 'F1'
+        _sub(registro_alta, 'sum1', 'NombreRazonEmisor', skeleton.name)
+        if invoice.verifactu_subsanacion:
+            # Registro ya aceptado que se vuelve a remitir con datos corregidos
+            _sub(registro_alta, 'sum1', 'Subsanacion', 'S')
+        _sub(registro_alta, 'sum1', 'TipoFactura', 'F1')
         description = ", ".join([line.name or '' for line in invoice.invoice_line_ids][:3])
-        ET.SubElement(registro_alta, 'sum1:DescripcionOperacion').text = saxutils.escape(description[:500])
+        _sub(registro_alta, 'sum1', 'DescripcionOperacion', description[:500])
 
         # Destinatarios 
-        destinatarios = ET.SubElement(registro_alta, 'sum1:Destinatarios')
-        id_destinatario = ET.SubElement(destinatarios, 'sum1:IDDestinatario')
-        ET.SubElement(id_destinatario, 'sum1:NombreRazon').text = saxutils.escape(invoice.partner_id.name or '')
-        ET.SubElement(id_destinatario, 'sum1:NIF').text = self._clean_vat(invoice.partner_id.vat)
-
-        # Desglose de impuestos 
-        desglose = ET.SubElement(registro_alta, 'sum1:Desglose')
-        total_cuota = Decimal('0.00')
-        total_base = Decimal('0.00')
-
-        for line in invoice.invoice_line_ids:
-            base_imponible = Decimal(str(line.price_subtotal))
-            total_base += base_imponible
-
-            for tax in line.tax_ids:
-                detalle = ET.SubElement(desglose, 'sum1:DetalleDesglose')
-                ET.SubElement(detalle, 'sum1:ClaveRegimen').text = '01'
-                ET.SubElement(detalle, 'sum1:CalificacionOperacion').text = 'S1'
-
-                tipo_impositivo = Decimal(str(tax.amount))
-                ET.SubElement(detalle, 'sum1:TipoImpositivo').text = f"{tipo_impositivo:.2f}"
-                ET.SubElement(detalle, 'sum1:BaseImponibleOimporteNoSujeto').text = f"{base_imponible:.2f}"
-
-                taxes = tax.compute_all(
-                    line.price_unit,
-                    line.currency_id,
-                    line.quantity,
-                    product=line.product_id,
-                    partner=invoice.partner_id
-                )
-
-                try:
-                    tax_amount = Decimal('0.00')
-                    for t in taxes['taxes']:
-                        if t['id'] == tax.id:
-                            tax_amount += Decimal(str(t['amount']))
-                    tax_amount = tax_amount.quantize(Decimal('0.00'), rounding=ROUND_HALF_UP)
-                    total_cuota += tax_amount  
-                except Exception as e:
-                    _logger.warning("Error al calcular impuesto %s: %s", tax.name, str(e))
-                    tax_amount = Decimal('0.00')
-
-                ET.SubElement(detalle, 'sum1:CuotaRepercutida').text = f"{tax_amount:.2f}"
-
-        
-        ET.SubElement(registro_alta, 'sum1:CuotaTotal').text = f"{total_cuota:.2f}"
-        ET.SubElement(registro_alta, 'sum1:ImporteTotal').text = f"{(total_base + total_cuota):.2f}"
-
-        
-        encadenamiento = ET.SubElement(registro_alta, 'sum1:Encadenamiento')
-        registro_anterior = ET.SubElement(encadenamiento, 'sum1:RegistroAnterior')
-        
-        last_invoice = self.search([
-            ('company_id', '=', invoice.company_id.id),
-            ('verifactu_sent', '=', True),
-            ('id', '!=', invoice.id)
-        ], order='verifactu_sent_date desc', limit=1)
-
-        if last_invoice:
-            ET.SubElement(registro_anterior, 'sum1:IDEmisorFactura').text = self._clean_vat(last_invoice.company_id.vat)
-            ET.SubElement(registro_anterior, 'sum1:NumSerieFactura').text = last_invoice.name
-            ET.SubElement(registro_anterior, 'sum1:FechaExpedicionFactura').text = last_invoice.invoice_date.strftime('%d-%m-%Y')
-            ET.SubElement(registro_anterior, 'sum1:Huella').text = last_invoice.verifactu_hash or ''
+        destinatarios = _sub(registro_alta, 'sum1', 'Destinatarios')
+        id_destinatario = _sub(destinatarios, 'sum1', 'IDDestinatario')
+        _sub(id_destinatario, 'sum1', 'NombreRazon', invoice.partner_id.name or '')
+        _sub(id_destinatario, 'sum1', 'NIF', self._clean_vat(invoice.partner_id.vat))
+
+        # Desglose de impuestos: una fila por tipo impositivo, régimen y calificación
+        breakdown = invoice._get_verifactu_tax_breakdown()
+        desglose = _sub(registro_alta, 'sum1', 'Desglose')
+        for row in breakdown['rows']:
+            detalle = _sub(desglose, 'sum1', 'DetalleDesglose')
+            _sub(detalle, 'sum1', 'ClaveRegimen', row['clave_regimen'])
+            _sub(detalle, 'sum1', 'CalificacionOperacion', row['calificacion'])
+            _sub(detalle, 'sum1', 'TipoImpositivo', row['tipo_impositivo'])
+            _sub(detalle, 'sum1', 'BaseImponibleOimporteNoSujeto', format_cents(row['base']))
+            _sub(detalle, 'sum1', 'CuotaRepercutida', format_cents(row['cuota']))
+
+        _sub(registro_alta, 'sum1', 'CuotaTotal', format_cents(breakdown['cuota']))
+        _sub(registro_alta, 'sum1', 'ImporteTotal', format_cents(breakdown['base'] + breakdown['cuota']))
+
+        encadenamiento = _sub(registro_alta, 'sum1', 'Encadenamiento')
+        anterior = invoice._get_verifactu_registro_anterior(previous=previous, create_head=create_head)
+        if anterior:
+            registro_anterior = _sub(encadenamiento, 'sum1', 'RegistroAnterior')
+            for tag in ('IDEmisorFactura', 'NumSerieFactura', 'FechaExpedicionFactura', 'Huella'):
+                _sub(registro_anterior, 'sum1', tag, anterior[tag])
         else:
-            ET.SubElement(registro_anterior, 'sum1:IDEmisorFactura').text = self._clean_vat(invoice.company_id.vat)
-            ET.SubElement(registro_anterior, 'sum1:NumSerieFactura').text = 'INITIAL'
-            ET.SubElement(registro_anterior, 'sum1:FechaExpedicionFactura').text = invoice.invoice_date.strftime('%d-%m-%Y')
-            ET.SubElement(registro_anterior, 'sum1:Huella').text = 'INITIAL'
+            # Primer registro de la cadena de la empresa: no tiene registro anterior
+            _sub(encadenamiento, 'sum1', 'PrimerRegistro', 'S')
 
         # Resto de elementos 
-        sistema = ET.SubElement(registro_alta, 'sum1:SistemaInformatico')
-        ET.SubElement(sistema, 'sum1:NombreRazon').text = saxutils.escape('Odoo')
-        ET.SubElement(sistema, 'sum1:NIF').text = self._clean_vat(invoice.company_id.vat)
-        ET.SubElement(sistema, 'sum1:NombreSistemaInformatico').text = 'Odoo VeriFactu'
-        ET.SubElement(sistema, 'sum1:IdSistemaInformatico').text = 'OD'
-        ET.SubElement(sistema, 'sum1:Version').text = '1.0.03'
-        ET.SubElement(sistema, 'sum1:NumeroInstalacion').text = str(invoice.company_id.id)
-        ET.SubElement(sistema, 'sum1:TipoUsoPosibleSoloVerifactu').text = 'N'
-        ET.SubElement(sistema, 'sum1:TipoUsoPosibleMultiOT').text = 'S'
-        ET.SubElement(sistema, 'sum1:IndicadorMultiplesOT').text = 'S'
-
-        ET.SubElement(registro_alta, 'sum1:FechaHoraHusoGenRegistro').text = fields.Datetime.now().strftime('%Y-%m-%dT%H:%M:%S+01:00')
-        ET.SubElement(registro_alta, 'sum1:TipoHuella').text = '01'
-        ET.SubElement(registro_alta, 'sum1:Huella').text = invoice.verifactu_hash or ''
-
-        # Generación del XML 
-        xml_str = ET.tostring(envelope, encoding='utf-8', method='xml')
-        dom = minidom.parseString(xml_str)
-        pretty_xml = dom.toprettyxml(indent="  ", encoding='utf-8').decode('utf-8')
-        
-        # return pretty_xml
+        registro_alta.append(copy.deepcopy(skeleton.sistema))
+
+        _sub(registro_alta, 'sum1', 'FechaHoraHusoGenRegistro',
+             invoice.verifactu_gen_datetime or verifactu_timestamp(fields.Datetime.now()))
+        _sub(registro_alta, 'sum1', 'TipoHuella', '01')
+        _sub(registro_alta, 'sum1', 'Huella', invoice.verifactu_hash or '')
+        return registro_factura
+
+    @timed_stage('sign')
+    def _sign_verifactu_envelope(self, envelope):
+        """
+        Firma el envelope (árbol lxml) con el certificado de la empresa y
+        devuelve el árbol firmado, sin serializarlo.
+        La firma se registra en el ``verifactu.signature`` de cada factura.
+        """
+        company = self.company_id
+
         # Firma del XML 
         try:
-            cert_pem = invoice.company_id.verifactu_cert_pem
-            key_pem = invoice.company_id.verifactu_key_pem
-            key_pass = invoice.company_id.verifactu_key_password
+            cert_pem = company.verifactu_cert_pem
+            key_pem = company.verifactu_key_pem
+            key_pass = company.verifactu_key_password
 
             if not cert_pem or not key_pem:
                 raise UserError(_("Certificado o clave privada no configurados en los ajustes de la empresa."))
 
-            signature_record = self.env['verifactu.signature'].search([('move_id', '=', invoice.id)], limit=1)
-            if not signature_record:
-                signature_record = self.env['verifactu.signature'].create({
-                    'move_id': invoice.id,
-                })
+            signatures = self.env['verifactu.signature'].search([('move_id', 'in', self.ids)])
+            missing = self - signatures.move_id
+            if missing:
+                signatures |= self.env['verifactu.signature'].create([
+                    {'move_id': invoice.id} for invoice in missing
+                ])
 
-            signed_xml = signature_record._sign_verifactu_xml(
-                xml_str=pretty_xml,
+            return signatures._sign_verifactu_xml(
+                xml_str=envelope,
                 cert_pem=cert_pem,
                 key_pem=key_pem,
                 key_pass=key_pass,
             )
-            return signed_xml
 
         except Exception as e:
             _logger.error("Error al firmar o validar el XML: %s", str(e))
             raise UserError(_("Error al firmar o validar el XML para VeriFactu: %s") % str(e))
 
+    @timed_stage('xml')
+    def _build_verifactu_unsigned_tree(self, create_head=True):
+        self.ensure_one()
+        envelope, reg_factu = self._build_verifactu_envelope(self.company_id)
+        self._append_verifactu_registro_alta(reg_factu, create_head=create_head)
+        return envelope
 
-    def _validate_xml_against_schema(self, xml_data):
+    def _generate_verifactu_tree(self, create_head=True):
+        """Árbol lxml firmado de la factura, listo para validar y serializar."""
         self.ensure_one()
-        xsd_path = self.env['ir.config_parameter'].sudo().get_param('verifactu.xsd_path')
-        if not xsd_path or not os.path.isfile(xsd_path):
+        return self._sign_verifactu_envelope(self._build_verifactu_unsigned_tree(create_head=create_head))
+
+    def _generate_verifactu_xml(self):
+        return serialize_verifactu_xml(self._generate_verifactu_tree())
+
+    def action_sign_verifactu_bulk(self):
+        """
+        Firma en bloque el XML de cada factura (ver ``_sign_verifactu_xml_bulk``);
+        el XML firmado queda guardado para el envío.
+        """
+        for company in self.company_id:
+            invoices = self.filtered(lambda m: m.company_id == company)
+            trees = {invoice: invoice._build_verifactu_unsigned_tree() for invoice in invoices}
+            self.env['verifactu.signature']._sign_verifactu_xml_bulk(company, trees)
+        for invoice in self:
+            invoice.message_post(body="✅ Factura firmada electrónicamente con éxito")
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Firma exitosa',
+                'message': '%s facturas firmadas electrónicamente' % len(self),
+                'type': 'success',
+                'sticky': False,
+            }
+        }
+
+    @timed_stage('xml')
+    def _split_verifactu_batches(self, first_only=False):
+        """
+        Reparte las facturas en lotes enviables: una sola empresa por lote,
+        como máximo VERIFACTU_BATCH_LIMIT registros y sin superar el tamaño
+        configurado en ``verifactu.batch_max_bytes``. Con ``first_only`` se
+        detiene al cerrar el primer lote.
+        Devuelve una lista de tuplas (facturas, envelope sin firmar).
+        """
+        max_bytes = int(self.env['ir.config_parameter'].sudo().get_param(
+            'verifactu.batch_max_bytes', VERIFACTU_BATCH_MAX_BYTES))
+        batches = []
+        for company in self.company_id:
+            invoices = self.filtered(lambda m: m.company_id == company)
+            envelope, reg_factu = self._build_verifactu_envelope(company)
+            batch = self.browse()
+            size = len(etree.tostring(envelope))
+            previous = None
+            for invoice in invoices:
+                registro = invoice._append_verifactu_registro_alta(reg_factu, previous=previous)
+                registro_size = len(etree.tostring(registro))
+                if batch and (len(batch) >= VERIFACTU_BATCH_LIMIT or size + registro_size > max_bytes):
+                    # El registro no cabe: se cierra el lote y se abre uno nuevo
+                    reg_factu.remove(registro)
+                    batches.append((batch, envelope))
+                    if first_only:
+                        return batches
+                    envelope, reg_factu = self._build_verifactu_envelope(company)
+                    reg_factu.append(registro)
+                    batch = self.browse()
+                    size = len(etree.tostring(envelope))
+                batch |= invoice
+                size += registro_size
+                previous = invoice
+            if batch:
+                batches.append((batch, envelope))
+        return batches
+
+    def _generate_verifactu_next_batch(self):
+        """
+        Genera y firma el primer lote enviable de las facturas de una empresa.
+        Los siguientes se generan después de enviarlo, encadenados con la
+        cabeza que haya dejado. Devuelve (facturas, árbol lxml firmado).
+        Una sola factura reutiliza su XML firmado guardado si no ha cambiado
+        (ver ``_get_verifactu_signed_xml``).
+        """
+        if len(self) == 1:
+            return self, etree.fromstring(self._get_verifactu_signed_xml().encode('utf-8'))
+        batch, envelope = self._split_verifactu_batches(first_only=True)[0]
+        return batch, batch._sign_verifactu_envelope(envelope)
+
+    # Facturas del lote cuyo RegistroAlta no se puede generar o no cumple el XSD
+    def _find_invalid_verifactu_records(self):
+        invalid = self.browse()
+        for invoice in self:
+            try:
+                with self.env.cr.savepoint():
+                    invoice._validate_xml_against_schema(invoice._build_verifactu_unsigned_tree())
+            except UserError as e:
+                invoice.write({'verifactu_state': 'error', 'verifactu_response': str(e)})
+                invalid |= invoice
+        return invalid
+
+    def _get_verifactu_schema(self):
+        """
+        Devuelve el XMLSchema compilado y su lock. Se usa, por orden, el XSD
+        subido en Ajustes (clave: checksum del adjunto), la ruta del parámetro
+        ``verifactu.xsd_path`` o los XSD incluidos en el módulo (clave: ruta y
+        fecha de modificación). La compilación solo ocurre una vez por proceso.
+        """
+        config = self.env['ir.config_parameter'].sudo()
+        xsd_path = None
+        cache_key = None
+
+        attachment_id = config.get_param('verifactu.xsd_attachment_id')
+        if attachment_id:
+            attachment = self.env['ir.attachment'].sudo().browse(int(attachment_id)).exists()
+            if attachment and attachment.store_fname:
+                xsd_path = attachment._full_path(attachment.store_fname)
+                cache_key = ('attachment', attachment.checksum)
+
+        if not xsd_path:
+            xsd_path = config.get_param('verifactu.xsd_path')
+            if not xsd_path or not os.path.isfile(xsd_path):
+                xsd_path = BUNDLED_XSD_PATH
+            cache_key = (xsd_path, os.path.getmtime(xsd_path))
+
+        with _SCHEMA_CACHE_LOCK:
+            cached = _SCHEMA_CACHE.get(cache_key)
+        if cached:
+            return cached
+
+        if not os.path.isfile(xsd_path):
             raise UserError("No se encontró el archivo de esquema XSD de VeriFactu. Verifica la ruta en la configuración.")
-        
+        schema = etree.XMLSchema(etree.parse(xsd_path))
+        cached = (schema, threading.Lock())
+        with _SCHEMA_CACHE_LOCK:
+            _SCHEMA_CACHE[cache_key] = cached
+        return cached
+
+    @timed_stage('validate')
+    def _validate_xml_against_schema(self, xml_data):
+        self.ensure_one()
+        schema, schema_lock = self._get_verifactu_schema()
+
         try:
-            # Parseamos todo el XML
-            xml_doc = etree.fromstring(xml_data.encode('utf-8'))
+            # Se admite el árbol lxml ya construido o el XML serializado
+            if isinstance(xml_data, etree._Element):
+                xml_doc = xml_data
+            else:
+                xml_doc = etree.fromstring(xml_data.encode('utf-8') if isinstance(xml_data, str) else xml_data)
 
             # Extraemos el cuerpo del mensaje SOAP 
-            body = xml_doc.find('.//soapenv:Body', namespaces=xml_doc.nsmap)
+            body = xml_doc.find('.//{%s}Body' % NAMESPACES['soapenv'])
 
             if body is None:
                 raise UserError("No se encontró el elemento <soapenv:Body> en el XML.")
 
-            # Tomamos el primer hijo del Body (por ejemplo, sum:RegFactuSistemaFacturacion)
+            # Validamos directamente el primer hijo del Body (sum:RegFactuSistemaFacturacion)
+            # sin serializarlo ni volver a parsearlo
             root_element_to_validate = body[0]
-
-            # Convertimos a cadena ese fragmento
-            xml_fragment = etree.tostring(root_element_to_validate, encoding='utf-8')
-
-            # Parseamos el XSD
-            xsd_doc = etree.parse(xsd_path)
-            schema = etree.XMLSchema(xsd_doc)
-
-            # Validamos solo el fragmento
-            xml_to_validate = etree.fromstring(xml_fragment)
-            if not schema.validate(xml_to_validate):
+            with schema_lock:
+                valid = schema.validate(root_element_to_validate)
                 errors = "\n".join([str(e) for e in schema.error_log])
+            if not valid:
                 raise UserError(f"El XML no es válido según el esquema XSD:\n{errors}")
 
             return True
         except Exception as e:
-            raise UserError(f"Error durante la validación del XML: {str(e)}")
\ No newline at end of file
+            raise UserError(f"Error durante la validación del XML: {str(e)}")
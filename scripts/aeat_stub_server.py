@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Simulador local del servicio SOAP VeriFactu de la AEAT, con mTLS, para
+pruebas de carga y de caídas sin red.
+
+Recibe ``RegFactuSistemaFacturacion``, lo valida contra los XSD de
+``static/xsd`` y responde con una ``RespuestaRegFactuSistemaFacturacion``
+realista (CSV, TiempoEsperaEnvio, EstadoEnvio y una RespuestaLinea por
+registro). Se pueden inyectar latencia, registros rechazados, el
+TiempoEsperaEnvio y errores HTTP 403/5xx, tanto al arrancar como en caliente
+con ``POST /_stub/config`` (JSON con las mismas claves que las opciones).
+
+Uso::
+
+    # CA, certificado de servidor (localhost) y certificado de cliente
+    python3 aeat_stub_server.py --generate-certs /tmp/aeat_stub
+
+    python3 aeat_stub_server.py --certs /tmp/aeat_stub --port 8443 \\
+        --latency 0.2 --record-error-rate 0.05 --wait 5 --http-5xx-rate 0.1
+
+En Odoo: ``verifactu.endpoint_url`` = ``https://localhost:8443/wbWTINE-CONT/swi/SistemaFacturacion/VerifactuSOAP``,
+``verifactu.endpoint_ca_file`` = ``/tmp/aeat_stub/ca.pem`` y, en la empresa,
+``client.pem`` y ``client.key`` como certificado y clave.
+
+Solo depende de lxml y cryptography (esta última para ``--generate-certs``).
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import ssl
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+_logger = logging.getLogger('aeat_stub')
+
+XSD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'xsd')
+
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+BASE_NS = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/'
+SUM_NS = BASE_NS + 'SuministroLR.xsd'
+SUM1_NS = BASE_NS + 'SuministroInformacion.xsd'
+RESP_NS = BASE_NS + 'RespuestaSuministro.xsd'
+
+# Errores de registro que se devuelven al azar (código, descripción)
+RECORD_ERRORS = [
+    ('1100', 'Valor o tipo incorrecto del campo: Huella.'),
+    ('1104', 'Valor del campo NIF del bloque IDDestinatario no es correcto.'),
+    ('2000', 'El cálculo de la huella suministrada es incorrecta.'),
+    ('3000', 'Registro de facturación duplicado.'),
+]
+
+# Parámetros inyectables (también modificables en caliente)
+DEFAULT_SETTINGS = {
+    'latency': 0.0,             # segundos fijos por petición
+    'latency_jitter': 0.0,      # segundos aleatorios añadidos (uniforme)
+    'record_error_rate': 0.0,   # fracción de registros rechazados
+    'wait': 60,                 # TiempoEsperaEnvio devuelto
+    'http_403_rate': 0.0,       # fracción de peticiones rechazadas con 403
+    'http_5xx_rate': 0.0,       # fracción de peticiones con error de servidor
+    'http_5xx_code': 503,
+    'reject_duplicates': True,  # un registro ya aceptado se rechaza con 3000
+}
+
+
+class StubState:
+    """Configuración, registros aceptados y estadísticas compartidos entre hilos."""
+
+    def __init__(self, settings, seed=None):
+        self.lock = threading.Lock()
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.random = random.Random(seed)
+        self.accepted = set()
+        self.stats = {'requests': 0, 'records': 0, 'accepted': 0, 'rejected': 0,
+                      'http_403': 0, 'http_5xx': 0, 'invalid': 0}
+
+    def update(self, values):
+        with self.lock:
+            unknown = set(values) - set(DEFAULT_SETTINGS)
+            if unknown:
+                raise ValueError('Parámetros desconocidos: %s' % ', '.join(sorted(unknown)))
+            self.settings.update(values)
+            return dict(self.settings)
+
+    def snapshot(self):
+        with self.lock:
+            return {'settings': dict(self.settings), 'stats': dict(self.stats)}
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    # random.Random no es seguro entre hilos: toda tirada pasa por el bloqueo
+    def roll(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def choice(self, seq):
+        with self.lock:
+            return self.random.choice(seq)
+
+    def uniform(self, a, b):
+        with self.lock:
+            return self.random.uniform(a, b)
+
+
+def load_schema(xsd_dir):
+    return etree.XMLSchema(etree.parse(os.path.join(xsd_dir, 'SuministroLR.xsd')))
+
+
+def _text(parent, path):
+    node = parent.find(path)
+    return node.text if node is not None and node.text else ''
+
+
+def _sub(parent, ns, tag, text=None):
+    node = etree.SubElement(parent, '{%s}%s' % (ns, tag))
+    if text is not None:
+        node.text = str(text)
+    return node
+
+
+def soap_fault(message):
+    envelope = etree.Element('{%s}Envelope' % SOAP_NS, nsmap={'env': SOAP_NS})
+    fault = _sub(_sub(envelope, SOAP_NS, 'Body'), SOAP_NS, 'Fault')
+    etree.SubElement(fault, 'faultcode').text = 'env:Client'
+    etree.SubElement(fault, 'faultstring').text = message
+    return etree.tostring(envelope, xml_declaration=True, encoding='UTF-8')
+
+
+def build_response(state, reg_factu):
+    """RespuestaRegFactuSistemaFacturacion para los registros de ``reg_factu``."""
+    settings = state.snapshot()['settings']
+    nif = _text(reg_factu, '{%s}Cabecera/{%s}ObligadoEmision/{%s}NIF' % (SUM_NS, SUM1_NS, SUM1_NS))
+    nombre = _text(reg_factu, '{%s}Cabecera/{%s}ObligadoEmision/{%s}NombreRazon' % (SUM_NS, SUM1_NS, SUM1_NS))
+
+    envelope = etree.Element('{%s}Envelope' % SOAP_NS, nsmap={'env': SOAP_NS, 'tikR': RESP_NS, 'tik': SUM1_NS})
+    respuesta = _sub(_sub(envelope, SOAP_NS, 'Body'), RESP_NS, 'RespuestaRegFactuSistemaFacturacion')
+    csv_node = _sub(respuesta, RESP_NS, 'CSV')
+    presentacion = _sub(respuesta, RESP_NS, 'DatosPresentacion')
+    _sub(presentacion, SUM1_NS, 'NIFPresentador', nif)
+    _sub(presentacion, SUM1_NS, 'TimestampPresentacion', datetime.datetime.now().astimezone().isoformat(timespec='seconds'))
+    cabecera = _sub(respuesta, RESP_NS, 'Cabecera')
+    obligado = _sub(cabecera, SUM1_NS, 'ObligadoEmision')
+    _sub(obligado, SUM1_NS, 'NombreRazon', nombre)
+    _sub(obligado, SUM1_NS, 'NIF', nif)
+    _sub(respuesta, RESP_NS, 'TiempoEsperaEnvio', int(settings['wait']))
+    estado_envio = _sub(respuesta, RESP_NS, 'EstadoEnvio')
+
+    accepted = rejected = 0
+    for alta in reg_factu.iterfind('{%s}RegistroFactura/{%s}RegistroAlta' % (SUM_NS, SUM1_NS)):
+        id_factura = alta.find('{%s}IDFactura' % SUM1_NS)
+        key = tuple(_text(id_factura, '{%s}%s' % (SUM1_NS, tag))
+                    for tag in ('IDEmisorFactura', 'NumSerieFactura', 'FechaExpedicionFactura'))
+
+        error = None
+        if state.roll(settings['record_error_rate']):
+            error = state.choice(RECORD_ERRORS[:3])
+        with state.lock:
+            if not error and settings['reject_duplicates'] and key in state.accepted:
+                error = RECORD_ERRORS[3]
+            if not error:
+                state.accepted.add(key)
+
+        linea = _sub(respuesta, RESP_NS, 'RespuestaLinea')
+        id_node = _sub(linea, RESP_NS, 'IDFactura')
+        for tag, value in zip(('IDEmisorFactura', 'NumSerieFactura', 'FechaExpedicionFactura'), key):
+            _sub(id_node, SUM1_NS, tag, value)
+        _sub(_sub(linea, RESP_NS, 'Operacion'), SUM1_NS, 'TipoOperacion', 'Alta')
+        if error:
+            rejected += 1
+            _sub(linea, RESP_NS, 'EstadoRegistro', 'Incorrecto')
+            _sub(linea, RESP_NS, 'CodigoErrorRegistro', error[0])
+            _sub(linea, RESP_NS, 'DescripcionErrorRegistro', error[1])
+        else:
+            accepted += 1
+            _sub(linea, RESP_NS, 'EstadoRegistro', 'Correcto')
+
+    if accepted and rejected:
+        estado_envio.text = 'ParcialmenteCorrecto'
+    elif accepted:
+        estado_envio.text = 'Correcto'
+    else:
+        estado_envio.text = 'Incorrecto'
+    # Solo se asigna CSV si se ha aceptado algún registro
+    if accepted:
+        csv_node.text = 'A-' + uuid.uuid4().hex[:14].upper()
+    else:
+        respuesta.remove(csv_node)
+
+    state.count('records', accepted + rejected)
+    state.count('accepted', accepted)
+    state.count('rejected', rejected)
+    return etree.tostring(envelope, xml_declaration=True, encoding='UTF-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'AEATStub/1.0'
+
+    def log_message(self, fmt, *args):
+        _logger.info("%s %s", self.address_string(), fmt % args)
+
+    def _reply(self, status, body, content_type='text/xml; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):
+        if self.path == '/_stub/stats':
+            return self._reply(200, json.dumps(self.server.state.snapshot()).encode(), 'application/json')
+        self._reply(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        state = self.server.state
+        if self.path == '/_stub/config':
+            try:
+                settings = state.update(json.loads(self._read_body() or b'{}'))
+            except ValueError as e:
+                return self._reply(400, str(e).encode(), 'text/plain; charset=utf-8')
+            _logger.info("Configuración actualizada: %s", settings)
+            return self._reply(200, json.dumps(settings).encode(), 'application/json')
+
+        data = self._read_body()
+        state.count('requests')
+        settings = state.snapshot()['settings']
+        delay = settings['latency'] + (state.uniform(0, settings['latency_jitter'])
+                                       if settings['latency_jitter'] else 0)
+        if delay:
+            time.sleep(delay)
+
+        if state.roll(settings['http_403_rate']):
+            state.count('http_403')
+            return self._reply(403, b'<html><body>403 Forbidden</body></html>', 'text/html')
+        if state.roll(settings['http_5xx_rate']):
+            state.count('http_5xx')
+            return self._reply(int(settings['http_5xx_code']), b'<html><body>Service Unavailable</body></html>', 'text/html')
+
+        try:
+            document = etree.fromstring(data)
+        except etree.XMLSyntaxError as e:
+            state.count('invalid')
+            return self._reply(500, soap_fault('XML mal formado: %s' % e))
+        reg_factu = document.find('{%s}Body/{%s}RegFactuSistemaFacturacion' % (SOAP_NS, SUM_NS))
+        if reg_factu is None:
+            state.count('invalid')
+            return self._reply(500, soap_fault('No se encontró RegFactuSistemaFacturacion en el Body.'))
+
+        schema = self.server.schema
+        with self.server.schema_lock:
+            valid = schema.validate(reg_factu)
+            errors = '; '.join(str(e) for e in schema.error_log)
+        if not valid:
+            state.count('invalid')
+            _logger.warning("Envío no válido según el XSD: %s", errors)
+            return self._reply(500, soap_fault('Error de validación del esquema: %s' % errors))
+
+        self._reply(200, build_response(state, reg_factu))
+
+
+def generate_certs(directory):
+    """CA, certificado de servidor para localhost y certificado de cliente (PEM)."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+    import ipaddress
+
+    os.makedirs(directory, exist_ok=True)
+    now = datetime.datetime.utcnow()
+
+    def new_key():
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def write(name, key, cert):
+        with open(os.path.join(directory, name + '.pem'), 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        if key is not None:
+            path = os.path.join(directory, name + '.key')
+            with open(path, 'wb') as f:
+                f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                          serialization.NoEncryption()))
+            os.chmod(path, 0o600)
+
+    def issue(common_name, key, issuer_name, issuer_key, usage, san=None, ca=False):
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+            .issuer_name(issuer_name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=365))
+            .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+        )
+        if usage:
+            builder = builder.add_extension(x509.ExtendedKeyUsage([usage]), critical=False)
+        if san:
+            builder = builder.add_extension(x509.SubjectAlternativeName(san), critical=False)
+        return builder.sign(issuer_key, hashes.SHA256())
+
+    ca_key = new_key()
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'AEAT Stub CA')])
+    ca_cert = issue('AEAT Stub CA', ca_key, ca_name, ca_key, None, ca=True)
+    write('ca', None, ca_cert)
+
+    server_key = new_key()
+    write('server', server_key, issue('localhost', server_key, ca_name, ca_key, ExtendedKeyUsageOID.SERVER_AUTH, san=[
+        x509.DNSName('localhost'), x509.IPAddress(ipaddress.ip_address('127.0.0.1')),
+    ]))
+
+    client_key = new_key()
+    write('client', client_key, issue('B12345678 PRUEBAS', client_key, ca_name, ca_key, ExtendedKeyUsageOID.CLIENT_AUTH))
+    print("Certificados generados en %s: ca.pem, server.pem/.key, client.pem/.key" % directory)
+
+
+def build_server(args, settings):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.path.join(args.certs, 'server.pem'), os.path.join(args.certs, 'server.key'))
+    # mTLS: sin certificado de cliente emitido por la CA no hay conexión
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(os.path.join(args.certs, 'ca.pem'))
+
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    # El handshake se hace en el hilo de cada conexión, no en el bucle de accept
+    server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    server.daemon_threads = True
+    server.state = StubState(settings, seed=args.seed)
+    server.schema = load_schema(args.xsd_dir)
+    server.schema_lock = threading.Lock()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--generate-certs', metavar='DIR', help="Genera CA y certificados de prueba y termina")
+    parser.add_argument('--certs', metavar='DIR', help="Directorio con ca.pem, server.pem y server.key")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--xsd-dir', default=XSD_DIR)
+    parser.add_argument('--seed', type=int, help="Semilla para reproducir los fallos inyectados")
+    parser.add_argument('--latency', type=float, default=DEFAULT_SETTINGS['latency'])
+    parser.add_argument('--latency-jitter', type=float, default=DEFAULT_SETTINGS['latency_jitter'])
+    parser.add_argument('--record-error-rate', type=float, default=DEFAULT_SETTINGS['record_error_rate'])
+    parser.add_argument('--wait', type=int, default=DEFAULT_SETTINGS['wait'], help="TiempoEsperaEnvio (segundos)")
+    parser.add_argument('--http-403-rate', type=float, default=DEFAULT_SETTINGS['http_403_rate'])
+    parser.add_argument('--http-5xx-rate', type=float, default=DEFAULT_SETTINGS['http_5xx_rate'])
+    parser.add_argument('--http-5xx-code', type=int, default=DEFAULT_SETTINGS['http_5xx_code'])
+    parser.add_argument('--allow-duplicates', action='store_true', help="No rechazar registros ya aceptados")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.generate_certs:
+        generate_certs(args.generate_certs)
+        return
+    if not args.certs:
+        parser.error("Indique --certs (o genere los certificados con --generate-certs)")
+
+    settings = {key: getattr(args, key) for key in DEFAULT_SETTINGS if hasattr(args, key)}
+    settings['reject_duplicates'] = not args.allow_duplicates
+    server = build_server(args, settings)
+    _logger.info("Simulador AEAT escuchando en https://%s:%s (%s)", args.host, args.port, server.state.settings)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+from . import test_verifactu_artifact
+from . import test_verifactu_batch
+from . import test_verifactu_benchmark
+from . import test_verifactu_chain
+from . import test_verifactu_chain_verifier
+from . import test_verifactu_circuit
+from . import test_verifactu_export
+from . import test_verifactu_hash
+from . import test_verifactu_payload
+from . import test_verifactu_response
+from . import test_verifactu_retry
+from . import test_verifactu_scan
+from . import test_verifactu_signature
+from . import test_verifactu_submission
+from . import test_verifactu_tiempo_espera
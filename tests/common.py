@@ -0,0 +1,148 @@
+"""
+Utilidades comunes de los tests VeriFactu: credenciales de usar y tirar,
+respuestas de la AEAT sintéticas y un ``_send_to_aeat`` simulado que
+responde a cada registro enviado sin salir a la red.
+"""
+import datetime
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from lxml import etree
+
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+
+from ..models.verifactu_aeat_integration import RESP_NS
+from ..models.verifactu_xml_generation import NAMESPACES
+
+SOAP_NS = NAMESPACES['soapenv']
+SUM1_NS = NAMESPACES['sum1']
+# Espacio de nombres de la RespuestaSuministro, sin llaves
+RESP_URI = RESP_NS[1:-1]
+
+
+def _throwaway_credentials():
+    """Clave RSA y certificado autofirmado generados para la prueba (PEM)."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'VeriFactu Test')])
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .sign(key, hashes.SHA256())
+    )
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM).decode()
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    return cert_pem, key_pem
+
+
+def aeat_response(lines, tiempo_espera=0, csv='A-TEST0000000001'):
+    """
+    RespuestaRegFactuSistemaFacturacion con una RespuestaLinea por cada
+    (número de serie, código de error o None) de ``lines``.
+    """
+    def sub(parent, ns, tag, text=None):
+        node = etree.SubElement(parent, '{%s}%s' % (ns, tag))
+        if text is not None:
+            node.text = str(text)
+        return node
+
+    envelope = etree.Element('{%s}Envelope' % SOAP_NS, nsmap={'env': SOAP_NS, 'tikR': RESP_URI, 'tik': SUM1_NS})
+    respuesta = sub(sub(envelope, SOAP_NS, 'Body'), RESP_URI, 'RespuestaRegFactuSistemaFacturacion')
+    sub(respuesta, RESP_URI, 'CSV', csv)
+    sub(respuesta, RESP_URI, 'TiempoEsperaEnvio', tiempo_espera)
+    estado_envio = sub(respuesta, RESP_URI, 'EstadoEnvio')
+    for num_serie, codigo in lines:
+        linea = sub(respuesta, RESP_URI, 'RespuestaLinea')
+        sub(sub(linea, RESP_URI, 'IDFactura'), SUM1_NS, 'NumSerieFactura', num_serie)
+        if codigo:
+            sub(linea, RESP_URI, 'EstadoRegistro', 'Incorrecto')
+            sub(linea, RESP_URI, 'CodigoErrorRegistro', codigo)
+            sub(linea, RESP_URI, 'DescripcionErrorRegistro', 'Error %s' % codigo)
+        else:
+            sub(linea, RESP_URI, 'EstadoRegistro', 'Correcto')
+    rejected = sum(1 for _num_serie, codigo in lines if codigo)
+    if not rejected:
+        estado_envio.text = 'Correcto'
+    elif rejected < len(lines):
+        estado_envio.text = 'ParcialmenteCorrecto'
+    else:
+        estado_envio.text = 'Incorrecto'
+    return etree.tostring(envelope, encoding='unicode')
+
+
+def sent_records(xml_data):
+    """RegistroAlta de un envío: lista de (número de serie, Subsanacion o None)."""
+    root = etree.fromstring(xml_data.encode('utf-8'))
+    records = []
+    for alta in root.iterfind('.//{%s}RegistroAlta' % SUM1_NS):
+        subsanacion = alta.find('{%s}Subsanacion' % SUM1_NS)
+        records.append((
+            alta.find('{%s}IDFactura/{%s}NumSerieFactura' % (SUM1_NS, SUM1_NS)).text,
+            subsanacion.text if subsanacion is not None else None,
+        ))
+    return records
+
+
+class VerifactuTestCommon(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super().setUpClass(chart_template_ref=chart_template_ref)
+        cert_pem, key_pem = _throwaway_credentials()
+        cls.company_data['company'].write({
+            'vat': 'ESB12345678',
+            'verifactu_cert_pem': cert_pem,
+            'verifactu_key_pem': key_pem,
+        })
+        cls.partner_a.vat = '12345678Z'
+
+    def _create_invoices(self, count, post=True):
+        """``count`` facturas de venta a ``partner_a`` con el impuesto de venta por defecto."""
+        return self.env['account.move'].concat(*(
+            self.init_invoice('out_invoice', amounts=[100.0 + i],
+                              taxes=self.company_data['default_tax_sale'], post=post)
+            for i in range(count)
+        ))
+
+    @contextmanager
+    def _mock_aeat(self, rejections=None, tiempo_espera=0, results=None):
+        """
+        Sustituye ``_send_to_aeat``. Por defecto acepta todos los registros;
+        ``rejections`` asigna un código de error a ciertos números de serie y
+        ``results`` es una lista de resultados de ``_send_to_aeat`` que se
+        devuelven, por orden, antes de volver a aceptar. Produce la lista de
+        envíos recibidos: [(facturas, registros de ``sent_records``)].
+        """
+        rejections = rejections or {}
+        results = list(results or [])
+        calls = []
+
+        def _send_to_aeat(moves, xml_data):
+            records = sent_records(xml_data)
+            calls.append((moves, records))
+            if results:
+                return results.pop(0)
+            return {
+                'success': True,
+                'status_code': 200,
+                'response': aeat_response(
+                    [(number, rejections.get(number)) for number, _subsanacion in records],
+                    tiempo_espera=tiempo_espera,
+                ),
+            }
+
+        with patch.object(type(self.env['account.move']), '_send_to_aeat', _send_to_aeat):
+            yield calls
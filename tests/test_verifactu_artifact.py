@@ -0,0 +1,31 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuArtifact(VerifactuTestCommon):
+
+    def test_download_does_not_create_chain_head(self):
+        invoice = self._create_invoices(1)
+        Chain = self.env['verifactu.chain']
+        self.assertFalse(Chain._get_head(invoice.company_id, create=False))
+
+        xml_data = invoice._get_verifactu_signed_xml()
+
+        # Descargar el XML es una lectura: la cadena sigue sin cabeza
+        self.assertIn('PrimerRegistro', xml_data)
+        self.assertFalse(Chain._get_head(invoice.company_id, create=False))
+
+    def test_signed_xml_reused_until_data_changes(self):
+        invoice = self._create_invoices(1)
+        xml_data = invoice._get_verifactu_signed_xml()
+
+        Move = type(self.env['account.move'])
+        with patch.object(Move, '_sign_verifactu_envelope', side_effect=AssertionError('re-firmado')):
+            self.assertEqual(invoice._get_verifactu_signed_xml(), xml_data)
+
+        self.partner_a.name = 'Cliente renombrado'
+        self.assertNotEqual(invoice._get_verifactu_signed_xml(), xml_data)
@@ -0,0 +1,123 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+from odoo.tools import mute_logger
+
+from .common import VerifactuTestCommon
+
+STATUS_LOGGER = 'odoo.addons.l10n_es_verifactu.models.verifactu_status_views'
+
+RETRY_RESULT = {
+    'success': False,
+    'error': 'La AEAT respondió con un error 503.',
+    'status_code': 503,
+    'retry': True,
+}
+FAULT_RESULT = {
+    'success': False,
+    'error': 'La AEAT rechazó el envío: Codigo[4102]',
+    'status_code': 500,
+}
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuBatch(VerifactuTestCommon):
+
+    def _one_invoice_per_batch(self):
+        # Ningún segundo registro cabe en el lote: un envío por factura
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.batch_max_bytes', 1)
+
+    def test_batch_accepted_in_chain_order(self):
+        invoices = self._create_invoices(3)
+        with self._mock_aeat() as calls:
+            failed, retry, held, deferred = invoices._send_verifactu_batches()
+
+        self.assertFalse(failed | retry | held | deferred)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][1], [(invoice.name, None) for invoice in invoices])
+        self.assertEqual(invoices.mapped('verifactu_state'), ['accepted'] * 3)
+        self.assertFalse(invoices[0].verifactu_prev_hash)
+        self.assertEqual(invoices[1].verifactu_prev_hash, invoices[0].verifactu_hash)
+        self.assertEqual(invoices[2].verifactu_prev_hash, invoices[1].verifactu_hash)
+
+    def test_split_batches_chain_on_previous_batch(self):
+        self._one_invoice_per_batch()
+        invoices = self._create_invoices(3)
+        with self._mock_aeat() as calls:
+            invoices._send_verifactu_batches()
+
+        self.assertEqual([records for _moves, records in calls], [[(invoice.name, None)] for invoice in invoices])
+        self.assertEqual(invoices[1].verifactu_prev_hash, invoices[0].verifactu_hash)
+        self.assertEqual(invoices[2].verifactu_prev_hash, invoices[1].verifactu_hash)
+
+    def test_split_batches_respect_size(self):
+        invoices = self._create_invoices(3)
+        self.assertEqual(len(invoices._split_verifactu_batches()), 1)
+        self._one_invoice_per_batch()
+        batches = invoices._split_verifactu_batches()
+        self.assertEqual([batch for batch, _envelope in batches], list(invoices))
+        self.assertEqual(len(invoices._split_verifactu_batches(first_only=True)), 1)
+
+    def test_hashes_computed_once_per_chain(self):
+        self._one_invoice_per_batch()
+        invoices = self._create_invoices(3)
+        Move = type(self.env['account.move'])
+        with patch.object(Move, '_generate_verifactu_hash', autospec=True,
+                          side_effect=Move._generate_verifactu_hash) as mock_hash, \
+                self._mock_aeat() as calls:
+            invoices._send_verifactu_batches()
+
+        # Tres envíos, pero las huellas no se recalculan después de cada uno
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([call.args[0] for call in mock_hash.call_args_list], [invoices])
+
+    def test_rejection_resends_following_records(self):
+        invoices = self._create_invoices(3)
+        first, rejected, last = invoices
+        with self._mock_aeat(rejections={rejected.name: '1100'}) as calls:
+            failed, _retry, _held, _deferred = invoices._send_verifactu_batches()
+
+        # El registro aceptado tras el rechazo se encadena de nuevo y se subsana
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[1][1], [(last.name, 'S')])
+        self.assertEqual(failed, rejected)
+        self.assertEqual(invoices.mapped('verifactu_state'), ['accepted', 'rejected', 'accepted'])
+        self.assertEqual(last.verifactu_prev_hash, first.verifactu_hash)
+        self.assertFalse(last.verifactu_subsanacion)
+
+    def test_rejected_last_record_rehashes_next_batch(self):
+        self._one_invoice_per_batch()
+        invoices = self._create_invoices(2)
+        first, following = invoices
+        with self._mock_aeat(rejections={first.name: '1100'}) as calls:
+            invoices._send_verifactu_batches()
+
+        # La siguiente factura ya no encadena con la rechazada
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(following.verifactu_state, 'accepted')
+        self.assertFalse(following.verifactu_prev_hash)
+
+    @mute_logger(STATUS_LOGGER)
+    def test_failed_batch_stops_the_company(self):
+        self._one_invoice_per_batch()
+        invoices = self._create_invoices(2)
+        with self._mock_aeat(results=[FAULT_RESULT]) as calls:
+            failed, retry, held, deferred = invoices._send_verifactu_batches()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(failed, invoices[0])
+        self.assertFalse(retry | held)
+        self.assertEqual(deferred, invoices[1])
+
+    @mute_logger(STATUS_LOGGER)
+    def test_retryable_failure_holds_the_rest(self):
+        self._one_invoice_per_batch()
+        invoices = self._create_invoices(2)
+        with self._mock_aeat(results=[RETRY_RESULT]) as calls:
+            failed, retry, held, deferred = invoices._send_verifactu_batches()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(failed, invoices[0])
+        self.assertEqual(retry, invoices[0])
+        self.assertEqual(held, invoices[1])
+        self.assertFalse(deferred)
@@ -0,0 +1,166 @@
+"""
+Benchmark de cada etapa del proceso VeriFactu con facturas sintéticas de
+1, 50 y 1000 líneas: huella, XML firmado, JSON, firma, validación XSD y QR.
+
+No forma parte de la batería estándar; se lanza con la etiqueta
+``verifactu_benchmark``::
+
+    odoo-bin -d <bd> -i l10n_es_verifactu --test-enable --stop-after-init \\
+        --test-tags verifactu_benchmark
+
+Variables de entorno:
+
+- ``VERIFACTU_BENCHMARK_OUTPUT``: fichero JSON con los resultados
+  (por defecto ``<data_dir>/verifactu_benchmark.json``).
+- ``VERIFACTU_BENCHMARK_BASELINE``: resultados de referencia; el test falla
+  si la mediana de alguna etapa empeora más de la tolerancia.
+- ``VERIFACTU_BENCHMARK_TOLERANCE``: empeoramiento admitido (0.25 = 25 %).
+- ``VERIFACTU_BENCHMARK_REPEAT``: repeticiones medidas por etapa.
+
+Para fijar una nueva referencia basta con copiar el fichero de resultados.
+"""
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import time
+
+from odoo import release
+from odoo.tests import tagged
+from odoo.tools import config
+
+from ..models.verifactu_qr import verifactu_qr_svg
+from .common import VerifactuTestCommon
+
+_logger = logging.getLogger(__name__)
+
+# Líneas de las facturas sintéticas
+LINE_COUNTS = (1, 50, 1000)
+# Ejecuciones previas no medidas (compilación del XSD, cachés por empresa)
+WARMUP = 1
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.25
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compara la mediana de cada etapa y tamaño con la referencia. Devuelve
+    la lista de regresiones (etapa, líneas, referencia, actual, ratio).
+    Las etapas o tamaños que no existen en la referencia se ignoran.
+    """
+    regressions = []
+    for stage, sizes in results['stages'].items():
+        for lines, timing in sizes.items():
+            reference = baseline.get('stages', {}).get(stage, {}).get(lines)
+            if not reference or not reference.get('median'):
+                continue
+            ratio = timing['median'] / reference['median']
+            if ratio > 1 + tolerance:
+                regressions.append((stage, lines, reference['median'], timing['median'], ratio))
+    return regressions
+
+
+@tagged('verifactu_benchmark', '-standard', '-at_install', 'post_install')
+class TestVerifactuBenchmark(VerifactuTestCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super().setUpClass(chart_template_ref=chart_template_ref)
+        cls.company_data['company'].name = 'VeriFactu Benchmark S.L.'
+        cls.invoices = {lines: cls._create_synthetic_invoice(lines) for lines in LINE_COUNTS}
+
+    @classmethod
+    def _create_synthetic_invoice(cls, line_count):
+        tax = cls.company_data['default_tax_sale']
+        invoice = cls.env['account.move'].create({
+            'move_type': 'out_invoice',
+            'partner_id': cls.partner_a.id,
+            'invoice_date': '2025-01-15',
+            'invoice_line_ids': [(0, 0, {
+                'name': f'Línea {i}',
+                'product_id': cls.product_a.id,
+                'quantity': 1 + i % 7,
+                'price_unit': 10.0 + i % 13,
+                'tax_ids': [(6, 0, tax.ids)],
+            }) for i in range(line_count)],
+        })
+        invoice.action_post()
+        invoice._generate_verifactu_hash()
+        return invoice
+
+    def _measure(self, func, setup=None):
+        """Mide ``func`` tras WARMUP ejecuciones; ``setup`` se ejecuta fuera de la medida."""
+        repeat = int(os.environ.get('VERIFACTU_BENCHMARK_REPEAT', DEFAULT_REPEAT))
+        timings = []
+        for i in range(WARMUP + repeat):
+            if setup:
+                setup()
+            # Cada ejecución lee de la base de datos, como en un envío real
+            self.env.invalidate_all()
+            start = time.perf_counter()
+            func()
+            self.env.flush_all()
+            elapsed = time.perf_counter() - start
+            if i >= WARMUP:
+                timings.append(elapsed)
+        return {
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'max': max(timings),
+            'runs': len(timings),
+        }
+
+    def _benchmark_invoice(self, invoice):
+        state = {}
+
+        def reset_hash():
+            invoice.write({'verifactu_hash': False, 'verifactu_gen_datetime': False})
+            self.env.flush_all()
+
+        def build_unsigned():
+            state['tree'] = invoice._build_verifactu_unsigned_tree()
+
+        def build_signed():
+            state['tree'] = invoice._generate_verifactu_tree()
+
+        return {
+            'hash': self._measure(invoice._generate_verifactu_hash, setup=reset_hash),
+            'xml': self._measure(invoice._generate_verifactu_xml),
+            'json': self._measure(invoice._generate_verifactu_json),
+            'sign': self._measure(lambda: invoice._sign_verifactu_envelope(state['tree']), setup=build_unsigned),
+            'validate': self._measure(lambda: invoice._validate_xml_against_schema(state['tree']), setup=build_signed),
+            'qr': self._measure(invoice._generate_verifactu_qr, setup=verifactu_qr_svg.cache_clear),
+        }
+
+    def test_benchmark_pipeline(self):
+        results = {
+            'odoo': release.version,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'date': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'stages': {},
+        }
+        for lines, invoice in self.invoices.items():
+            for stage, timing in self._benchmark_invoice(invoice).items():
+                results['stages'].setdefault(stage, {})[str(lines)] = timing
+                _logger.info("Benchmark VeriFactu %-8s %4s líneas: mediana %.4fs (min %.4fs, max %.4fs)",
+                             stage, lines, timing['median'], timing['min'], timing['max'])
+
+        output = os.environ.get('VERIFACTU_BENCHMARK_OUTPUT') or os.path.join(
+            config['data_dir'], 'verifactu_benchmark.json')
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        _logger.info("Resultados del benchmark VeriFactu guardados en %s", output)
+
+        baseline_path = os.environ.get('VERIFACTU_BENCHMARK_BASELINE')
+        if not baseline_path:
+            return
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        tolerance = float(os.environ.get('VERIFACTU_BENCHMARK_TOLERANCE', DEFAULT_TOLERANCE))
+        regressions = compare_with_baseline(results, baseline, tolerance)
+        self.assertFalse(regressions, "Regresiones de rendimiento respecto a %s:\n%s" % (baseline_path, '\n'.join(
+            "%s (%s líneas): %.4fs -> %.4fs (x%.2f)" % regression for regression in regressions)))
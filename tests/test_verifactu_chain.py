@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuChain(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.Chain = self.env['verifactu.chain'].sudo()
+        self.company = self.env.company
+
+    def test_head_created_once(self):
+        self.assertFalse(self.Chain._get_head(self.company, create=False))
+        head = self.Chain._get_head(self.company)
+        self.assertEqual(head.company_id, self.company)
+        self.assertEqual(head.installation, str(self.company.id))
+        self.assertEqual(head.sequence, 0)
+        self.assertEqual(self.Chain._get_head(self.company, lock=True), head)
+        self.assertEqual(self.Chain._get_head(self.company, create=False), head)
+        self.assertEqual(self.Chain.search_count([('company_id', '=', self.company.id)]), 1)
+
+    def test_head_seeded_from_history(self):
+        # Envío registrado antes de existir la cabeza de la cadena
+        invoice = self._create_invoices(1)
+        invoice.write({'verifactu_sent': True, 'verifactu_state': 'accepted', 'verifactu_hash': 'A' * 64})
+
+        head = self.Chain._get_head(self.company)
+        self.assertEqual(head.last_move_id, invoice)
+        self.assertEqual(head.last_number, invoice.name)
+        self.assertEqual(head.last_nif, 'B12345678')
+        self.assertEqual(head.last_hash, 'A' * 64)
+
+        following = self._create_invoices(1)
+        self.assertEqual(following._get_verifactu_registro_anterior()['Huella'], 'A' * 64)
+
+    def test_advance(self):
+        invoices = self._create_invoices(2)
+        invoices._generate_verifactu_hash()
+        head = self.Chain._get_head(self.company)
+        head._advance(invoices)
+        self.assertEqual(invoices.mapped('verifactu_chain_seq'), [1, 2])
+        self.assertEqual(invoices[1].verifactu_chain_prev_id, invoices[0])
+        self.assertEqual(head.sequence, 2)
+        self.assertEqual(head.last_move_id, invoices[1])
+        self.assertEqual(head.last_hash, invoices[1].verifactu_hash)
+
+        # Una factura encadenada conserva su registro anterior aunque la cabeza avance
+        later = self._create_invoices(1)
+        later._generate_verifactu_hash()
+        head._advance(later)
+        anterior = invoices[1]._get_verifactu_registro_anterior()
+        self.assertEqual(anterior['NumSerieFactura'], invoices[0].name)
+        self.assertEqual(anterior['Huella'], invoices[0].verifactu_hash)
+
+    def test_send_locks_head_and_advances(self):
+        Chain = type(self.Chain)
+        invoices = self._create_invoices(2)
+        with patch.object(Chain, '_get_head', autospec=True, side_effect=Chain._get_head) as mock_get_head, \
+                self._mock_aeat():
+            invoices._send_verifactu_batches()
+
+        self.assertTrue(any(call.kwargs.get('lock') for call in mock_get_head.call_args_list))
+        self.assertEqual(invoices.mapped('verifactu_chain_seq'), [1, 2])
+        self.assertFalse(invoices[0].verifactu_chain_prev_id)
+        self.assertEqual(invoices[1].verifactu_chain_prev_id, invoices[0])
+        self.assertEqual(self.Chain._get_head(self.company).last_move_id, invoices[1])
@@ -0,0 +1,52 @@
+from odoo.tests import tagged
+
+from ..models.verifactu_chain_verifier import verify_verifactu_chain
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuChainVerifier(VerifactuTestCommon):
+
+    def _send_chain(self, count):
+        invoices = self._create_invoices(count)
+        with self._mock_aeat():
+            invoices._send_verifactu_batches()
+        # Las modificaciones en SQL de los tests no deben pisarse con escrituras pendientes
+        self.env.flush_all()
+        self.assertEqual(set(invoices.mapped('verifactu_state')), {'accepted'})
+        return invoices
+
+    def test_valid_chain(self):
+        self._send_chain(3)
+        # Lotes menores que la cadena: la lectura por lotes no pierde el registro anterior
+        report = verify_verifactu_chain(self.env, self.env.company, batch_size=2)
+        self.assertTrue(report['ok'], report)
+        self.assertEqual(report['checked'], 3)
+        self.assertFalse(report['gaps'])
+        self.assertFalse(report['unchained'])
+
+    def test_detects_changed_amount(self):
+        invoices = self._send_chain(3)
+        # Cambiar un importe después del envío rompe la huella de esa factura
+        tax_line = invoices[1].line_ids.filtered('tax_line_id')
+        self.env.cr.execute("UPDATE account_move_line SET amount_currency = amount_currency - 1 WHERE id = %s",
+                            [tax_line.id])
+        report = verify_verifactu_chain(self.env, self.env.company, batch_size=2)
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['divergences'], 1)
+        self.assertEqual(report['first_divergence']['move_id'], invoices[1].id)
+
+    def test_detects_broken_link(self):
+        invoices = self._send_chain(3)
+        self.env.cr.execute("UPDATE account_move SET verifactu_prev_hash = 'X' WHERE id = %s", [invoices[2].id])
+        report = verify_verifactu_chain(self.env, self.env.company)
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['first_divergence']['move_id'], invoices[2].id)
+
+    def test_detects_gap_and_unchained(self):
+        invoices = self._send_chain(3)
+        self.env.cr.execute("UPDATE account_move SET verifactu_chain_seq = NULL WHERE id = %s", [invoices[1].id])
+        report = verify_verifactu_chain(self.env, self.env.company)
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['gaps'], [(1, 3)])
+        self.assertEqual(report['unchained'], 1)
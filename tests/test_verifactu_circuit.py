@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import tagged
+
+from ..models.verifactu_circuit import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_PROBE_SECONDS
+from .common import VerifactuTestCommon
+
+ENDPOINT = 'https://aeat.test/circuit'
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuCircuit(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        # El circuito usa su propio cursor: en los tests comparte la transacción del test
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.Circuit = self.env['verifactu.circuit'].sudo()
+
+    def _circuit(self):
+        circuit = self.Circuit.search([('endpoint', '=', ENDPOINT)])
+        circuit.invalidate_recordset()
+        return circuit
+
+    def _open(self):
+        for _i in range(CIRCUIT_FAILURE_THRESHOLD):
+            self.Circuit._record_failure(ENDPOINT, 'HTTP 503')
+
+    def _age(self, seconds):
+        """Retrasa ``seconds`` las marcas de tiempo del circuito (simula el paso del tiempo)."""
+        circuit = self._circuit()
+        vals = {'opened_at': circuit.opened_at - timedelta(seconds=seconds)}
+        if circuit.probe_until:
+            vals['probe_until'] = circuit.probe_until - timedelta(seconds=seconds)
+        circuit.write(vals)
+        circuit.flush_recordset()
+
+    def test_opens_after_threshold(self):
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+        for _i in range(CIRCUIT_FAILURE_THRESHOLD - 1):
+            self.Circuit._record_failure(ENDPOINT, 'HTTP 503')
+        self.assertEqual(self._circuit().state, 'closed')
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+
+        self.Circuit._record_failure(ENDPOINT, 'HTTP 503')
+        self.assertEqual(self._circuit().state, 'open')
+        self.assertEqual(self._circuit().last_error, 'HTTP 503')
+        self.assertFalse(self.Circuit._allow_request(ENDPOINT))
+
+    def test_success_resets_failures(self):
+        self.Circuit._record_failure(ENDPOINT, 'HTTP 503')
+        self.Circuit._record_success(ENDPOINT)
+        self.assertEqual(self._circuit().failures, 0)
+
+    def test_single_probe_after_open_period(self):
+        self._open()
+        self._age(CIRCUIT_OPEN_SECONDS + 1)
+
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+        self.assertEqual(self._circuit().state, 'half_open')
+        # Mientras dura la prueba nadie más llama al endpoint
+        self.assertFalse(self.Circuit._allow_request(ENDPOINT))
+
+        # Si el worker de la prueba muere, otro puede probar al caducar la reserva
+        self._age(CIRCUIT_PROBE_SECONDS + 1)
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+
+    def test_failed_probe_reopens(self):
+        self._open()
+        self._age(CIRCUIT_OPEN_SECONDS + 1)
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+
+        self.Circuit._record_failure(ENDPOINT, 'timeout')
+        circuit = self._circuit()
+        self.assertEqual(circuit.state, 'open')
+        self.assertGreater(circuit.opened_at, fields.Datetime.now() - timedelta(seconds=CIRCUIT_OPEN_SECONDS))
+        self.assertFalse(self.Circuit._allow_request(ENDPOINT))
+
+    def test_successful_probe_closes_and_replays_backlog(self):
+        submission = self.env['verifactu.submission']._enqueue(self._create_invoices(1))
+        submission.next_retry_at = fields.Datetime.now() + timedelta(hours=1)
+        self.env.flush_all()
+
+        self._open()
+        self._age(CIRCUIT_OPEN_SECONDS + 1)
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+        self.Circuit._record_success(ENDPOINT)
+
+        self.assertEqual(self._circuit().state, 'closed')
+        self.assertTrue(self.Circuit._allow_request(ENDPOINT))
+        # Los reintentos programados quedan disponibles en cuanto la AEAT responde
+        submission.invalidate_recordset()
+        self.assertFalse(submission.next_retry_at)
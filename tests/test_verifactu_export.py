@@ -0,0 +1,25 @@
+from odoo.tests import tagged
+
+from ..controllers.verifactu_export import _stored_signed_xml
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuExport(VerifactuTestCommon):
+
+    def test_sent_records_export_the_sent_xml(self):
+        invoices = self._create_invoices(3)
+        accepted, rejected, unsent = invoices
+        # Las tres tienen un XML firmado guardado antes del envío
+        for invoice in invoices:
+            invoice._get_verifactu_signed_xml()
+        with self._mock_aeat(rejections={rejected.name: '1100'}):
+            (accepted | rejected)._send_verifactu_batches()
+
+        payloads = _stored_signed_xml(self.env, invoices)
+
+        # Lo enviado a la AEAT prevalece sobre el XML firmado para descarga
+        self.assertEqual(payloads[accepted.id], accepted.verifactu_xml_payload_id)
+        self.assertEqual(payloads[rejected.id], rejected.verifactu_xml_payload_id)
+        signature = self.env['verifactu.signature'].search([('move_id', '=', unsent.id)])
+        self.assertEqual(payloads[unsent.id], signature.verifactu_artifact_payload_id)
@@ -0,0 +1,110 @@
+from odoo.tests import tagged
+
+from ..models.verifactu_hash import verifactu_huella
+from ..models.verifactu_tax_breakdown import format_cents, read_verifactu_amounts, verifactu_amounts
+from .common import SUM1_NS, VerifactuTestCommon
+
+# Ejemplos de la especificación de la huella publicada por la AEAT
+AEAT_FIRST_HUELLA = '3C464DAF61ACB827C65FDA19F352A4E3BDC2C640E9E9FC4CC058073F38F12F60'
+AEAT_SECOND_HUELLA = 'F7B94CFD8924EDFF273501B01EE5153E4CE8F259766F88CF6ACB8935802A2B97'
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuHash(VerifactuTestCommon):
+
+    def test_huella_known_vectors(self):
+        first = verifactu_huella('89890001K', '12345678/G33', '01-01-2024', 'F1', '12.35', '123.45',
+                                 '', '2024-01-01T19:20:30+01:00')
+        self.assertEqual(first, AEAT_FIRST_HUELLA)
+        second = verifactu_huella('89890001K', '12345679/G34', '01-01-2024', 'F1', '12.35', '123.45',
+                                  first, '2024-01-01T19:20:35+01:00')
+        self.assertEqual(second, AEAT_SECOND_HUELLA)
+
+    def test_huella_strips_identifiers(self):
+        self.assertEqual(
+            verifactu_huella(' 89890001K ', '12345678/G33 ', '01-01-2024', 'F1', '12.35', '123.45',
+                             None, '2024-01-01T19:20:30+01:00'),
+            AEAT_FIRST_HUELLA,
+        )
+
+    def test_format_cents(self):
+        self.assertEqual(format_cents(0), '0.00')
+        self.assertEqual(format_cents(5), '0.05')
+        self.assertEqual(format_cents(12345), '123.45')
+        self.assertEqual(format_cents(-5), '-0.05')
+        self.assertEqual(format_cents(-12300), '-123.00')
+
+    def test_amounts_ignore_other_lines(self):
+        # Venta (signo -1): producto y cuota cuentan; la línea a cobrar y el redondeo no
+        lines = [
+            ('product', False, -100.0),
+            ('product', False, -50.0),
+            ('tax', True, -31.5),
+            ('payment_term', False, 181.5),
+            ('rounding', False, -0.01),
+        ]
+        self.assertEqual(verifactu_amounts(lines, -1), (3150, 18150))
+
+    def test_live_hash_uses_shared_amounts(self):
+        invoice = self._create_invoices(1)
+        invoice._generate_verifactu_hash()
+        cuota, importe_total = read_verifactu_amounts(self.env.cr, invoice.ids)[invoice.id]
+        breakdown = invoice._get_verifactu_tax_breakdown()
+        self.assertEqual((cuota, importe_total), (breakdown['cuota'], breakdown['base'] + breakdown['cuota']))
+        self.assertEqual(invoice.verifactu_hash, verifactu_huella(
+            'B12345678', invoice.name, invoice.invoice_date.strftime('%d-%m-%Y'), 'F1',
+            format_cents(cuota), format_cents(importe_total), '', invoice.verifactu_gen_datetime,
+        ))
+
+    def test_hash_chains_and_is_stable(self):
+        invoices = self._create_invoices(3)
+        invoices._generate_verifactu_hash()
+        self.assertFalse(invoices[0].verifactu_prev_hash)
+        self.assertEqual(invoices[1].verifactu_prev_hash, invoices[0].verifactu_hash)
+        self.assertEqual(invoices[2].verifactu_prev_hash, invoices[1].verifactu_hash)
+
+        # Sin cambios se conservan huella y fecha de generación
+        before = [(invoice.verifactu_hash, invoice.verifactu_gen_datetime) for invoice in invoices]
+        invoices._generate_verifactu_hash()
+        self.assertEqual([(invoice.verifactu_hash, invoice.verifactu_gen_datetime) for invoice in invoices], before)
+
+    def test_first_record_is_primer_registro(self):
+        first, second = invoices = self._create_invoices(2)
+        invoices._generate_verifactu_hash()
+        envelope, reg_factu = first._build_verifactu_envelope(self.env.company)
+        first._append_verifactu_registro_alta(reg_factu)
+        second._append_verifactu_registro_alta(reg_factu, previous=first)
+        first._validate_xml_against_schema(envelope)
+
+        primero, segundo = reg_factu.iter('{%s}Encadenamiento' % SUM1_NS)
+        self.assertEqual(primero.findtext('{%s}PrimerRegistro' % SUM1_NS), 'S')
+        self.assertIsNone(primero.find('{%s}RegistroAnterior' % SUM1_NS))
+        self.assertEqual(segundo.findtext('{ns}RegistroAnterior/{ns}Huella'.format(ns='{%s}' % SUM1_NS)),
+                         first.verifactu_hash)
+        encadenamiento = first._generate_verifactu_json()['RegistroFactura']['RegistroAlta']['Encadenamiento']
+        self.assertEqual(encadenamiento, {'PrimerRegistro': 'S'})
+
+    def test_registro_anterior_without_head_uses_history(self):
+        # Envío registrado antes de existir la cabeza de la cadena
+        sent, invoice = self._create_invoices(2)
+        sent.write({'verifactu_sent': True, 'verifactu_state': 'accepted', 'verifactu_hash': 'A' * 64})
+
+        registro_alta = invoice._generate_verifactu_json(create_head=False)['RegistroFactura']['RegistroAlta']
+        encadenamiento = registro_alta['Encadenamiento']
+        self.assertEqual(encadenamiento['RegistroAnterior']['NumSerieFactura'], sent.name)
+        self.assertEqual(encadenamiento['RegistroAnterior']['Huella'], 'A' * 64)
+        self.assertFalse(self.env['verifactu.chain'].search([('company_id', '=', self.env.company.id)]))
+
+    def test_backfill_matches_live_hashes(self):
+        invoices = self._create_invoices(3)
+        with self._mock_aeat():
+            invoices._send_verifactu_batches()
+        live = invoices.mapped('verifactu_hash')
+        self.env.flush_all()
+        self.env.cr.execute("UPDATE account_move SET verifactu_hash = NULL, verifactu_prev_hash = NULL WHERE id IN %s",
+                            [tuple(invoices.ids)])
+        self.env.invalidate_all()
+
+        self.assertEqual(self.env['account.move']._verifactu_backfill_hashes(self.env.company, batch_size=2), 3)
+        self.assertEqual(invoices.mapped('verifactu_hash'), live)
+        self.assertEqual(invoices[2].verifactu_prev_hash, live[1])
@@ -0,0 +1,55 @@
+from lxml import etree
+
+from odoo.tests import tagged
+
+from ..models.verifactu_payload import PAYLOAD_GC_GRACE_HOURS
+from .common import SUM1_NS, VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuPayload(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.Payload = self.env['verifactu.payload'].sudo()
+
+    def _age(self, payloads, hours):
+        self.env.flush_all()
+        self.env.cr.execute(
+            "UPDATE verifactu_payload SET create_date = create_date - make_interval(hours => %s) WHERE id IN %s",
+            (hours, tuple(payloads.ids)))
+        payloads.invalidate_recordset()
+
+    def test_store_deduplicates(self):
+        text = '<RegFactuSistemaFacturacion>%s</RegFactuSistemaFacturacion>' % ('x' * 10000)
+        payload = self.Payload._store(text)
+        self.assertEqual(self.Payload._store(text), payload)
+        self.assertEqual(payload.size, len(text))
+        self.assertLess(payload.compressed_size, payload.size)
+        self.assertEqual(payload._load(), text)
+        self.assertFalse(self.Payload._store(''))
+
+    def test_sent_batch_shares_payloads(self):
+        invoices = self._create_invoices(2)
+        with self._mock_aeat():
+            invoices._send_verifactu_batches()
+
+        # Todo el lote comparte un único XML enviado y una única respuesta
+        self.assertEqual(len(invoices.verifactu_xml_payload_id), 1)
+        self.assertEqual(len(invoices.verifactu_response_payload_id), 1)
+        root = etree.fromstring(invoices[0].verifactu_xml.encode('utf-8'))
+        self.assertEqual(len(root.findall('.//{%s}RegistroAlta' % SUM1_NS)), 2)
+        self.assertIn('RespuestaLinea', invoices[1].verifactu_response)
+
+    def test_gc_keeps_referenced_and_recent_payloads(self):
+        invoice = self._create_invoices(1)
+        invoice.verifactu_xml = '<xml>enviado</xml>'
+        referenced = invoice.verifactu_xml_payload_id
+        orphan = self.Payload._store('<xml>sin uso</xml>')
+        recent = self.Payload._store('<xml>reciente</xml>')
+        self._age(referenced | orphan, PAYLOAD_GC_GRACE_HOURS + 1)
+
+        self.Payload._gc_unreferenced_payloads()
+        self.assertTrue(referenced.exists())
+        self.assertTrue(recent.exists())
+        self.assertFalse(orphan.exists())
@@ -0,0 +1,127 @@
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from odoo.tests import tagged
+from odoo.tools import mute_logger
+
+from ..models import verifactu_aeat_integration
+from ..models.verifactu_aeat_integration import _parse_soap_fault
+from ..models.verifactu_circuit import CIRCUIT_FAILURE_THRESHOLD
+from .common import VerifactuTestCommon, aeat_response
+
+ENDPOINT = 'https://aeat.test/verifactu'
+STATUS_LOGGER = 'odoo.addons.l10n_es_verifactu.models.verifactu_status_views'
+SOAP_FAULT = (
+    '<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/"><env:Body><env:Fault>'
+    '<faultcode>env:Client</faultcode><faultstring>Codigo[4102].El XML no cumple el esquema</faultstring>'
+    '</env:Fault></env:Body></env:Envelope>'
+)
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuResponse(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        # El circuito usa su propio cursor: en los tests comparte la transacción del test
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.endpoint_url', ENDPOINT)
+        self.move = self.env['account.move']
+
+    def _circuit(self):
+        circuit = self.env['verifactu.circuit'].search([('endpoint', '=', ENDPOINT)])
+        circuit.invalidate_recordset()
+        return circuit
+
+    def _send(self, post):
+        """``_send_to_aeat`` con una sesión HTTP simulada cuyo ``post`` es ``post``."""
+        session = MagicMock()
+        session.post.side_effect = post
+        with patch.object(verifactu_aeat_integration, 'get_aeat_session', return_value=session):
+            return self.move._send_to_aeat('<xml/>'), session
+
+    def _http_response(self, status_code, body):
+        response = MagicMock(status_code=status_code, text=body, content=body.encode('utf-8'))
+        return lambda *args, **kwargs: response
+
+    def test_parse_response_lines(self):
+        parsed = self.move._parse_aeat_response(aeat_response(
+            [('F/1', None), ('F/2', '1100'), ('F/3', None)], tiempo_espera=60, csv='A-123'))
+        self.assertEqual(parsed['estado'], 'ParcialmenteCorrecto')
+        self.assertEqual(parsed['csv'], 'A-123')
+        self.assertEqual(parsed['tiempo_espera'], 60)
+        self.assertEqual(
+            [(linea['num_serie'], linea['estado'], linea['codigo']) for linea in parsed['lineas']],
+            [('F/1', 'Correcto', ''), ('F/2', 'Incorrecto', '1100'), ('F/3', 'Correcto', '')],
+        )
+        self.assertEqual(parsed['lineas'][1]['descripcion'], 'Error 1100')
+
+    def test_parse_invalid_response(self):
+        parsed = self.move._parse_aeat_response('<html>Service Unavailable')
+        self.assertEqual(parsed['estado'], 'Error')
+        self.assertEqual(parsed['lineas'], [])
+        self.assertTrue(parsed['errores'])
+
+    def test_parse_soap_fault(self):
+        self.assertEqual(_parse_soap_fault(SOAP_FAULT), 'Codigo[4102].El XML no cumple el esquema')
+        self.assertIsNone(_parse_soap_fault(aeat_response([('F/1', None)])))
+        self.assertIsNone(_parse_soap_fault('<html>Bad Gateway</html'))
+
+    def test_soap_fault_is_not_retried(self):
+        result, _session = self._send(self._http_response(500, SOAP_FAULT))
+        self.assertFalse(result['success'])
+        self.assertFalse(result.get('retry'))
+        self.assertIn('4102', result['error'])
+        # El endpoint ha respondido: no cuenta como fallo del circuito
+        self.assertEqual(self._circuit().failures, 0)
+
+    def test_server_error_is_retried(self):
+        result, _session = self._send(self._http_response(503, '<html>Service Unavailable</html>'))
+        self.assertTrue(result['retry'])
+        self.assertFalse(result.get('uncertain'))
+        self.assertEqual(self._circuit().failures, 1)
+
+    def test_read_timeout_is_uncertain(self):
+        def post(*args, **kwargs):
+            raise requests.exceptions.ReadTimeout('read timed out')
+        result, _session = self._send(post)
+        self.assertTrue(result['retry'])
+        self.assertTrue(result['uncertain'])
+
+    def test_connect_timeout_is_retried(self):
+        def post(*args, **kwargs):
+            raise requests.exceptions.ConnectTimeout('connect timed out')
+        result, _session = self._send(post)
+        self.assertTrue(result['retry'])
+        self.assertFalse(result.get('uncertain'))
+
+    def test_open_circuit_fails_fast(self):
+        for _i in range(CIRCUIT_FAILURE_THRESHOLD):
+            self._send(self._http_response(503, ''))
+        self.assertEqual(self._circuit().state, 'open')
+
+        result, session = self._send(self._http_response(200, aeat_response([])))
+        self.assertTrue(result['circuit_open'])
+        self.assertTrue(result['retry'])
+        session.post.assert_not_called()
+
+    @mute_logger(STATUS_LOGGER)
+    def test_uncertain_send_reconciles_duplicate(self):
+        invoices = self._create_invoices(2)
+        invoices._apply_verifactu_result({'success': False, 'error': 'timeout', 'retry': True, 'uncertain': True})
+        self.assertEqual(invoices.mapped('verifactu_send_uncertain'), [True, True])
+
+        # El reenvío devuelve "duplicado" para la que la AEAT sí había registrado
+        response = aeat_response([(invoices[0].name, '3000'), (invoices[1].name, None)])
+        invoices._apply_verifactu_result({'success': True, 'status_code': 200, 'response': response})
+        self.assertEqual(invoices.mapped('verifactu_state'), ['accepted', 'accepted'])
+        self.assertEqual(invoices.mapped('verifactu_send_uncertain'), [False, False])
+
+    def test_duplicate_without_uncertain_send_is_rejected(self):
+        invoice = self._create_invoices(1)
+        response = aeat_response([(invoice.name, '3000')])
+        invoice._apply_verifactu_result({'success': True, 'status_code': 200, 'response': response})
+        self.assertEqual(invoice.verifactu_state, 'rejected')
+        self.assertEqual(invoice.verifactu_response_line_ids.codigo, '3000')
@@ -0,0 +1,83 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import tagged
+from odoo.tools import mute_logger
+
+from ..models.verifactu_submission import VERIFACTU_MAX_ATTEMPTS
+from .common import VerifactuTestCommon
+
+STATUS_LOGGER = 'odoo.addons.l10n_es_verifactu.models.verifactu_status_views'
+
+RETRY_RESULT = {
+    'success': False,
+    'error': 'La AEAT respondió con un error 503.',
+    'status_code': 503,
+    'retry': True,
+}
+CIRCUIT_OPEN_RESULT = dict(RETRY_RESULT, circuit_open=True)
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuRetry(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.Submission = self.env['verifactu.submission']
+
+    @mute_logger(STATUS_LOGGER)
+    def test_retry_holds_rest_of_company(self):
+        # Ningún segundo registro cabe en el lote: un envío por factura
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.batch_max_bytes', 1)
+        invoices = self._create_invoices(2)
+        submissions = self.Submission._enqueue(invoices)
+        with self._mock_aeat(results=[RETRY_RESULT]) as calls:
+            submissions._process()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(submissions.mapped('state'), ['pending', 'pending'])
+        # Solo el lote enviado gasta un intento; el resto espera sin gastarlo
+        self.assertEqual(submissions.mapped('attempts'), [1, 0])
+        self.assertTrue(all(submissions.mapped('next_retry_at')))
+        self.assertEqual(invoices[0].verifactu_state, 'error')
+        self.assertFalse(invoices[1].verifactu_sent)
+
+    @mute_logger(STATUS_LOGGER)
+    def test_retry_gives_up_after_max_attempts(self):
+        submission = self.Submission._enqueue(self._create_invoices(1))
+        submission.attempts = VERIFACTU_MAX_ATTEMPTS - 1
+        with self._mock_aeat(results=[RETRY_RESULT]):
+            submission._process()
+        self.assertEqual(submission.state, 'error')
+        self.assertEqual(submission.attempts, VERIFACTU_MAX_ATTEMPTS)
+
+    def test_circuit_open_does_not_spend_attempts(self):
+        invoices = self._create_invoices(2)
+        submissions = self.Submission._enqueue(invoices)
+        with self._mock_aeat(results=[CIRCUIT_OPEN_RESULT]):
+            submissions._process()
+
+        self.assertEqual(submissions.mapped('state'), ['pending', 'pending'])
+        self.assertEqual(submissions.mapped('attempts'), [0, 0])
+        self.assertTrue(all(submissions.mapped('next_retry_at')))
+        self.assertNotIn('error', invoices.mapped('verifactu_state'))
+        self.assertFalse(invoices.mapped('verifactu_xml_payload_id'))
+
+    def test_scheduled_retry_is_not_claimed(self):
+        now, later = self._create_invoices(2)
+        self.Submission._enqueue(now | later)
+        self.Submission.search([('move_id', '=', later.id)]).next_retry_at = \
+            fields.Datetime.now() + timedelta(hours=1)
+        self.env.flush_all()
+
+        claimed = self.Submission._claim_pending(10, [self.env.company.id])
+        self.assertEqual(claimed.move_id, now)
+
+    def test_retry_delay_is_bounded(self):
+        submission = self.Submission._enqueue(self._create_invoices(1))
+        submission.attempts = 3
+        for _i in range(20):
+            self.assertTrue(120 <= submission._get_retry_delay() <= 240)
+        submission.attempts = 30
+        for _i in range(20):
+            self.assertTrue(1800 <= submission._get_retry_delay() <= 3600)
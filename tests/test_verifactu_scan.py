@@ -0,0 +1,33 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from ..controllers import qr_scanner
+from ..controllers.qr_scanner import SCAN_NEGATIVE_TTL, _find_invoice_by_hash
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuScan(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(qr_scanner._SCAN_MISSES.clear)
+        self.Move = self.env['account.move'].sudo()
+
+    def test_find_by_hash(self):
+        invoice = self._create_invoices(1)
+        invoice._generate_verifactu_hash()
+        self.assertEqual(_find_invoice_by_hash(self.Move, invoice.verifactu_hash), invoice)
+        self.assertFalse(_find_invoice_by_hash(self.Move, 'no-es-una-huella'))
+
+    def test_unknown_hash_is_cached_briefly(self):
+        invoice = self._create_invoices(1)
+        unknown = 'F' * 64
+        with patch.object(qr_scanner.time, 'monotonic', return_value=1000.0):
+            self.assertFalse(_find_invoice_by_hash(self.Move, unknown))
+            invoice.verifactu_hash = unknown
+            # Mientras dura la entrada negativa no se consulta la base de datos
+            self.assertFalse(_find_invoice_by_hash(self.Move, unknown))
+        with patch.object(qr_scanner.time, 'monotonic', return_value=1000.0 + SCAN_NEGATIVE_TTL + 1):
+            self.assertEqual(_find_invoice_by_hash(self.Move, unknown), invoice)
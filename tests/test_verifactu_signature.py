@@ -0,0 +1,40 @@
+from unittest.mock import patch
+
+from signxml import XMLSigner, XMLVerifier
+
+from odoo.tests import tagged
+
+from ..models import verifactu_signature_model
+from ..models.verifactu_signature_model import BULK_SIGN_MIN_DOCUMENTS
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuSignature(VerifactuTestCommon):
+
+    def test_bulk_sign_runs_in_pool(self):
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.sign_workers', 2)
+        self.addCleanup(verifactu_signature_model._drop_sign_pool)
+        company = self.env.company
+        invoices = self._create_invoices(BULK_SIGN_MIN_DOCUMENTS)
+        trees = {invoice: invoice._build_verifactu_unsigned_tree() for invoice in invoices}
+
+        # El servidor de tests tiene varios hilos; aun así nada se firma en el propio proceso
+        with patch.object(XMLSigner, 'sign', side_effect=AssertionError("Firma fuera del pool")):
+            signed = self.env['verifactu.signature']._sign_verifactu_xml_bulk(company, trees)
+
+        self.assertEqual(set(signed), set(invoices))
+        for invoice in invoices:
+            XMLVerifier().verify(signed[invoice], x509_cert=company.verifactu_cert_pem)
+        signatures = self.env['verifactu.signature'].search([('move_id', 'in', invoices.ids)])
+        self.assertEqual(signatures.move_id, invoices)
+        self.assertTrue(all(signatures.mapped('verifactu_artifact_payload_id')))
+
+    def test_bulk_sign_small_batch_in_process(self):
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.sign_workers', 2)
+        invoices = self._create_invoices(2)
+        trees = {invoice: invoice._build_verifactu_unsigned_tree() for invoice in invoices}
+        with patch.object(verifactu_signature_model, '_get_sign_pool') as mock_pool:
+            signed = self.env['verifactu.signature']._sign_verifactu_xml_bulk(self.env.company, trees)
+        mock_pool.assert_not_called()
+        XMLVerifier().verify(signed[invoices[0]], x509_cert=self.env.company.verifactu_cert_pem)
@@ -0,0 +1,119 @@
+from unittest.mock import patch
+
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+from odoo.tools import mute_logger
+
+from .common import SUM1_NS, VerifactuTestCommon
+
+STATUS_LOGGER = 'odoo.addons.l10n_es_verifactu.models.verifactu_status_views'
+
+FAULT_RESULT = {
+    'success': False,
+    'error': 'La AEAT rechazó el envío: Codigo[4102]',
+    'status_code': 500,
+}
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuSubmission(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.Submission = self.env['verifactu.submission']
+
+    def test_queue_sends_in_one_batch(self):
+        invoices = self._create_invoices(3)
+        submissions = self.Submission._enqueue(invoices)
+        with self._mock_aeat() as calls:
+            submissions._process()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(submissions.mapped('state'), ['done'] * 3)
+        self.assertEqual(submissions.mapped('attempts'), [1] * 3)
+        self.assertTrue(all(submissions.mapped('date_done')))
+        self.assertEqual(invoices.mapped('verifactu_state'), ['accepted'] * 3)
+
+    def test_invalid_invoice_does_not_block_others(self):
+        invoices = self._create_invoices(2)
+        untaxed = self._create_invoices(1, post=False)
+        untaxed.invoice_line_ids.tax_ids = False
+        untaxed.action_post()
+        submissions = self.Submission._enqueue(invoices | untaxed)
+        with self._mock_aeat() as calls:
+            submissions._process()
+
+        self.assertEqual(calls[0][1], [(invoice.name, None) for invoice in invoices])
+        self.assertEqual(submissions.mapped('state'), ['done', 'done', 'error'])
+        self.assertIn('impuesto', submissions[2].error_message)
+
+    @mute_logger(STATUS_LOGGER)
+    def test_schema_error_fails_only_that_record(self):
+        invoices = self._create_invoices(3)
+        bad = invoices[1]
+        Move = type(self.env['account.move'])
+        validate = Move._validate_xml_against_schema
+
+        def _validate_xml_against_schema(move, xml_data):
+            numbers = [node.text for node in xml_data.iter('{%s}NumSerieFactura' % SUM1_NS)]
+            if bad.name in numbers:
+                raise UserError("NumSerieFactura no válido")
+            return validate(move, xml_data)
+
+        submissions = self.Submission._enqueue(invoices)
+        with patch.object(Move, '_validate_xml_against_schema', _validate_xml_against_schema), \
+                self._mock_aeat() as calls:
+            submissions._process()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][1], [(invoices[0].name, None), (invoices[2].name, None)])
+        self.assertEqual(submissions.mapped('state'), ['done', 'error', 'done'])
+        self.assertEqual(bad.verifactu_state, 'error')
+        self.assertIn('NumSerieFactura no válido', submissions[1].error_message)
+        self.assertEqual(invoices[2].verifactu_prev_hash, invoices[0].verifactu_hash)
+
+    @mute_logger(STATUS_LOGGER)
+    def test_failed_send_leaves_rest_pending(self):
+        # Ningún segundo registro cabe en el lote: un envío por factura
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.batch_max_bytes', 1)
+        invoices = self._create_invoices(2)
+        submissions = self.Submission._enqueue(invoices)
+        with self._mock_aeat(results=[FAULT_RESULT]) as calls:
+            submissions._process()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(submissions.mapped('state'), ['error', 'pending'])
+        # La factura que no se llegó a enviar no gasta un intento
+        self.assertEqual(submissions.mapped('attempts'), [1, 0])
+        self.assertFalse(submissions[1].next_retry_at)
+
+    def test_enqueue_and_claim_order(self):
+        low, high, later = self._create_invoices(3)
+        self.Submission._enqueue(low | later, priority=10)
+        self.Submission._enqueue(high, priority=20)
+        self.Submission.search([('move_id', '=', later.id)]).state = 'done'
+        self.env.flush_all()
+
+        claimed = self.Submission._claim_pending(10, [self.env.company.id])
+        self.assertEqual(claimed.move_id, high | low)
+        self.assertEqual(claimed[0].move_id, high)
+
+        # Volver a encolar no duplica y solo sube la prioridad
+        again = self.Submission._enqueue(low, priority=20)
+        self.assertEqual(again, claimed[1])
+        self.assertEqual(again.priority, 20)
+        self.assertEqual(self.Submission.search_count([('move_id', '=', low.id)]), 1)
+
+    @mute_logger(STATUS_LOGGER)
+    def test_failed_submission_can_be_retried(self):
+        submission = self.Submission._enqueue(self._create_invoices(1))
+        with self._mock_aeat(results=[FAULT_RESULT]):
+            submission._process()
+        self.assertEqual(submission.state, 'error')
+
+        submission.action_retry()
+        self.assertEqual(submission.state, 'pending')
+        with self._mock_aeat():
+            submission._process()
+        self.assertEqual(submission.state, 'done')
+        self.assertEqual(submission.attempts, 2)
@@ -0,0 +1,66 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from .common import VerifactuTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestVerifactuTiempoEspera(VerifactuTestCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.Submission = self.env['verifactu.submission']
+
+    def _head(self):
+        return self.env['verifactu.chain'].sudo()._get_head(self.env.company)
+
+    def test_tiempo_espera_defers_partial_batches(self):
+        with self._mock_aeat(tiempo_espera=60):
+            self.Submission._enqueue(self._create_invoices(1))._process()
+        head = self._head()
+        self.assertGreater(head.next_send_at, fields.Datetime.now())
+
+        submission = self.Submission._enqueue(self._create_invoices(1))
+        self.env.flush_all()
+        company_id = self.env.company.id
+        self.assertNotIn(company_id, self.Submission._get_ready_companies(1000))
+        # Con pendientes suficientes para llenar un lote no se espera
+        self.assertIn(company_id, self.Submission._get_ready_companies(1))
+
+        with self._mock_aeat() as calls:
+            submission._process()
+        self.assertFalse(calls)
+        self.assertEqual(submission.state, 'pending')
+        self.assertEqual(submission.attempts, 0)
+
+        head.next_send_at = fields.Datetime.now() - timedelta(seconds=1)
+        self.env.flush_all()
+        self.assertIn(company_id, self.Submission._get_ready_companies(1000))
+
+    def test_tiempo_espera_applies_between_batches_of_a_run(self):
+        # Ningún segundo registro cabe en el lote: un envío por factura
+        self.env['ir.config_parameter'].sudo().set_param('verifactu.batch_max_bytes', 1)
+        invoices = self._create_invoices(2)
+        with self._mock_aeat(tiempo_espera=60) as calls:
+            failed, retry, held, deferred = invoices._send_verifactu_batches()
+
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(failed | retry | held)
+        self.assertEqual(deferred, invoices[1])
+
+    def test_cron_wakes_up_when_tiempo_espera_ends(self):
+        with self._mock_aeat(tiempo_espera=60):
+            self.Submission._enqueue(self._create_invoices(1))._process()
+        self.Submission._enqueue(self._create_invoices(1))
+        self.env.flush_all()
+
+        Submission = type(self.Submission)
+        with patch.object(Submission, '_trigger_workers', autospec=True) as trigger, \
+                self._mock_aeat() as calls:
+            self.Submission._cron_process_queue(batch_size=1000)
+
+        self.assertFalse(calls)
+        trigger.assert_called_once_with(self.Submission, at=self._head().next_send_at)